@@ -0,0 +1,665 @@
+import asyncio
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import uuid
+from db import SimpleDB
+from eviction import POLICIES, entry_size
+from client import AsyncClient
+from server import Server
+from replication import ReplicationServer, Replica
+from sharded import ShardedDB
+from tiered import TieredStore
+
+'''
+Micro benchmarks for SimpleDB
+
+Usage: python benchmark.py [number of operations]
+'''
+
+
+# Run func(i) for i in range(n) and return operations per second
+def ops_per_sec(func, n: int):
+    start = time.perf_counter()
+    for i in range(n):
+        func(i)
+    elapsed = time.perf_counter() - start
+    return n / elapsed if elapsed > 0 else float('inf')
+
+
+def report(name: str, rate: float):
+    print('{:<40} {:>14,.0f} ops/sec'.format(name, rate))
+
+
+# Autocommit put vs the old path of creating and committing a transaction per key
+def bench_autocommit_put(n: int = 200000):
+    keys = ['key_%d' % i for i in range(n)]
+
+    db = SimpleDB()
+
+    def transaction_put(i):
+        transactionId = str(uuid.uuid4())
+        db.createTransaction(transactionId)
+        db.put(keys[i], 'value', transactionId)
+        db.commitTransaction(transactionId)
+
+    baseline = ops_per_sec(transaction_put, n)
+
+    db = SimpleDB()
+
+    def autocommit_put(i):
+        db.put(keys[i], 'value')
+
+    fast = ops_per_sec(autocommit_put, n)
+
+    report('put via transaction per key', baseline)
+    report('put autocommit', fast)
+    print('{:<40} {:>14.1f}x'.format('speedup', fast / baseline))
+    return baseline, fast
+
+
+# One transaction per key vs a single transaction holding every key
+def bench_multi_key_transaction(n: int = 200000):
+    keys = ['key_%d' % i for i in range(n)]
+
+    db = SimpleDB()
+
+    def transaction_per_key(i):
+        transactionId = str(uuid.uuid4())
+        db.createTransaction(transactionId)
+        db.put(keys[i], 'value', transactionId)
+        db.commitTransaction(transactionId)
+
+    baseline = ops_per_sec(transaction_per_key, n)
+
+    db = SimpleDB()
+    db.createTransaction('batch')
+
+    def batch_put(i):
+        db.put(keys[i], 'value', 'batch')
+
+    start = time.perf_counter()
+    for i in range(n):
+        batch_put(i)
+    db.commitTransaction('batch')
+    fast = n / (time.perf_counter() - start)
+
+    report('transaction per key', baseline)
+    report('one transaction for all keys', fast)
+    print('{:<40} {:>14.1f}x'.format('speedup', fast / baseline))
+    return baseline, fast
+
+
+# Loops of single key calls vs the batch APIs
+def bench_batch(n: int = 200000):
+    items = {'key_%d' % i: 'value_%d' % i for i in range(n)}
+    keys = list(items)
+    results = {}
+
+    db = SimpleDB()
+    results['put loop'] = ops_per_sec(lambda i: db.put(keys[i], items[keys[i]]), n)
+    db = SimpleDB()
+    results['put_many'] = ops_per_sec(lambda i: db.put_many(items), 1) * n
+
+    results['get loop'] = ops_per_sec(lambda i: db.get(keys[i]), n)
+    results['get_many'] = ops_per_sec(lambda i: db.get_many(keys), 1) * n
+
+    results['delete loop'] = ops_per_sec(lambda i: db.delete(keys[i]), n)
+    db = SimpleDB()
+    db.put_many(items)
+    results['delete_many'] = ops_per_sec(lambda i: db.delete_many(keys), 1) * n
+
+    for name, rate in results.items():
+        report(name, rate)
+    return results
+
+
+# Run worker(thread_index) on each thread and return total operations per second
+def threaded_ops_per_sec(worker, threads: int, ops_per_thread: int):
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return threads * ops_per_thread / (time.perf_counter() - start)
+
+
+# Mixed 90% get / 10% put from several threads, thread safe mode vs one
+# global lock around every call
+def bench_threads(n: int = 200000, threads: int = 8):
+    per_thread = n // threads
+    keys = ['key_%d' % i for i in range(1000)]
+    results = {}
+
+    db = SimpleDB(dict.fromkeys(keys, 'value'))
+    global_lock = threading.Lock()
+
+    def global_lock_worker(t):
+        for i in range(per_thread):
+            with global_lock:
+                if i % 10 == 0:
+                    db.put(keys[(t + i) % 1000], 'value')
+                else:
+                    db.get(keys[(t + i) % 1000])
+
+    results['global lock %d threads' % threads] = threaded_ops_per_sec(
+        global_lock_worker, threads, per_thread)
+
+    safe_db = SimpleDB(dict.fromkeys(keys, 'value'), thread_safe=True)
+
+    def striped_worker(t):
+        for i in range(per_thread):
+            if i % 10 == 0:
+                safe_db.put(keys[(t + i) % 1000], 'value')
+            else:
+                safe_db.get(keys[(t + i) % 1000])
+
+    results['thread safe %d threads' % threads] = threaded_ops_per_sec(
+        striped_worker, threads, per_thread)
+
+    # Transactions incrementing shared counters, count aborts
+    safe_db = SimpleDB(dict.fromkeys(keys[:10], '0'), thread_safe=True)
+    aborts = []
+
+    def transaction_worker(t):
+        for i in range(per_thread // 10):
+            transactionId = '%d_%d' % (t, i)
+            key = keys[i % 10]
+            safe_db.createTransaction(transactionId)
+            safe_db.put(key, str(int(safe_db.get(key, transactionId)) + 1), transactionId)
+            try:
+                safe_db.commitTransaction(transactionId)
+            except Exception:
+                aborts.append(transactionId)
+
+    results['transactions %d threads' % threads] = threaded_ops_per_sec(
+        transaction_worker, threads, per_thread // 10)
+
+    for name, rate in results.items():
+        report(name, rate)
+    print('{:<40} {:>14,}'.format('transaction aborts', len(aborts)))
+    return results
+
+
+# Durable autocommit puts from several threads at each durability level
+# Threads incrementing one hot counter in transactions, retried until they
+# commit: optimistic get and put, pessimistic get and put, then incr. Each
+# transaction yields the GIL midway like a client doing work, so they overlap.
+def bench_contention(n: int = 20000, threads: int = 8):
+    per_thread = n // threads
+    results = {}
+    for mode in ('optimistic', 'pessimistic', 'incr'):
+        db = SimpleDB({'counter': '0'}, thread_safe=True,
+                      concurrency='pessimistic' if mode == 'pessimistic' else 'optimistic')
+        aborts = [0] * threads
+
+        def worker(i):
+            done = 0
+            while done < per_thread:
+                transactionId = str(uuid.uuid4())
+                try:
+                    db.createTransaction(transactionId)
+                    if mode == 'incr':
+                        db.incr('counter', 1, transactionId)
+                        time.sleep(0)
+                    else:
+                        value = int(db.get('counter', transactionId))
+                        time.sleep(0)
+                        db.put('counter', str(value + 1), transactionId)
+                    db.commitTransaction(transactionId)
+                    done += 1
+                except Exception:
+                    aborts[i] += 1
+
+        name = 'hot counter %s' % mode
+        results[name] = threaded_ops_per_sec(worker, threads, per_thread)
+        report(name, results[name])
+        print('{:<40} {:>14.1%}'.format('  aborted attempts',
+                                        sum(aborts) / (sum(aborts) + per_thread * threads)))
+        assert db.get('counter') == str(per_thread * threads)
+    return results
+
+
+def bench_wal(n: int = 20000, threads: int = 8):
+    per_thread = n // threads
+    results = {}
+    with tempfile.TemporaryDirectory() as wal_dir:
+        for durability in ('always', 'periodic', 'os'):
+            db = SimpleDB(thread_safe=True, wal_path=os.path.join(wal_dir, durability),
+                          durability=durability)
+
+            def worker(t):
+                for i in range(per_thread):
+                    db.put('key_%d_%d' % (t, i), 'value')
+
+            name = 'wal %s %d threads' % (durability, threads)
+            results[name] = threaded_ops_per_sec(worker, threads, per_thread)
+            db.close()
+            report(name, results[name])
+            print('{:<40} {:>14,}'.format('  fsync count', db.wal.sync_count))
+    return results
+
+
+# Time to start a database of n keys from a snapshot vs replaying the log
+def bench_startup(n: int = 1000000):
+    data = {'key_%d' % i: 'value_%d' % i for i in range(n)}
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        snapshot_path = os.path.join(data_dir, 'db.snap')
+        wal_path = os.path.join(data_dir, 'db.wal')
+        db = SimpleDB(wal_path=wal_path, durability='os')
+        db.put_many(data)
+        db.save_snapshot(snapshot_path)
+        db.close()
+
+        for name, kwargs in (('startup from snapshot', {'snapshot_path': snapshot_path}),
+                             ('startup from log replay', {'wal_path': wal_path})):
+            start = time.perf_counter()
+            db = SimpleDB(**kwargs)
+            results[name] = time.perf_counter() - start
+            db.close()
+            print('{:<40} {:>14.3f} sec for {:,} keys'.format(name, results[name], n))
+    return results
+
+
+# Autocommit puts into a database capped at a tenth of the keys written, so most
+# puts evict a key, for every eviction policy
+def bench_eviction(n: int = 200000):
+    maxmemory = entry_size('key_%d' % n, 'value') * (n // 10)
+    results = {}
+    for policy in POLICIES:
+        if policy == 'noeviction':
+            continue
+        db = SimpleDB(maxmemory=maxmemory, eviction_policy=policy)
+        ttl = 3600 if policy == 'volatile-ttl' else None
+
+        def put(i):
+            db.put('key_%d' % i, 'value', ttl=ttl)
+
+        name = 'eviction %s' % policy
+        results[name] = ops_per_sec(put, n)
+        report(name, results[name])
+    return results
+
+
+# Cost of keeping the ordered index on autocommit puts of new keys, and a prefix
+# scan through it vs filtering every key of db
+def bench_ordered_index(n: int = 200000):
+    results = {}
+    for ordered in (False, True):
+        db = SimpleDB(ordered_index=ordered)
+
+        def put(i):
+            db.put('user:%d:name' % (i * 7919 % n), 'value')
+
+        name = 'put %s ordered index' % ('with' if ordered else 'without')
+        results[name] = ops_per_sec(put, n)
+        report(name, results[name])
+
+    queries = 1000
+
+    def prefix(i):
+        list(db.prefix('user:%d:' % i))
+
+    def filtered(i):
+        start = 'user:%d:' % i
+        [(key, value) for key, value in db.getDB().items() if key.startswith(start)]
+
+    results['prefix scan'] = ops_per_sec(prefix, queries)
+    report('prefix scan', results['prefix scan'])
+    results['prefix full scan'] = ops_per_sec(filtered, max(queries // 100, 1))
+    report('prefix full scan', results['prefix full scan'])
+    return results
+
+
+# Overhead of metrics on autocommit put and get: never enabled, enabled, then
+# disabled again which must cost nothing
+def bench_metrics(n: int = 200000):
+    keys = ['key_%d' % i for i in range(n)]
+    results = {}
+    for mode in ('off', 'on', 'disabled'):
+        db = SimpleDB(metrics=mode != 'off')
+        if mode == 'disabled':
+            db.disable_metrics()
+
+        def put_get(i):
+            db.put(keys[i], 'value')
+            db.get(keys[i])
+
+        name = 'put+get metrics %s' % mode
+        results[name] = ops_per_sec(put_get, n)
+        report(name, results[name])
+    return results
+
+
+# Clients that begin transactions and never finish them: without a timeout
+# every one stays open, with one the begins reap them as they go
+def bench_abandoned_transactions(n: int = 200000, timeout: float = 0.01):
+    results = {}
+    for transaction_timeout in (None, timeout):
+        db = SimpleDB({'key': 'value'}, transaction_timeout=transaction_timeout)
+        most_open = 0
+
+        def abandon(i):
+            nonlocal most_open
+            transactionId = 'trans_%d' % i
+            db.createTransaction(transactionId)
+            db.put('key', 'value', transactionId)
+            most_open = max(most_open, len(db.transaction))
+
+        name = 'abandoned %s timeout' % ('with' if transaction_timeout else 'without')
+        results[name] = ops_per_sec(abandon, n)
+        report(name, results[name])
+        print('{:<40} {:>14,}'.format('  most open transactions', most_open))
+    return results
+
+
+# Cost of publishing every commit to the changefeed, then reading it back
+def bench_changefeed(n: int = 200000):
+    keys = ['key_%d' % i for i in range(n)]
+    results = {}
+    for capacity in (None, 65536):
+        db = SimpleDB(changefeed=capacity)
+
+        def put(i):
+            db.put(keys[i], 'value')
+
+        name = 'put %s changefeed' % ('with' if capacity else 'without')
+        results[name] = ops_per_sec(put, n)
+        report(name, results[name])
+    since = db.changefeed.oldest_seq() - 1
+    start = time.perf_counter()
+    count = sum(1 for _ in db.changes(since))
+    results['changes read'] = count / (time.perf_counter() - start)
+    report('changes read', results['changes read'])
+    db.close()
+    return results
+
+
+# Puts on a thread safe primary with a replica following over loopback, then
+# how long the replica takes to apply the backlog
+def bench_replication(n: int = 200000):
+    keys = ['key_%d' % i for i in range(n)]
+    results = {}
+    primary = SimpleDB(thread_safe=True, changefeed=n)
+    server = ReplicationServer(primary, port=0)
+    server.start()
+    with Replica(port=server.port) as replica:
+        replica.wait_for(0, 5)
+
+        def put(i):
+            primary.put(keys[i], 'value')
+
+        results['put with replica'] = ops_per_sec(put, n)
+        report('put with replica', results['put with replica'])
+        start = time.perf_counter()
+        replica.wait_for(primary.commit_seq)
+        results['replica catch up seconds'] = time.perf_counter() - start
+        print('{:<40} {:>14,.3f} s'.format('replica catch up', results['replica catch up seconds']))
+    server.close()
+    primary.close()
+    return results
+
+
+# Counters and binary payloads stored as text (serialized on the way in,
+# parsed on the way out) vs native int and bytes values, and reading half of a
+# 64 KB payload by slicing a copy vs get_view
+def bench_typed_values(n: int = 200000):
+    keys = ['key_%d' % i for i in range(1000)]
+    results = {}
+    db = SimpleDB()
+
+    def text_int(i):
+        db.put(keys[i % 1000], str(i))
+        int(db.get(keys[i % 1000]))
+
+    def native_int(i):
+        db.put(keys[i % 1000], i)
+        db.get(keys[i % 1000])
+
+    payload = os.urandom(4096)
+
+    def text_bytes(i):
+        db.put(keys[i % 1000], payload.hex())
+        bytes.fromhex(db.get(keys[i % 1000]))
+
+    def native_bytes(i):
+        db.put(keys[i % 1000], payload)
+        db.get(keys[i % 1000])
+
+    for name, func in (('int as text put+get', text_int), ('int native put+get', native_int),
+                       ('4KB bytes as hex put+get', text_bytes),
+                       ('4KB bytes native put+get', native_bytes)):
+        results[name] = ops_per_sec(func, n)
+        report(name, results[name])
+
+    db.put('large', os.urandom(65536))
+
+    def slice_copy(i):
+        db.get('large')[i % 1024:i % 1024 + 32768]
+
+    def slice_view(i):
+        db.get_view('large', i % 1024, i % 1024 + 32768)
+
+    for name, func in (('32KB of 64KB via slice', slice_copy),
+                       ('32KB of 64KB via get_view', slice_view)):
+        results[name] = ops_per_sec(func, n)
+        report(name, results[name])
+    return results
+
+
+# Read-modify-write of one key as a transaction (begin, get, put, commit) vs
+# the single call atomic operations
+def bench_atomic(n: int = 200000):
+    results = {}
+    db = SimpleDB({'counter': '0', 'config': '0'})
+
+    def transaction(i):
+        transactionId = str(uuid.uuid4())
+        db.createTransaction(transactionId)
+        value = db.get('config', transactionId)
+        db.put('config', str(int(value) + 1), transactionId)
+        db.commitTransaction(transactionId)
+
+    def cas(i):
+        value = db.get('config')
+        db.cas('config', value, str(int(value) + 1))
+
+    def incr(i):
+        db.incr('counter')
+
+    def getset(i):
+        db.getset('config', 'value')
+
+    for name, func in (('read-modify-write transaction', transaction), ('get + cas', cas),
+                       ('incr', incr), ('getset', getset)):
+        results[name] = ops_per_sec(func, n)
+        report(name, results[name])
+    return results
+
+
+# Tiered storage holding a tenth of n keys in memory: puts, reads of a hot set that
+# fits in memory, and uniform reads mostly going to disk, against dict storage
+def bench_tiered(n: int = 200000):
+    results = {}
+    keys = ['key_%d' % i for i in range(n)]
+    rng = random.Random(42)
+    hot_reads = [keys[rng.randrange(n // 20)] for i in range(n)]
+    uniform_reads = [keys[rng.randrange(n)] for i in range(n)]
+    for storage in ('dict', 'tiered'):
+        db = SimpleDB(storage=storage if storage == 'dict' else TieredStore(hot_keys=n // 10))
+        value = 'x' * 100
+        results['%s put' % storage] = ops_per_sec(lambda i: db.put(keys[i], value), n)
+        results['%s get hot set' % storage] = ops_per_sec(lambda i: db.get(hot_reads[i]), n)
+        results['%s get uniform' % storage] = ops_per_sec(lambda i: db.get(uniform_reads[i]), n)
+        for name in ('put', 'get hot set', 'get uniform'):
+            report('%s %s' % (storage, name), results['%s %s' % (storage, name)])
+        db.close()
+    return results
+
+
+# Paging through n keys with scan_page while keys are written, against copying
+# getDB, and from a transaction snapshot
+def bench_scan_page(n: int = 200000, count: int = 1000):
+    results = {}
+    db = SimpleDB({'key_%d' % i: 'value' for i in range(n)}, ordered_index=True)
+    start = time.perf_counter()
+    dict(db.getDB())
+    results['getDB copy'] = n / (time.perf_counter() - start)
+
+    def page_through(transactionId=None):
+        start = time.perf_counter()
+        cursor, page = db.scan_page(count=count, transactionId=transactionId)
+        pages = 0
+        while cursor != None:
+            db.put('key_%d' % pages, 'new')
+            cursor, page = db.scan_page(cursor, count, transactionId=transactionId)
+            pages += 1
+        return n / (time.perf_counter() - start)
+
+    results['scan_page'] = page_through()
+    db.createTransaction('snapshot')
+    results['scan_page snapshot'] = page_through('snapshot')
+    db.rollbackTransaction('snapshot')
+    for name, rate in results.items():
+        print('{:<40} {:>14,.0f} keys/sec'.format(name, rate))
+    return results
+
+
+def report_latency(name: str, latencies):
+    latencies = sorted(latencies)
+    for label, quantile in (('p50', 0.5), ('p99', 0.99)):
+        latency = latencies[min(int(len(latencies) * quantile), len(latencies) - 1)]
+        print('{:<40} {:>14,.1f} us'.format('  %s %s' % (name, label), latency * 1e6))
+
+
+# Loopback load on server.py: clients coroutines sharing a pool of pool_size
+# connections, each sending one request at a time, alternating put and get.
+# Then the same requests sent as pipelines of pipeline_depth commands.
+def bench_server(n: int = 100000, clients: int = 64, pool_size: int = 4,
+                 pipeline_depth: int = 100):
+    async def run():
+        results = {}
+        server = Server(SimpleDB(), port=0)
+        await server.start()
+        async with AsyncClient(port=server.port, pool_size=pool_size) as client:
+            latencies = []
+            per_client = n // clients
+
+            async def worker(c):
+                for i in range(per_client):
+                    key = 'key_%d_%d' % (c, i // 2)
+                    start = time.perf_counter()
+                    if i % 2 == 0:
+                        await client.put(key, 'value')
+                    else:
+                        await client.get(key)
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*[worker(c) for c in range(clients)])
+            name = 'server %d clients' % clients
+            results[name] = len(latencies) / (time.perf_counter() - start)
+            report(name, results[name])
+            report_latency(name, latencies)
+
+            latencies = []
+
+            async def pipeline_worker(c):
+                for i in range(0, per_client, pipeline_depth):
+                    commands = [('PUT', 'key_%d_%d' % (c, j), 'value')
+                                for j in range(i, i + pipeline_depth)]
+                    start = time.perf_counter()
+                    await client.pipeline(commands)
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*[pipeline_worker(c) for c in range(clients)])
+            name = 'server pipeline of %d' % pipeline_depth
+            results[name] = len(latencies) * pipeline_depth / (time.perf_counter() - start)
+            report(name, results[name])
+            report_latency(name, latencies)
+        await server.close()
+        return results
+
+    return asyncio.run(run())
+
+
+# Batched writes through ShardedDB as the number of worker processes grows, every
+# batch is split per shard and committed with two-phase commit. Shards log to a
+# write-ahead log (durability 'os') so each has CPU work of its own to spread.
+def bench_sharded(n: int = 200000, batch: int = 10000):
+    results = {}
+    cores = os.cpu_count() or 1
+    shard_counts = sorted({1, 2, 4, cores})
+    with tempfile.TemporaryDirectory() as wal_dir:
+        for shards in shard_counts:
+            with ShardedDB(shards, wal_path=os.path.join(wal_dir, 'db_%d.wal' % shards),
+                           durability='os') as db:
+                def put_batch(i):
+                    start = i * batch
+                    db.put_many({'key_%d' % j: 'value' for j in range(start, start + batch)})
+
+                name = 'sharded put_many %d shards' % shards
+                results[name] = ops_per_sec(put_batch, max(n // batch, 1)) * batch
+                report(name, results[name])
+    print('{:<40} {:>14}'.format('  cores', cores))
+    return results
+
+
+# Run in a child process: peak memory in bytes taken by n keys in a SimpleDB with
+# the given storage, half of the values repeated and half unique
+def measure_storage(storage: str, n: int, results):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    db = SimpleDB(storage=storage)
+    chunk = 100000
+    for start in range(0, n, chunk):
+        db.put_many({'key_%d' % i: 'status_%d' % (i % 16) if i % 2 else
+                     'user_%d@example.com' % i for i in range(start, min(start + chunk, n))})
+    # ru_maxrss is in kilobytes on Linux
+    results.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) * 1024)
+
+
+# Memory of the dict and arena storage at n keys, each built in its own process
+def bench_storage(n: int = 10000000):
+    results = {}
+    for storage in ('dict', 'arena'):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure_storage, args=(storage, n, queue))
+        process.start()
+        name = 'storage %s %d keys' % (storage, n)
+        results[name] = queue.get()
+        process.join()
+        print('{:<40} {:>14,.0f} MB ({:.0f} bytes/key)'.format(
+            name, results[name] / 2 ** 20, results[name] / n))
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    bench_autocommit_put(n)
+    bench_multi_key_transaction(n)
+    bench_batch(n)
+    bench_threads(n)
+    bench_contention(n // 10)
+    bench_wal(n // 10)
+    bench_startup(n)
+    bench_eviction(n)
+    bench_ordered_index(n)
+    bench_server(n // 2)
+    bench_sharded(n)
+    bench_storage(n)
+    bench_metrics(n)
+    bench_abandoned_transactions(n)
+    bench_changefeed(n)
+    bench_replication(n // 2)
+    bench_typed_values(n)
+    bench_atomic(n)
+    bench_tiered(n)
+    bench_scan_page(n)
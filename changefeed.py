@@ -0,0 +1,185 @@
+import asyncio
+import itertools
+import threading
+from collections import namedtuple
+
+'''
+Change data capture for SimpleDB
+
+Every commit is published as a Change (commit sequence number, puts as {key:
+value}, deleted keys, deadlines of puts with a TTL as {key: deadline} or None)
+into a ring buffer holding the last capacity commits.
+Commit sequence numbers have no gaps, so the change of commit n sits at slot
+n % capacity and a consumer resumes after any sequence number it still holds
+in O(1). A consumer that falls further behind than capacity gets an exception
+and must reload the data (getDB) before following again.
+
+Commits on different key stripes can publish out of order, a change is only
+made visible once every commit before it has been published.
+
+Watch callbacks run on one dispatcher thread following the feed, never on the
+thread that committed, so a slow callback does not slow commits down.
+'''
+
+Change = namedtuple('Change', ('commit_seq', 'puts', 'deletes', 'expires'), defaults=(None,))
+
+# Changes copied out of the buffer per lock
+READ_BATCH = 256
+
+
+class ChangeFeed(object):
+    def __init__(self, capacity: int = 65536, next_seq: int = 1):
+        if capacity < 1:
+            raise ValueError("Error, changefeed capacity must be at least 1")
+        self.capacity = capacity
+        self.buffer = [None] * capacity
+        # First commit sequence number this feed was given, and the next one
+        # to make visible
+        self.first_seq = next_seq
+        self.next_seq = next_seq
+        # Changes published ahead of an earlier one as {commit_seq: Change}
+        self.pending = {}
+        self.condition = threading.Condition(threading.Lock())
+        # (loop, asyncio.Event) of every changes_async waiting for a change
+        self.async_waiters = set()
+        # {watchId: (key, prefix, callback)}
+        self.watches = {}
+        self.watch_ids = itertools.count(1)
+        self.dispatcher = None
+        self.callback_errors = 0
+        self.missed_changes = 0
+        self.closed = False
+
+    def publish(self, commit_seq: int, puts, deletes=(), expires=None):
+        change = Change(commit_seq, puts, deletes if type(deletes) == tuple else tuple(deletes),
+                        expires)
+        with self.condition:
+            if commit_seq != self.next_seq:
+                self.pending[commit_seq] = change
+                return
+            self.buffer[commit_seq % self.capacity] = change
+            self.next_seq += 1
+            while self.pending and self.next_seq in self.pending:
+                self.buffer[self.next_seq % self.capacity] = self.pending.pop(self.next_seq)
+                self.next_seq += 1
+            self.condition.notify_all()
+            waiters = list(self.async_waiters) if self.async_waiters else ()
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    # Oldest commit sequence number still held
+    def oldest_seq(self):
+        return max(self.first_seq, self.next_seq - self.capacity)
+
+    # Up to limit changes after since, in order
+    def read(self, since: int, limit: int = READ_BATCH):
+        with self.condition:
+            if since + 1 < self.oldest_seq():
+                raise Exception("Error, changes after %d are no longer kept" % since)
+            end = min(self.next_seq, since + 1 + limit)
+            return [self.buffer[seq % self.capacity] for seq in range(since + 1, end)]
+
+    # Wait until a change after since is visible, False after timeout seconds
+    # or once closed
+    def wait(self, since: int, timeout: float = None):
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.next_seq > since + 1 or self.closed, timeout) and not self.closed
+
+    def last_seq(self):
+        return self.next_seq - 1
+
+    def changes(self, since: int, wait: bool = False, timeout: float = None):
+        while True:
+            batch = self.read(since)
+            if batch:
+                for change in batch:
+                    yield change
+                since = batch[-1].commit_seq
+                continue
+            if not wait or not self.wait(since, timeout):
+                return
+
+    async def changes_async(self, since: int):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.condition:
+            self.async_waiters.add(waiter)
+        try:
+            while True:
+                # Cleared before reading, a change published meanwhile set it again
+                waiter[1].clear()
+                batch = self.read(since)
+                if batch:
+                    for change in batch:
+                        yield change
+                    since = batch[-1].commit_seq
+                    continue
+                if self.closed:
+                    return
+                await waiter[1].wait()
+        finally:
+            with self.condition:
+                self.async_waiters.discard(waiter)
+
+    def watch(self, callback, key: str = None, prefix: str = None):
+        with self.condition:
+            watchId = next(self.watch_ids)
+            self.watches[watchId] = (key, prefix, callback)
+            if self.dispatcher == None:
+                self.dispatcher = threading.Thread(target=self.dispatch,
+                                                   args=(self.last_seq(),), daemon=True)
+                self.dispatcher.start()
+        return watchId
+
+    def unwatch(self, watchId: int):
+        with self.condition:
+            if self.watches.pop(watchId, None) == None:
+                raise Exception("Error, watchId not in changefeed")
+
+    # Dispatcher thread, call the matching watches of every change after since
+    def dispatch(self, since: int):
+        while not self.closed:
+            try:
+                for change in self.changes(since, wait=True):
+                    since = change.commit_seq
+                    if self.watches:
+                        self.notify(change)
+            except Exception:
+                # Fell behind the buffer, skip to the oldest change still held
+                oldest = self.oldest_seq()
+                self.missed_changes += oldest - 1 - since
+                since = oldest - 1
+
+    def notify(self, change: Change):
+        watches = list(self.watches.values())
+        deletes = ((key, None) for key in change.deletes)
+        for key, value in itertools.chain(change.puts.items(), deletes):
+            for watch_key, watch_prefix, callback in watches:
+                if watch_key != None and watch_key != key:
+                    continue
+                if watch_prefix != None and not key.startswith(watch_prefix):
+                    continue
+                try:
+                    callback(key, value, change.commit_seq)
+                except Exception:
+                    self.callback_errors += 1
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            waiters = list(self.async_waiters)
+            dispatcher = self.dispatcher
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+        if dispatcher != None and dispatcher is not threading.current_thread():
+            dispatcher.join()
+
+    def stats(self):
+        return {
+            'last_seq': self.last_seq(),
+            'oldest_seq': self.oldest_seq(),
+            'watches': len(self.watches),
+            'callback_errors': self.callback_errors,
+            'missed_changes': self.missed_changes,
+        }
@@ -0,0 +1,207 @@
+import asyncio
+from collections import deque
+from protocol import ReplyError, check_args, encode_command, parse_reply, reply_exception
+
+'''
+asyncio client for server.py
+
+A pool of up to pool_size connections. Every connection is pipelined: requests
+are written as soon as they are made and their replies are matched in order by
+a reader task, so many coroutines share a connection without waiting for each
+other's round trip. A request goes to the connection with the fewest replies
+outstanding, a new connection is opened while every open one is busy.
+'''
+
+READ_SIZE = 64 * 1024
+
+
+class Connection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # Futures of the requests sent, in order, waiting for their reply
+        self.pending = deque()
+        self.closed = False
+        self.reader_task = asyncio.ensure_future(self.read_replies())
+
+    @classmethod
+    async def open(cls, host: str, port: int):
+        reader, writer = await asyncio.open_connection(host, port, limit=READ_SIZE)
+        return cls(reader, writer)
+
+    # Write a request, return the future of its reply
+    def send(self, args):
+        if not check_args(args):
+            raise TypeError
+        if self.closed:
+            raise ConnectionError("Error, connection is closed")
+        future = asyncio.get_event_loop().create_future()
+        self.writer.write(encode_command(*args))
+        self.pending.append(future)
+        return future
+
+    # Wait while the socket buffer is full
+    async def drain(self):
+        await self.writer.drain()
+
+    async def read_replies(self):
+        buffer = bytearray()
+        try:
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                buffer += data
+                offset = 0
+                while True:
+                    parsed = parse_reply(buffer, offset)
+                    if parsed == None:
+                        break
+                    reply, offset = parsed
+                    future = self.pending.popleft()
+                    if not future.done():
+                        future.set_result(reply)
+                del buffer[:offset]
+        except Exception as error:
+            self.fail(error)
+        finally:
+            self.fail(ConnectionError("Error, connection closed by server"))
+
+    # Fail every request still waiting for a reply
+    def fail(self, error: Exception):
+        self.closed = True
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def close(self):
+        self.closed = True
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        await self.reader_task
+
+
+class AsyncClient(object):
+    def __init__(self, host: str = '127.0.0.1', port: int = 6380, pool_size: int = 4):
+        if pool_size < 1:
+            raise ValueError("Error, pool_size must be at least 1")
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.connections = []
+        self.connect_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Least busy open connection, a new one while all are busy and the pool is
+    # not full
+    async def connection(self):
+        if any(conn.closed for conn in self.connections):
+            self.connections = [conn for conn in self.connections if not conn.closed]
+        if self.connections:
+            least_busy = min(self.connections, key=lambda conn: len(conn.pending))
+            if not least_busy.pending or len(self.connections) >= self.pool_size:
+                return least_busy
+        async with self.connect_lock:
+            # Another request may have filled the pool while waiting for the lock
+            if len(self.connections) >= self.pool_size:
+                return min(self.connections, key=lambda conn: len(conn.pending))
+            connection = await Connection.open(self.host, self.port)
+            self.connections.append(connection)
+            return connection
+
+    async def execute(self, *args):
+        connection = await self.connection()
+        future = connection.send(args)
+        await connection.drain()
+        reply = await future
+        if isinstance(reply, ReplyError):
+            raise reply_exception(reply)
+        return reply
+
+    '''
+    Send every command of commands [(name, arg, ...)] on one connection at once,
+    return their replies in order. A failed command's exception is returned in
+    its place instead of raised.
+    '''
+
+    async def pipeline(self, commands):
+        commands = list(commands)
+        # Nothing is sent unless every command can be
+        if not all(map(check_args, commands)):
+            raise TypeError
+        connection = await self.connection()
+        futures = [connection.send(command) for command in commands]
+        await connection.drain()
+        replies = []
+        for future in futures:
+            reply = await future
+            replies.append(reply_exception(reply) if isinstance(reply, ReplyError)
+                           else reply)
+        return replies
+
+    async def get(self, key: str, transactionId: str = None):
+        if transactionId == None:
+            return await self.execute('GET', key)
+        return await self.execute('GET', key, transactionId)
+
+    async def put(self, key: str, value, transactionId: str = None):
+        if transactionId == None:
+            await self.execute('PUT', key, value)
+        else:
+            await self.execute('PUT', key, value, transactionId)
+
+    async def delete(self, key: str, transactionId: str = None):
+        if transactionId == None:
+            await self.execute('DELETE', key)
+        else:
+            await self.execute('DELETE', key, transactionId)
+
+    async def incr(self, key: str, amount: int = 1, transactionId: str = None):
+        args = ('INCR', key, str(amount)) + (() if transactionId == None else (transactionId,))
+        return await self.execute(*args)
+
+    async def decr(self, key: str, amount: int = 1, transactionId: str = None):
+        args = ('DECR', key, str(amount)) + (() if transactionId == None else (transactionId,))
+        return await self.execute(*args)
+
+    async def append(self, key: str, value, transactionId: str = None):
+        args = ('APPEND', key, value) + (() if transactionId == None else (transactionId,))
+        return await self.execute(*args)
+
+    async def cas(self, key: str, expected, value, transactionId: str = None):
+        args = ('CAS', key, expected, value) + (() if transactionId == None else (transactionId,))
+        return bool(await self.execute(*args))
+
+    async def getset(self, key: str, value, transactionId: str = None):
+        args = ('GETSET', key, value) + (() if transactionId == None else (transactionId,))
+        return await self.execute(*args)
+
+    async def setnx(self, key: str, value, transactionId: str = None):
+        args = ('SETNX', key, value) + (() if transactionId == None else (transactionId,))
+        return bool(await self.execute(*args))
+
+    async def createTransaction(self, transactionId: str):
+        await self.execute('BEGIN', transactionId)
+
+    async def commitTransaction(self, transactionId: str):
+        await self.execute('COMMIT', transactionId)
+
+    async def rollbackTransaction(self, transactionId: str):
+        await self.execute('ROLLBACK', transactionId)
+
+    async def ping(self):
+        await self.execute('PING')
+
+    async def close(self):
+        connections, self.connections = self.connections, []
+        for connection in connections:
+            await connection.close()
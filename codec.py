@@ -0,0 +1,93 @@
+import struct
+
+'''
+Typed values
+
+Values are str, bytes, int or float. A value is checked once, where it enters
+SimpleDB: the common types cost one set lookup (VALUE_TYPES), other ones go
+through check_value. Values are stored as given, bytes are never copied. A
+memoryview over bytes is stored as is too, any other buffer (bytearray,
+memoryview of a bytearray or mmap...) can still change under the caller's hands
+and is copied into bytes once.
+
+Wherever values leave memory (write-ahead log, snapshot, arena storage,
+replication) they are written as a type tag and bytes:
+    TYPE_STR    utf-8
+    TYPE_BYTES  the bytes themselves
+    TYPE_INT    two's complement, little endian, in as few bytes as fit
+    TYPE_FLOAT  float64
+A bytes-like value comes back as bytes.
+'''
+
+TYPE_STR = 0
+TYPE_BYTES = 1
+TYPE_INT = 2
+TYPE_FLOAT = 3
+
+# Types stored as given, bool is not an int value
+VALUE_TYPES = frozenset((str, bytes, int, float))
+BYTES_TYPES = frozenset((bytes, memoryview))
+
+FLOAT = struct.Struct('<d')
+
+
+# Value to store for value, raise TypeError when it is not a value
+def check_value(value):
+    value_type = type(value)
+    if value_type in VALUE_TYPES:
+        return value
+    if value_type == memoryview:
+        if type(value.obj) == bytes and value.c_contiguous and value.format == 'B':
+            return value
+        return value.tobytes()
+    if value_type == bytearray:
+        return bytes(value)
+    raise TypeError
+
+
+# Items {key: value} to store, the types of every value checked at C level
+def check_items(items):
+    if set(map(type, items.values())) <= VALUE_TYPES:
+        return items
+    return {key: check_value(value) for key, value in items.items()}
+
+
+def type_of(value):
+    value_type = type(value)
+    if value_type == str:
+        return TYPE_STR
+    if value_type in BYTES_TYPES:
+        return TYPE_BYTES
+    if value_type == int:
+        return TYPE_INT
+    if value_type == float:
+        return TYPE_FLOAT
+    raise TypeError
+
+
+# (type tag, bytes-like) of value
+def encode_value(value):
+    value_type = type(value)
+    if value_type == str:
+        return TYPE_STR, value.encode('utf-8')
+    if value_type in BYTES_TYPES:
+        return TYPE_BYTES, value
+    if value_type == int:
+        return TYPE_INT, value.to_bytes((value.bit_length() + 8) // 8, 'little', signed=True)
+    if value_type == float:
+        return TYPE_FLOAT, FLOAT.pack(value)
+    raise TypeError
+
+
+# Value of the type tag from data, any bytes-like (a memoryview slice of a
+# buffer is decoded without copying it first)
+def decode_value(tag: int, data):
+    if tag == TYPE_STR:
+        return str(data, 'utf-8')
+    if tag == TYPE_BYTES:
+        return bytes(data)
+    if tag == TYPE_INT:
+        return int.from_bytes(data, 'little', signed=True)
+    if tag == TYPE_FLOAT:
+        return FLOAT.unpack(data)[0]
+    raise ValueError("Error, unknown value type %d" % tag)
@@ -1,19 +1,298 @@
-import uuid
+import heapq
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from itertools import chain, islice
+from contextlib import nullcontext
 from typing import Dict
-from helper import checkStr
+from helper import checkStr, checkAllStr
+from codec import BYTES_TYPES, VALUE_TYPES, check_items, check_value
+from striped_lock import StripedLock
+from wal import WriteAheadLog, replay
+from snapshot import write_snapshot, load_snapshot
+from expiry import ExpiryIndex
+from eviction import MemoryLimit
+from ordered_index import OrderedKeyIndex, decode_cursor, encode_cursor, prefix_end
+from value_index import ValueIndex
+from storage import close_storage, forkable, make_storage, version_map
+from metrics import Metrics
+from lock_manager import LockManager
+from changefeed import ChangeFeed
+
+# Marker left in a transaction write set for a key deleted within the transaction
+TOMBSTONE = object()
+
+# Due transactions reap_transactions look at on every createTransaction
+REAP_WORK = 4
+
+# Versions kept in db_history before it is first pruned, see prune_history
+HISTORY_PRUNE_MIN = 1024
+
+CONCURRENCY_MODES = ('optimistic', 'pessimistic')
+INCR = 'incr'
+APPEND = 'append'
+
+
+class Merge(object):
+    '''
+    Commutative write left in a transaction write set by incr or append. It is
+    applied at commit to the value committed then, so transactions merging into
+    the same key do not conflict.
+    '''
+
+    __slots__ = ('kind', 'operand')
+
+    def __init__(self, kind: str, operand):
+        self.kind = kind
+        self.operand = operand
+
+    # One merge doing both, None when they are of different kinds or append
+    # text and bytes
+    def combine(self, other):
+        if other.kind != self.kind:
+            return None
+        if self.kind == APPEND:
+            if (type(self.operand) == str) != (type(other.operand) == str):
+                return None
+            if type(self.operand) != str:
+                return Merge(APPEND, b''.join((self.operand, other.operand)))
+        return Merge(self.kind, self.operand + other.operand)
+
+    # Value after the merge, of value or of a missing key (None or TOMBSTONE).
+    # An int or float value stay one, a str holding an integer stay a str.
+    def apply(self, value):
+        missing = value is None or value is TOMBSTONE
+        if self.kind == APPEND:
+            if missing:
+                return self.operand
+            if (type(value) == str) != (type(self.operand) == str):
+                raise Exception("Error, can not append text and bytes")
+            return value + self.operand if type(value) == str else \
+                b''.join((value, self.operand))
+        if missing:
+            return str(self.operand)
+        if type(value) in (int, float):
+            return value + self.operand
+        try:
+            return str(int(value) + self.operand)
+        except (TypeError, ValueError):
+            raise Exception("Error, value is not an integer")
 
 
 class SimpleDB(object):
-    def __init__(self, preset_data: Dict[str, str] = None):
+    def __init__(self, preset_data: Dict[str, str] = None, thread_safe: bool = False,
+                 lock_stripes: int = 64, wal_path: str = None, durability: str = 'always',
+                 wal_interval_ms: int = 10, snapshot_path: str = None,
+                 maxmemory: int = None, eviction_policy: str = 'lru',
+                 ordered_index: bool = False, storage='dict', metrics: bool = False,
+                 transaction_timeout: float = None, max_transactions: int = None,
+                 concurrency: str = 'optimistic', changefeed: int = None):
+        # Thread safe mode: writes lock the stripes of the keys they touch, commit
+        # validate and apply while holding them. Reads without transaction take
+        # no lock, a key always hold a fully committed value.
+        if thread_safe:
+            self.key_locks = StripedLock(lock_stripes)
+            self.seq_lock = threading.Lock()
+            self.transaction_lock = threading.Lock()
+        else:
+            self.key_locks = None
+            self.seq_lock = nullcontext()
+            self.transaction_lock = nullcontext()
         self.transaction = {}
+        # Transactions not finished transaction_timeout seconds (or the timeout given
+        # to createTransaction) after they began are rolled back, see
+        # reap_transactions. At most max_transactions are open at once.
+        if transaction_timeout != None:
+            self.check_ttl(transaction_timeout)
+        if max_transactions != None and max_transactions < 1:
+            raise ValueError("Error, max_transactions must be at least 1")
+        self.transaction_timeout = transaction_timeout
+        self.max_transactions = max_transactions
+        self.transaction_deadlines = ExpiryIndex()
+        self.reaped_transactions = 0
+        self.rejected_transactions = 0
+        # Pessimistic transactions lock the keys they touch instead of failing on
+        # commit, see lock_manager.py. Waiting for a lock need other threads.
+        if concurrency not in CONCURRENCY_MODES:
+            raise ValueError("Error, concurrency must be one of %s" % ', '.join(CONCURRENCY_MODES))
+        self.pessimistic = concurrency == 'pessimistic'
+        self.lock_manager = LockManager(wait=thread_safe)
+        # Global commit sequence number, every commit takes the next number and
+        # stamps it on the keys it writes. db_transaction_id hold the sequence
+        # number of the last commit that touched each key.
+        self.commit_seq = 0
         self.db_transaction_id = {}
-        # In memory JSON Object
+        # Older versions of keys as {key: [(commit_seq, value), ...]}, oldest first,
+        # kept only while transactions are open so they can read their snapshot.
+        # TOMBSTONE as value means the key did not exist from that commit_seq.
+        # Versions no open snapshot can read are pruned once their number doubled.
+        self.db_history = {}
+        self.history_versions = 0
+        self.history_prune_at = HISTORY_PRUNE_MIN
+        # Keys held by prepared transactions as {key: transactionId}, see
+        # prepareTransaction
+        self.prepared = {}
+        # Deadline of keys put with a TTL, in unix time from self.clock
+        self.expiry = ExpiryIndex()
+        self.clock = time.time
+        # Replicas leave expiry to their primary and apply its deletes, expiring
+        # locally would commit under sequence numbers the primary also uses
+        self.expire_locally = True
+        # In memory JSON Object. storage='arena' keep values packed in one
+        # bytearray instead, storage='tiered' spill cold keys to disk, see
+        # storage.py
         if preset_data != None:
-            self.db = preset_data
-            for key in preset_data:
-                self.db_transaction_id[key] = uuid.uuid4()
+            self.db = make_storage(storage, preset_data)
+            self.db_transaction_id = version_map(self.db, self.next_commit_seq())
         else:
-            self.db = {}
+            self.db = make_storage(storage)
+            self.db_transaction_id = version_map(self.db)
+
+        # Start from the snapshot at snapshot_path when there is one, the log then
+        # only need to replay commits made after it
+        self.snapshot_path = snapshot_path
+        snapshot_seq = 0
+        if snapshot_path != None and os.path.exists(snapshot_path):
+            if preset_data != None:
+                raise Exception("Error, preset_data can not be used with a snapshot")
+            snapshot_seq, data, expires = load_snapshot(snapshot_path)
+            self.db = make_storage(storage, data)
+            self.commit_seq = snapshot_seq
+            self.db_transaction_id = version_map(self.db, snapshot_seq)
+            for key, deadline in expires.items():
+                self.expiry.set(key, deadline)
+
+        # Durable mode: every commit is appended to the write-ahead log at wal_path
+        # before it is applied, and the log is replayed here on startup.
+        # Note: preset_data is not written to the log.
+        self.wal = None
+        if wal_path != None:
+            self.replay_wal(wal_path, snapshot_seq)
+            self.wal = WriteAheadLog(wal_path, durability, wal_interval_ms)
+
+        # Memory bounded mode: estimated usage is kept up to date on every write,
+        # once it pass maxmemory (bytes) keys are evicted by eviction_policy
+        self.memory_limit = None
+        if maxmemory != None:
+            self.memory_limit = MemoryLimit(maxmemory, eviction_policy, self.expiry)
+            self.memory_limit.load(self.db)
+
+        # Ordered mode: keys are also kept sorted so scan and prefix can walk a
+        # range without looking at every key
+        self.key_index = None
+        # Keys of db_history kept sorted too, so scan_page within a transaction
+        # finds the keys deleted since its snapshot in the range of a page
+        self.history_index = None
+        if ordered_index:
+            self.key_index = OrderedKeyIndex(self.db)
+            self.history_index = OrderedKeyIndex()
+
+        # Secondary indexes on values {name: ValueIndex}, see create_index
+        self.value_indexes = {}
+
+        # Change data capture: every commit from here on is published to a ring
+        # buffer of the last changefeed commits, see changes and watch
+        self.changefeed = None
+        if changefeed != None:
+            self.changefeed = ChangeFeed(changefeed, self.commit_seq + 1)
+
+        # Instrumentation, see enable_metrics. None when off.
+        self.metrics = None
+        if metrics:
+            self.enable_metrics()
+
+        self.refresh_plain_autocommit()
+
+    # Autocommit put can write straight into db when nothing else need to see
+    # the write, see autocommit_put
+    def refresh_plain_autocommit(self):
+        self.plain_autocommit = self.key_locks == None and self.wal == None and \
+            self.memory_limit == None and not self.value_indexes
+
+    # Re-apply every commit found in the write-ahead log at path, skip those
+    # already in the snapshot taken at snapshot_seq
+    def replay_wal(self, path: str, snapshot_seq: int = 0):
+        for commit_seq, puts, deletes, expires in replay(path):
+            if commit_seq <= snapshot_seq:
+                continue
+            for key in deletes:
+                self.db.pop(key, None)
+                self.db_transaction_id.pop(key, None)
+            self.db.update(puts)
+            self.db_transaction_id.update(dict.fromkeys(puts, commit_seq))
+            self.update_expiry(puts, deletes, expires)
+            self.commit_seq = max(self.commit_seq, commit_seq)
+
+    # Flush and close the write-ahead log, stop the changefeed, release the storage
+    def close(self):
+        if self.wal != None:
+            self.wal.close()
+        if self.changefeed != None:
+            self.changefeed.close()
+        close_storage(self.db)
+
+    '''
+    -int save_snapshot(String path)
+        *Write every committed key to a snapshot file at path (snapshot_path when
+        not given) and return the commit sequence number it was taken at
+        *Throws an exception or returns an error on failure
+    -int bgsave(String path)
+        *Same as save_snapshot but written by a forked child process from its copy
+        of db, so commits carry on meanwhile. Return the child pid to pass to
+        wait_snapshot, None when fork is not available (or the storage can not be
+        forked, storage='tiered') and it was saved inline
+    -void checkpoint(String path)
+        *save_snapshot then drop the write-ahead log records it cover, which bound
+        the time needed to recover on startup
+    '''
+
+    def save_snapshot(self, path: str = None):
+        path = self.get_snapshot_path(path)
+        with self.lock_all():
+            write_snapshot(path, self.db, self.commit_seq, self.expiry.deadlines)
+            return self.commit_seq
+
+    def bgsave(self, path: str = None):
+        path = self.get_snapshot_path(path)
+        if not hasattr(os, 'fork') or not forkable(self.db):
+            self.save_snapshot(path)
+            return None
+        # Fork while holding every key so the child copy is at one commit
+        with self.lock_all():
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    write_snapshot(path, self.db, self.commit_seq,
+                                   self.expiry.deadlines)
+                except BaseException:
+                    status = 1
+                finally:
+                    os._exit(status)
+        return pid
+
+    # Wait for a bgsave child to finish
+    def wait_snapshot(self, pid: int):
+        if pid == None:
+            return
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            raise Exception("Error, background snapshot failed")
+
+    def checkpoint(self, path: str = None):
+        path = self.get_snapshot_path(path)
+        snapshot_seq = self.save_snapshot(path)
+        if self.wal != None:
+            self.wal.truncate_until(snapshot_seq)
+        return snapshot_seq
+
+    def get_snapshot_path(self, path: str = None):
+        if path == None:
+            path = self.snapshot_path
+        if path == None:
+            raise Exception("Error, no snapshot path")
+        return path
 
     # Assist in testing
     def getDB(self):
@@ -25,16 +304,32 @@ class SimpleDB(object):
 
     # Assist in testing
     def insert_transaction(self, transaction):
-        self.transaction.update(transaction)
+        with self.transaction_lock:
+            self.transaction.update(transaction)
         return self.getTransaction()
 
-    # Check if commit immediately is needed
-    def check_commit_immediately(self, transactionId):
-        if transactionId == None:
-            transactionId = str(uuid.uuid4())
-            self.createTransaction(transactionId)
-            return True, transactionId
-        return False, transactionId
+    # Take the next commit sequence number
+    def next_commit_seq(self):
+        with self.seq_lock:
+            self.commit_seq += 1
+            return self.commit_seq
+
+    # Hold the lock of keys in thread safe mode
+    def lock_keys(self, keys):
+        if self.key_locks == None:
+            return nullcontext()
+        return self.key_locks.hold(keys)
+
+    def lock_key(self, key: str):
+        if self.key_locks == None:
+            return nullcontext()
+        return self.key_locks.for_key(key)
+
+    # Hold every key, no commit can run meanwhile
+    def lock_all(self):
+        if self.key_locks == None:
+            return nullcontext()
+        return self.key_locks.hold_all()
 
     '''
     -void put(String key, String value)
@@ -44,37 +339,136 @@ class SimpleDB(object):
         *Set the variable “key” to the provided “value” within the transaction with ID
         “transactionId”
         *Throws an exception or returns an error on failure
-    '''
 
-    def put(self, key: str, value: str, transactionId: str = None):
+    NOTE: With ttl (seconds) the key expire ttl seconds after it is committed. Put
+    without ttl clear any TTL the key had.
 
-        commit_immediately, transactionId = self.check_commit_immediately(
-            transactionId)
+    NOTE: Values are str, bytes, int or float (codec.py) and are stored as given.
+    A memoryview over bytes is kept without a copy, other buffers are copied.
+    '''
 
-        if not checkStr(key, value, transactionId):
+    def put(self, key: str, value: str, transactionId: str = None, ttl: float = None):
+        if ttl != None:
+            self.check_ttl(ttl)
+        if type(value) not in VALUE_TYPES:
+            value = check_value(value)
+        # Autocommit write, skip creating a transaction for a single key
+        if transactionId == None:
+            if type(key) != str:
+                raise TypeError
+            self.autocommit_put(key, value, ttl)
+            return
+
+        if not checkStr(key, transactionId):
             raise TypeError
         if transactionId not in self.transaction:
             raise Exception("Error, transactionId not in db")
 
         try:
-            # Set operation within specific transaction
-            self.transaction[transactionId]['value'] = {key: value}
-
-            # Get Exisiting uuid on key that is related to transaction
-            # to ensure it is not modify between transaction and commit
-            # Note: python string are immutable
-            if key in self.db:
-                self.transaction[transactionId]['transaction_uuid'] = {
-                    key: self.db_transaction_id[key]}
-            else:
-                self.transaction[transactionId]['transaction_uuid'] = {
-                    key: None}
-
+            self.track_version(transactionId, key)
+            # Add operation to the write set of specific transaction
+            self.transaction[transactionId]['value'][key] = value
+            self.track_ttl(transactionId, (key,), ttl)
         except Exception as error:
             raise error
 
-        if commit_immediately:
-            self.commitTransaction(transactionId)
+    def check_ttl(self, ttl: float):
+        if type(ttl) not in (int, float):
+            raise TypeError
+        if not ttl > 0:
+            raise Exception("Error, ttl must be positive")
+
+    # Remember the TTL of keys put within a transaction, turned into a deadline
+    # on commit. Only created once a transaction use a TTL.
+    def track_ttl(self, transactionId: str, keys, ttl: float = None):
+        current_transaction = self.transaction[transactionId]
+        if ttl != None:
+            current_transaction.setdefault('ttl', {}).update(dict.fromkeys(keys, ttl))
+        elif 'ttl' in current_transaction:
+            for key in keys:
+                current_transaction['ttl'].pop(key, None)
+
+    # Get Exisiting commit sequence number on key that is related to transaction
+    # to ensure it is not modify between transaction and commit. Only the first
+    # time a key is touched is recorded, the version seen by the transaction
+    # snapshot, None if the key did not exist in it.
+    # Note: python string are immutable
+    def track_version(self, transactionId: str, key: str):
+        transaction_keys = self.transaction[transactionId]['transaction_uuid']
+        if key not in transaction_keys:
+            self.first_touch(transactionId, key)
+            with self.lock_key(key):
+                transaction_keys[key] = self.read_snapshot(
+                    key, self.get_snapshot(transactionId))[1]
+
+    # Autocommit write engine
+    # A put without transactionId only ever touches one key, so there is nothing
+    # to validate. Write the value and stamp the key with a new commit sequence
+    # number directly, open transactions holding the old one will still fail on commit.
+    # When transactions are open, go through apply_writes so the old value is kept
+    # for their snapshot.
+    def autocommit_put(self, key: str, value: str, ttl: float = None):
+        if self.plain_autocommit and ttl == None and not self.transaction and \
+                not self.expiry.deadlines:
+            if self.key_index != None and key not in self.db:
+                self.key_index.add(key)
+            self.db[key] = value
+            commit_seq = self.next_commit_seq()
+            self.db_transaction_id[key] = commit_seq
+            if self.changefeed != None:
+                self.changefeed.publish(commit_seq, {key: value})
+            return
+        self.check_memory()
+        expires = None if ttl == None else {key: self.clock() + ttl}
+        with self.lock_key(key):
+            self.apply_writes({key: value}, (), expires)
+        self.evict_if_needed()
+
+    # Commit sequence number the transaction read from, transactions inserted
+    # without one read the latest commit
+    def get_snapshot(self, transactionId: str):
+        snapshot = self.transaction[transactionId].get('snapshot')
+        return self.commit_seq if snapshot == None else snapshot
+
+    # Return (value, commit_seq) of key as of commit sequence number snapshot,
+    # (TOMBSTONE, None) if the key did not exist then
+    def read_snapshot(self, key: str, snapshot: int):
+        version = self.db_transaction_id.get(key)
+        if version != None and version <= snapshot:
+            return self.db[key], version
+        for commit_seq, value in reversed(self.db_history.get(key, ())):
+            if commit_seq <= snapshot:
+                if value is TOMBSTONE:
+                    break
+                return value, commit_seq
+        return TOMBSTONE, None
+
+    # Read key within a transaction: its own write first, then its snapshot
+    # of db. The version read is tracked so commit fail if it changed.
+    def read_transaction(self, transactionId: str, key: str):
+        write_set = self.transaction[transactionId]['value']
+        if key in write_set:
+            value = write_set[key]
+            if type(value) != Merge:
+                return value
+            # Reading a merged key make the transaction depend on its value
+            return value.apply(self.read_tracked(transactionId, key))
+        return self.read_tracked(transactionId, key)
+
+    # Read key from the transaction snapshot of db, ignoring its write set
+    def read_tracked(self, transactionId: str, key: str):
+        current_transaction = self.transaction[transactionId]
+        if key not in current_transaction['transaction_uuid']:
+            self.first_touch(transactionId, key)
+        with self.lock_key(key):
+            value, version = self.read_snapshot(
+                key, self.get_snapshot(transactionId))
+        if self.memory_limit != None:
+            self.memory_limit.on_access(key)
+        transaction_keys = current_transaction['transaction_uuid']
+        if key not in transaction_keys:
+            transaction_keys[key] = version
+        return value
 
     '''
     -String get(String key)
@@ -84,27 +478,24 @@ class SimpleDB(object):
         *Returns the value associated with “key” within the transaction with ID
         “transactionId”
         *Throws an exception or returns an error on failure
+
+    NOTE: Within a transaction, get see the transaction's own put and delete first.
+    Other keys are read from db as it was when the transaction was created, commits
+    made after that are not visible (snapshot isolation). This does not copy db,
+    older values are kept in db_history while transactions are open.
     '''
 
     def get(self, key: str, transactionId: str = None):
-        # commit_immediately, transactionId = self.check_commit_immediately(
-        #     transactionId)
-        # if not checkStr(key, transactionId):
-        #     raise TypeError
-        # if transactionId not in self.transaction:
-        #     raise Exception("Error, transactionId not in db")
-
-        # if commit_immediately:
         if transactionId == None:
             try:
-                # Same uuid to ensure data is not modify if concurency are something we concider to implement
-                # with this DB
-                # self.transaction[transactionId]['value'][key] = self.db[key]
-                # self.transaction[transactionId]['transaction_uuid'][key] = self.db_transaction_id[key]
-                # self.commitTransaction(transactionId)
                 if not checkStr(key):
                     raise TypeError
-                return self.db[key]
+                if self.expiry.deadlines and self.expire_if_due(key):
+                    raise KeyError(key)
+                value = self.db[key]
+                if self.memory_limit != None:
+                    self.memory_limit.on_access(key)
+                return value
             except Exception as error:
                 raise error
         else:
@@ -113,9 +504,29 @@ class SimpleDB(object):
             if transactionId not in self.transaction:
                 raise Exception("Error, transactionId not in db")
             try:
-                return self.transaction[transactionId]['value'][key]
+                value = self.read_transaction(transactionId, key)
             except Exception as error:
                 raise error
+            if value is TOMBSTONE:
+                raise KeyError(key)
+            return value
+
+    '''
+    -memoryview get_view(String key, int start, int end)
+    -memoryview get_view(String key, int start, int end, String transactionId)
+        *Returns a memoryview of bytes "start" to "end" (None: the end) of the bytes
+        value of "key", as get would read it. The stored buffer is not copied.
+        *Throws an exception or returns an error on failure
+
+    NOTE: With SimpleDB(storage='arena') values live packed in the arena, the
+    view is then over a copy read out of it.
+    '''
+
+    def get_view(self, key: str, start: int = 0, end: int = None, transactionId: str = None):
+        value = self.get(key, transactionId)
+        if type(value) not in BYTES_TYPES:
+            raise Exception("Error, value is not bytes")
+        return memoryview(value)[start:end]
 
     '''
     -void delete(String key)
@@ -128,63 +539,641 @@ class SimpleDB(object):
     '''
 
     def delete(self, key: str, transactionId: str = None):
-        # commit_immediately, transactionId = self.check_commit_immediately(
-        #     transactionId)
-        # if not checkStr(key, transactionId):
-        #     raise TypeError
-        # if transactionId not in self.transaction:
-        #     raise Exception("Error, transactionId not in db")
-
-        # if commit_immediately:
         if transactionId == None:
             if not checkStr(key):
                 raise TypeError
-            current_val = self.db[key]
-            current_transaction_uuid = self.db_transaction_id[key]
-            if not key in self.db:
-                raise Exception("Error, key not in db")
-            try:
-                # self.commitTransaction(transactionId)
-                del self.db[key]
-                del self.db_transaction_id[key]
-            except Exception as error:
-                # Revert change if somehow the operation fail
-                self.db[key] = current_val
-                self.db_transaction_id[key] = current_transaction_uuid
-                raise error
+            if self.expiry.deadlines:
+                self.expire_if_due(key)
+            with self.lock_key(key):
+                if not key in self.db:
+                    raise Exception("Error, key not in db")
+                self.apply_writes({}, (key,))
         else:
             if not checkStr(key, transactionId):
                 raise TypeError
             if transactionId not in self.transaction:
                 raise Exception("Error, transactionId not in db")
-            current_val = self.transaction[transactionId]['value'][key]
-            current_val_uuid = self.transaction[transactionId]['transaction_uuid'][key]
-            try:
-                del self.transaction[transactionId]['value'][key]
-                del self.transaction[transactionId]['transaction_uuid'][key]
-            except Exception as error:
-                # Revert change if somehow the operation fail
-                self.transaction[transactionId]['value'][key] = current_val
-                self.transaction[transactionId]['transaction_uuid'][key] = current_val_uuid
-                raise error
+            # Key must exist either in the transaction or in its snapshot
+            if self.read_transaction(transactionId, key) is TOMBSTONE:
+                raise Exception("Error, key not in db")
+            # Leave a tombstone so the key is removed from db on commit
+            self.transaction[transactionId]['value'][key] = TOMBSTONE
+            self.track_ttl(transactionId, (key,))
+
+    '''
+    -void put_many(Dict[String, String] items)
+        *Set every key in "items" to its value in one commit
+        *Throws an exception or returns an error on failure, nothing is written
+    -void put_many(Dict[String, String] items, String transactionId)
+        *Set every key in "items" to its value within the transaction with ID
+        “transactionId”
+        *Throws an exception or returns an error on failure
+    Same ttl as put, applied to every key
+    '''
+
+    def put_many(self, items, transactionId: str = None, ttl: float = None):
+        # Accept a mapping or an iterable of (key, value) pairs
+        write_set = dict(items)
+        if not checkAllStr(write_set):
+            raise TypeError
+        write_set = check_items(write_set)
+        if ttl != None:
+            self.check_ttl(ttl)
+
+        if transactionId == None:
+            expires = None
+            if ttl != None:
+                expires = dict.fromkeys(write_set, self.clock() + ttl)
+            self.check_memory()
+            with self.lock_keys(write_set):
+                self.apply_writes(write_set, (), expires)
+            self.evict_if_needed()
+            return
+
+        if not checkStr(transactionId):
+            raise TypeError
+        if transactionId not in self.transaction:
+            raise Exception("Error, transactionId not in db")
+        for key in write_set:
+            self.track_version(transactionId, key)
+        self.transaction[transactionId]['value'].update(write_set)
+        self.track_ttl(transactionId, write_set, ttl)
+
+    '''
+    -List[String] get_many(List[String] keys)
+        *Returns the values associated with "keys" in the same order, None for
+        a key that does not exist
+        *Throws an exception or returns an error on failure
+    -List[String] get_many(List[String] keys, String transactionId)
+        *Returns the values associated with "keys" within the transaction with ID
+        “transactionId”, None for a key that the transaction does not hold
+        *Throws an exception or returns an error on failure
+    '''
+
+    def get_many(self, keys, transactionId: str = None):
+        keys = list(keys)
+        if not checkAllStr(keys):
+            raise TypeError
+
+        if transactionId == None:
+            db_get = self.db.get
+            if self.expiry.deadlines:
+                values = [None if self.expire_if_due(key) else db_get(key) for key in keys]
+            else:
+                values = [db_get(key) for key in keys]
+            if self.memory_limit != None:
+                for key in keys:
+                    self.memory_limit.on_access(key)
+            return values
+
+        if not checkStr(transactionId):
+            raise TypeError
+        if transactionId not in self.transaction:
+            raise Exception("Error, transactionId not in db")
+        values = [self.read_transaction(transactionId, key) for key in keys]
+        return [None if value is TOMBSTONE else value for value in values]
+
+    '''
+    -void delete_many(List[String] keys)
+        *Remove the values associated with "keys" in one commit
+        *Throws an exception or returns an error on failure, nothing is removed
+    -void delete_many(List[String] keys, String transactionId)
+        *Remove the values associated with "keys" within the transaction with ID
+        “transactionId”
+        *Throws an exception or returns an error on failure
+    '''
+
+    def delete_many(self, keys, transactionId: str = None):
+        keys = list(keys)
+        if not checkAllStr(keys):
+            raise TypeError
+
+        if transactionId == None:
+            if self.expiry.deadlines:
+                for key in keys:
+                    self.expire_if_due(key)
+            with self.lock_keys(keys):
+                # Every key must exist before anything is removed
+                if not all(map(self.db.__contains__, keys)):
+                    raise Exception("Error, key not in db")
+                self.apply_writes({}, keys)
+            return
+
+        if not checkStr(transactionId):
+            raise TypeError
+        if transactionId not in self.transaction:
+            raise Exception("Error, transactionId not in db")
+        for key in keys:
+            if self.read_transaction(transactionId, key) is TOMBSTONE:
+                raise Exception("Error, key not in db")
+        self.transaction[transactionId]['value'].update(
+            dict.fromkeys(keys, TOMBSTONE))
+        self.track_ttl(transactionId, keys)
+
+    '''
+    -int incr(String key, int amount)
+        *Add amount (1 when not given) to the integer value of "key", a missing
+        key counting as 0, and return the new value. An int or float value is
+        incremented as such, a str is parsed and stored back as a str.
+        *Throws an exception or returns an error on failure
+    -int append(String key, String value)
+        *Add "value" (str, or bytes to a bytes value) at the end of the value of
+        "key", a missing key counting as empty, and return the new length
+        *Throws an exception or returns an error on failure
+    -void incr(String key, int amount, String transactionId)
+    -void append(String key, String value, String transactionId)
+        *Same within the transaction with ID “transactionId”. The key is not read:
+        the change is merged into the value committed when the transaction commits,
+        so it does not conflict with other commits of the key.
+
+    NOTE: A TTL the key has is kept. Reading the key within the transaction
+    after incr or append makes it a read like any other, which can conflict.
+    '''
+
+    def incr(self, key: str, amount: int = 1, transactionId: str = None):
+        if type(amount) != int:
+            raise TypeError
+        value = self.merge(key, Merge(INCR, amount), transactionId)
+        return value if type(value) != str else int(value)
+
+    def append(self, key: str, value: str, transactionId: str = None):
+        if type(value) != str:
+            value = check_value(value)
+            if type(value) not in BYTES_TYPES:
+                raise TypeError
+        value = self.merge(key, Merge(APPEND, value), transactionId)
+        return None if value is None else len(value)
+
+    def merge(self, key: str, merge: Merge, transactionId: str = None):
+        if not checkStr(key):
+            raise TypeError
+        if transactionId == None:
+            if self.expiry.deadlines:
+                self.expire_if_due(key)
+            self.check_memory()
+            with self.lock_key(key):
+                puts, expires = self.resolve_merges({key: merge})
+                self.apply_writes(puts, (), expires)
+            self.evict_if_needed()
+            return puts[key]
+
+        if not checkStr(transactionId):
+            raise TypeError
+        if transactionId not in self.transaction:
+            raise Exception("Error, transactionId not in db")
+        current_transaction = self.transaction[transactionId]
+        write_set = current_transaction['value']
+        if key not in write_set:
+            if key not in current_transaction['transaction_uuid']:
+                self.check_not_prepared(transactionId)
+            write_set[key] = merge
+            current_transaction['merges'] = True
+            return None
+        current = write_set[key]
+        if type(current) != Merge:
+            write_set[key] = merge.apply(current)
+            return None
+        combined = current.combine(merge)
+        if combined == None:
+            # Merges of different kinds do not commute, apply them to the value read
+            combined = merge.apply(current.apply(self.read_tracked(transactionId, key)))
+        write_set[key] = combined
+        return None
+
+    # Apply the merges among puts to the committed value of their key, keeping
+    # its deadline. Return the puts and expires for apply_writes. Called with the
+    # keys locked.
+    def resolve_merges(self, puts, expires=None):
+        resolved = {}
+        now = self.clock() if self.expiry.deadlines else None
+        for key, value in puts.items():
+            if type(value) == Merge:
+                committed = self.db.get(key)
+                deadline = None if now == None else self.expiry.get(key)
+                if deadline != None and deadline <= now:
+                    committed = deadline = None
+                value = value.apply(committed)
+                if deadline != None:
+                    if expires == None:
+                        expires = {}
+                    expires.setdefault(key, deadline)
+            resolved[key] = value
+        return resolved, expires
+
+    '''
+    -int decr(String key, int amount)
+        *Same as incr(key, -amount)
+    -bool cas(String key, Value expected, Value value)
+        *Set "key" to "value" only if its value is "expected" (None: only if it
+        does not exist), return whether it was set
+    -Value getset(String key, Value value)
+        *Set "key" to "value", return its previous value or None
+    -bool setnx(String key, Value value)
+        *Set "key" to "value" only if it does not exist, return whether it was set
+        *Throws an exception or returns an error on failure
+    -decr, cas, getset and setnx(..., String transactionId)
+        *Same within the transaction with ID “transactionId”, against the value
+        the transaction sees. The key is read, a commit of it made meanwhile makes
+        the transaction fail on commit.
+
+    NOTE: Without transactionId each one is one step with the key locked: the new
+    value is committed with a new version in db_transaction_id, so open
+    transactions that read the key fail on commit as after a put. Same ttl as
+    put.
+    '''
+
+    def decr(self, key: str, amount: int = 1, transactionId: str = None):
+        if type(amount) != int:
+            raise TypeError
+        return self.incr(key, -amount, transactionId)
+
+    def cas(self, key: str, expected, value, transactionId: str = None, ttl: float = None):
+        if type(value) not in VALUE_TYPES:
+            value = check_value(value)
+
+        def swap(current):
+            if (current is None) if expected is None else (current == expected):
+                return value, True
+            return None, False
+
+        return self.read_modify_write(key, swap, transactionId, ttl)
+
+    def getset(self, key: str, value, transactionId: str = None, ttl: float = None):
+        if type(value) not in VALUE_TYPES:
+            value = check_value(value)
+        return self.read_modify_write(key, lambda current: (value, current), transactionId, ttl)
+
+    def setnx(self, key: str, value, transactionId: str = None, ttl: float = None):
+        if type(value) not in VALUE_TYPES:
+            value = check_value(value)
+        return self.read_modify_write(
+            key, lambda current: (value, True) if current is None else (None, False),
+            transactionId, ttl)
+
+    # Call update(current value of key, None when it does not exist) and put the
+    # value it returns with (value or None to leave the key, result), in one
+    # step: with the key locked, or as a tracked read then a put within
+    # transactionId. Return the result.
+    def read_modify_write(self, key: str, update, transactionId: str = None, ttl: float = None):
+        if not checkStr(key):
+            raise TypeError
+        if ttl != None:
+            self.check_ttl(ttl)
+        if transactionId == None:
+            if self.expiry.deadlines:
+                self.expire_if_due(key)
+            self.check_memory()
+            with self.lock_key(key):
+                value, result = update(self.read_live(key))
+                if value is not None:
+                    expires = None if ttl == None else {key: self.clock() + ttl}
+                    self.apply_writes({key: value}, (), expires)
+            self.evict_if_needed()
+            return result
+
+        if not checkStr(transactionId):
+            raise TypeError
+        if transactionId not in self.transaction:
+            raise Exception("Error, transactionId not in db")
+        current = self.read_transaction(transactionId, key)
+        value, result = update(None if current is TOMBSTONE else current)
+        if value is not None:
+            self.transaction[transactionId]['value'][key] = value
+            self.track_ttl(transactionId, (key,), ttl)
+        return result
+
+    # Committed value of key, None when it does not exist or its deadline has
+    # passed. Called with the key locked.
+    def read_live(self, key: str):
+        value = self.db.get(key)
+        if value is not None and self.expiry.deadlines:
+            deadline = self.expiry.get(key)
+            if deadline != None and deadline <= self.clock():
+                return None
+        return value
+
+    '''
+    -Iterator[(String, String)] scan(String start, String end, bool reverse, int limit,
+                                    int offset)
+        *Yields (key, value) of the committed keys from "start" (inclusive) to "end"
+        (exclusive) in key order, or from the last one when reverse is True. None
+        means unbounded. The first "offset" keys are skipped, at most "limit" are
+        yielded.
+        *Requires SimpleDB(ordered_index=True)
+        *Throws an exception or returns an error on failure
+    -Iterator[(String, String)] prefix(String prefix, bool reverse, int limit, int offset)
+        *Same as scan over the keys starting with "prefix"
+        *Throws an exception or returns an error on failure
+
+    NOTE: Keys are read lazily, one chunk of the index at a time. A key written
+    while iterating may or may not be yielded, a key deleted or expired before it
+    is reached is skipped.
+    '''
+
+    def scan(self, start: str = None, end: str = None, reverse: bool = False,
+             limit: int = None, offset: int = 0):
+        if self.key_index == None:
+            raise Exception("Error, ordered_index is not enabled")
+        if not checkAllStr(bound for bound in (start, end) if bound != None):
+            raise TypeError
+        if (limit != None and type(limit) != int) or type(offset) != int:
+            raise TypeError
+        if (limit != None and limit < 0) or offset < 0:
+            raise Exception("Error, limit and offset must not be negative")
+        return self.scan_items(self.key_index.irange(start, end, reverse), limit, offset)
+
+    def prefix(self, prefix: str, reverse: bool = False, limit: int = None,
+               offset: int = 0):
+        if not checkStr(prefix):
+            raise TypeError
+        return self.scan(prefix, prefix_end(prefix), reverse, limit, offset)
+
+    # Yield (key, value) of keys still in db, validation is done by the caller so
+    # errors raise on the call and not on the first next()
+    def scan_items(self, keys, limit: int, offset: int):
+        if limit == 0:
+            return
+        for key in keys:
+            if self.expiry.deadlines and self.expire_if_due(key):
+                continue
+            value = self.db.get(key)
+            if value == None:
+                continue
+            if offset:
+                offset -= 1
+                continue
+            if self.memory_limit != None:
+                self.memory_limit.on_access(key)
+            yield key, value
+            if limit != None:
+                limit -= 1
+                if limit == 0:
+                    return
+
+    '''
+    -(String, List[(String, String)]) scan_page(String cursor, int count, String start,
+                                               String end, String transactionId)
+        *Returns (next cursor, page) where page is up to "count" (key, value) in key
+        order from "start" (inclusive) to "end" (exclusive), None means unbounded.
+        Pass the cursor back to get the next page, without start and end which it
+        holds. The next cursor is None once every key was paged through.
+        *Within the transaction with ID "transactionId", pages are read from its
+        snapshot
+        *Requires SimpleDB(ordered_index=True)
+        *Throws an exception or returns an error on failure
+
+    NOTE: A cursor is an opaque string holding the last key it reached, nothing
+    is kept in the database between pages and a page reads one chunk of the index
+    at a time, so paging through any number of keys takes bounded memory. A page
+    resumes after the last key even if it was deleted meanwhile: every key present
+    from the first page to the last is returned exactly once, in order, one
+    written or deleted meanwhile may or may not be.
+    Within a transaction every page sees db as it was when the transaction was
+    created plus the transaction's own writes, keys deleted since are read from
+    db_history. Keys paged through are not tracked, they do not make the
+    transaction's commit fail. Open a transaction to page through a consistent
+    view, roll it back at the end.
+    '''
+
+    def scan_page(self, cursor: str = None, count: int = 100, start: str = None,
+                  end: str = None, transactionId: str = None):
+        if self.key_index == None:
+            raise Exception("Error, ordered_index is not enabled")
+        if type(count) != int or not checkAllStr(bound for bound in (cursor, start, end)
+                                                 if bound != None):
+            raise TypeError
+        if count < 1:
+            raise Exception("Error, count must be at least 1")
+        if transactionId != None:
+            if not checkStr(transactionId):
+                raise TypeError
+            if transactionId not in self.transaction:
+                raise Exception("Error, transactionId not in db")
+        inclusive = True
+        if cursor != None:
+            if start != None or end != None:
+                raise Exception("Error, start and end are held by the cursor")
+            start, end = decode_cursor(cursor)
+            inclusive = False
+        keys = self.key_index.irange(start, end, inclusive=inclusive)
+        if transactionId != None:
+            keys = self.snapshot_keys(transactionId, keys, start, end, inclusive)
+            write_set = self.transaction[transactionId]['value']
+            snapshot = self.get_snapshot(transactionId)
+        page = []
+        for key in keys:
+            if transactionId != None:
+                value = self.read_untracked(write_set, snapshot, key)
+                if value is TOMBSTONE:
+                    continue
+            else:
+                if self.expiry.deadlines and self.expire_if_due(key):
+                    continue
+                value = self.db.get(key)
+                if value == None:
+                    continue
+            if self.memory_limit != None:
+                self.memory_limit.on_access(key)
+            page.append((key, value))
+            if len(page) == count:
+                return encode_cursor(key, end), page
+        return None, page
+
+    # Keys of the index merged with the keys in range the transaction may see
+    # although they are not in the index: deleted since its snapshot (in
+    # db_history) or put by itself
+    def snapshot_keys(self, transactionId: str, keys, start: str, end: str, inclusive: bool):
+        history_keys = self.history_index.irange(start, end, inclusive=inclusive)
+        write_keys = self.write_set_keys(transactionId, start, end, inclusive)
+        last_key = None
+        for key in heapq.merge(keys, history_keys, write_keys):
+            if key != last_key:
+                last_key = key
+                yield key
+
+    # Keys of the transaction write set in range, in order. Keys are only ever
+    # added to a write set, its sorted keys are kept until it grows.
+    def write_set_keys(self, transactionId: str, start: str, end: str, inclusive: bool):
+        current_transaction = self.transaction[transactionId]
+        write_set = current_transaction['value']
+        sorted_keys = current_transaction.get('sorted_keys')
+        if sorted_keys == None or len(sorted_keys) != len(write_set):
+            sorted_keys = sorted(write_set)
+            current_transaction['sorted_keys'] = sorted_keys
+        low = 0
+        if start != None:
+            low = (bisect_left if inclusive else bisect_right)(sorted_keys, start)
+        high = len(sorted_keys) if end == None else bisect_left(sorted_keys, end)
+        return islice(sorted_keys, low, high)
+
+    # Read key within a transaction like read_transaction, from its write set
+    # then its snapshot, without tracking the version
+    def read_untracked(self, write_set, snapshot: int, key: str):
+        value = write_set.get(key)
+        if value != None and type(value) != Merge:
+            return value
+        with self.lock_key(key):
+            committed, _ = self.read_snapshot(key, snapshot)
+        if self.memory_limit != None:
+            self.memory_limit.on_access(key)
+        return committed if value == None else value.apply(committed)
+
+    '''
+    -void create_index(String name, String kind, Function extractor)
+        *Index the values of every key under "name", then keep the index up to date
+        on every commit. "kind" is 'exact' (equality) or 'prefix' (equality and
+        prefix), "extractor" map a value to what is indexed, None to skip the key.
+        *Throws an exception or returns an error on failure
+    -void drop_index(String name)
+        *Remove the index "name"
+        *Throws an exception or returns an error on failure
+    -Iterator[(String, String)] find(String name, String equals, String prefix,
+                                    String transactionId, int limit)
+        *Yields (key, value) of the keys whose indexed value equals "equals", or
+        starts with "prefix", at most "limit" of them. Within the transaction with
+        ID "transactionId" the transaction's own puts and deletes are taken into
+        account, its puts are yielded last.
+        *Throws an exception or returns an error on failure
+
+    NOTE: Indexes are updated by the commit that writes the keys, a rolled back
+    transaction never reach them. They are not saved to the log or snapshots and
+    must be created again after a restart. Within a transaction, keys are looked up
+    in the latest index then read from the transaction's snapshot, a key that only
+    matched before a later commit is not found.
+    '''
+
+    def create_index(self, name: str, kind: str = 'exact', extractor=None):
+        if not checkStr(name):
+            raise TypeError
+        if name in self.value_indexes:
+            raise Exception("Error, index already exists")
+        index = ValueIndex(kind, extractor)
+        with self.lock_all():
+            index.load(self.db)
+            self.value_indexes[name] = index
+            self.refresh_plain_autocommit()
+
+    def drop_index(self, name: str):
+        if not checkStr(name):
+            raise TypeError
+        if name not in self.value_indexes:
+            raise Exception("Error, index not in db")
+        with self.lock_all():
+            del self.value_indexes[name]
+            self.refresh_plain_autocommit()
+
+    def find(self, name: str, equals=None, prefix: str = None,
+             transactionId: str = None, limit: int = None):
+        if not checkStr(name):
+            raise TypeError
+        if name not in self.value_indexes:
+            raise Exception("Error, index not in db")
+        if (equals == None) == (prefix == None):
+            raise Exception("Error, find needs one of equals or prefix")
+        if limit != None and type(limit) != int:
+            raise TypeError
+        if transactionId != None:
+            if not checkStr(transactionId):
+                raise TypeError
+            if transactionId not in self.transaction:
+                raise Exception("Error, transactionId not in db")
+        index = self.value_indexes[name]
+        if prefix != None:
+            if not checkStr(prefix):
+                raise TypeError
+            keys = index.keys_prefix(prefix)
+        else:
+            if index.kind == 'prefix' and not checkStr(equals):
+                raise TypeError
+            keys = index.keys_equal(equals)
+        return islice(self.find_items(index, keys, equals, prefix, transactionId), limit)
+
+    # Yield (key, value) of keys that still match, see find
+    def find_items(self, index: ValueIndex, keys, equals, prefix: str,
+                   transactionId: str = None):
+        if transactionId == None:
+            for key in keys:
+                if self.expiry.deadlines and self.expire_if_due(key):
+                    continue
+                value = self.db.get(key)
+                if value != None and index.matches(value, equals, prefix):
+                    if self.memory_limit != None:
+                        self.memory_limit.on_access(key)
+                    yield key, value
+            return
+
+        write_set = self.transaction[transactionId]['value']
+        for key in keys:
+            if key in write_set:
+                continue
+            value = self.read_transaction(transactionId, key)
+            if value is not TOMBSTONE and index.matches(value, equals, prefix):
+                yield key, value
+        for key in list(write_set):
+            value = self.read_transaction(transactionId, key)
+            if value is not TOMBSTONE and index.matches(value, equals, prefix):
+                yield key, value
 
     '''
     -void createTransaction(String transactionId)
         *Starts a transaction with the specified ID. The ID must not be an active
         transaction ID.
         *Throws an exception or returns an error on failure
+    -void createTransaction(String transactionId, float timeout)
+        *Same, the transaction is rolled back when not finished timeout seconds
+        later instead of after transaction_timeout
+        *Throws an exception when max_transactions are already open
+    -void createTransaction(String transactionId, bool pessimistic)
+        *Same, pessimistic or optimistic whatever the concurrency of the database
+
+    NOTE: A pessimistic transaction lock every key it reads or writes on first
+    touch and reads the latest committed value of the keys it holds instead of a
+    snapshot. Another pessimistic transaction touching a held key waits or is
+    rolled back with an exception, see lock_manager.py. Its commit can then only
+    fail on a write made without transaction.
     '''
 
-    def createTransaction(self, transactionId: str):
+    def createTransaction(self, transactionId: str, timeout: float = None,
+                          pessimistic: bool = None):
         if not checkStr(transactionId):
             raise TypeError
-        if transactionId not in self.transaction:
-            self.transaction[transactionId] = {
-                'value': {},
-                'transaction_uuid': {}
-            }
+        if timeout == None:
+            timeout = self.transaction_timeout
         else:
-            raise Exception("Error, Transaction Key already exists")
+            self.check_ttl(timeout)
+        # Reap a few due transactions on every begin, so abandoned ones are
+        # rolled back without a background thread
+        if self.transaction_deadlines.deadlines:
+            self.reap_transactions(REAP_WORK)
+        if self.max_transactions != None and len(self.transaction) >= self.max_transactions:
+            self.reap_transactions(len(self.transaction))
+        if self.history_versions >= self.history_prune_at:
+            self.prune_history()
+        with self.transaction_lock:
+            if transactionId in self.transaction:
+                raise Exception("Error, Transaction Key already exists")
+            if self.max_transactions != None and len(self.transaction) >= self.max_transactions:
+                self.rejected_transactions += 1
+                raise Exception("Error, too many open transactions")
+            if pessimistic == None:
+                pessimistic = self.pessimistic
+            if pessimistic:
+                # Without snapshot the transaction reads the latest commit
+                self.transaction[transactionId] = {
+                    'value': {},
+                    'transaction_uuid': {},
+                    'pessimistic': True
+                }
+                self.lock_manager.begin(transactionId)
+            else:
+                self.transaction[transactionId] = {
+                    'value': {},
+                    'transaction_uuid': {},
+                    # Reads see every commit up to this sequence number
+                    'snapshot': self.commit_seq
+                }
+            if timeout != None:
+                self.transaction_deadlines.set(transactionId, self.clock() + timeout)
 
     '''
     -void rollbackTransaction(String transactionId)
@@ -197,10 +1186,30 @@ class SimpleDB(object):
         if not checkStr(transactionId):
             raise TypeError
         if transactionId in self.transaction:
-            del self.transaction[transactionId]
+            self.end_transaction(transactionId)
         else:
             raise Exception("Error, Transaction Key dp not exists")
 
+    # Remove transaction, older versions are dropped once no transaction is open
+    def end_transaction(self, transactionId: str, release_locks: bool = True):
+        with self.transaction_lock:
+            current_transaction = self.transaction.pop(transactionId)
+            if self.transaction_deadlines.deadlines:
+                self.transaction_deadlines.remove(transactionId)
+            if current_transaction.get('pessimistic') and release_locks:
+                self.lock_manager.release(transactionId)
+            if current_transaction.get('prepared'):
+                for key in chain(current_transaction['transaction_uuid'],
+                                 self.merge_keys(current_transaction)):
+                    if self.prepared.get(key) == transactionId:
+                        del self.prepared[key]
+            if not self.transaction:
+                self.db_history = {}
+                if self.history_index != None:
+                    self.history_index.load(())
+                self.history_versions = 0
+                self.history_prune_at = HISTORY_PRUNE_MIN
+
     '''
     -void commitTransaction(String transactionId)
         *Commits the transaction and invalidates the ID. If there is a conflict (meaning the
@@ -218,38 +1227,549 @@ class SimpleDB(object):
     modify self.db to get the same result but I think if we target to grow this db implementation
     in the long run, it will be easier if all operation follow the same kind of work flow, hence
     all those function are calling commitTransaction. Also I can use commitTransaction to modify
-    update the uuid which is use to keep track of if a data have been touch.
+    update the commit sequence number which is use to keep track of if a data have been touch.
     '''
 
     def commitTransaction(self, transactionId: str):
+        if self.transaction_deadlines.deadlines:
+            self.check_deadline(transactionId)
         current_transaction = self.transaction[transactionId]
-        update = True
         # Get keys at transaction to check if keys at db have been modify
-        # should return json of { key: uuid, key_1: uuid_1, etc}
+        # should return json of { key: commit_seq, key_1: commit_seq_1, etc}
+        transaction_keys = current_transaction['transaction_uuid']
+        # Merged keys are written without being read, hold them too
+        locked_keys = transaction_keys
+        if current_transaction.get('merges'):
+            locked_keys = chain(transaction_keys, current_transaction['value'])
+        # Validate and apply while holding every key, so no other commit can
+        # change them in between
+        with self.lock_keys(locked_keys):
+            if self.validate_transaction(transactionId):
+                try:
+                    # End the transaction first so its own writes are not kept as
+                    # history when no other transaction is open. Its pessimistic
+                    # locks are kept until the writes are applied, it is restored
+                    # with them if they fail.
+                    self.end_transaction(transactionId, release_locks=False)
+                    puts, deletes = self.split_write_set(current_transaction['value'])
+                    expires = None
+                    if current_transaction.get('ttl'):
+                        now = self.clock()
+                        expires = {key: now + ttl for key, ttl
+                                   in current_transaction['ttl'].items()}
+                    if current_transaction.get('merges'):
+                        puts, expires = self.resolve_merges(puts, expires)
+                    if puts:
+                        self.check_memory()
+                    self.apply_writes(puts, deletes, expires)
+                    if current_transaction.get('pessimistic'):
+                        self.lock_manager.release(transactionId)
+                except Exception as error:
+                    # restore transaction incase transaction fail
+                    self.transaction[transactionId] = current_transaction
+                    if current_transaction.get('prepared'):
+                        self.hold_prepared(transactionId)
+                    raise error
+            else:
+                if self.metrics != None:
+                    self.metrics.record_conflict(self.find_conflict(transactionId))
+                self.end_transaction(transactionId)
+                raise Exception('Transaction Commit Fail')
+        if self.metrics != None:
+            self.metrics.record_commit(transaction_keys)
+        if self.history_versions >= self.history_prune_at:
+            self.prune_history()
+        self.evict_if_needed()
+
+    # Whether no key the transaction touched has been committed since it read it,
+    # and none is held by another prepared transaction. Called with the keys locked.
+    def validate_transaction(self, transactionId: str):
+        return self.find_conflict(transactionId) == None
+
+    # First key failing validate_transaction, None when there is none
+    def find_conflict(self, transactionId: str):
         transaction_keys = self.transaction[transactionId]['transaction_uuid']
+        # Single pass over every key the transaction has touched. If key is not in
+        # db_transaction_id, get() give None, so we can also ensure that no delete
+        # operation have been done inbetween transaction
+        db_transaction_id = self.db_transaction_id
         for key in transaction_keys:
-            # If key is not in db_transaction_id, make sure is None.
-            # So we can ensure that no delete operation have been done inbetween transaction
-            if key not in self.db_transaction_id:
-                if transaction_keys[key] != None:
-                    update = False
-                    break
-            else:
-                # Check if key value have been read or modify between Transaction Create and Commit
-                if self.db_transaction_id[key] != transaction_keys[key]:
-                    update = False
-                    break
+            # Check if key value have been read or modify between Transaction Create and Commit
+            if db_transaction_id.get(key) != transaction_keys[key]:
+                return key
+        if self.prepared:
+            for key in transaction_keys:
+                if self.prepared.get(key, transactionId) != transactionId:
+                    return key
+        return None
+
+    '''
+    -void prepareTransaction(String transactionId)
+        *First phase of a two-phase commit. Validate the transaction like
+        commitTransaction, then hold every key it read or wrote: other commits of
+        those keys fail until the transaction is committed or rolled back, so its
+        commitTransaction can no longer fail on a conflict. Keys merged into (incr,
+        append) are held too, once their merge is checked to apply to the value
+        committed now.
+        *Throws an exception if the transaction conflicts, it is then rolled back
+    '''
+
+    def prepareTransaction(self, transactionId: str):
+        if not checkStr(transactionId):
+            raise TypeError
+        if transactionId not in self.transaction:
+            raise Exception("Error, transactionId not in db")
+        if self.transaction_deadlines.deadlines:
+            self.check_deadline(transactionId)
+        current_transaction = self.transaction[transactionId]
+        merge_keys = self.merge_keys(current_transaction)
+        with self.lock_keys(chain(current_transaction['transaction_uuid'], merge_keys)):
+            conflict = self.find_conflict(transactionId)
+            if conflict == None and merge_keys:
+                conflict = self.find_merge_conflict(transactionId, merge_keys)
+            if conflict != None:
+                if self.metrics != None:
+                    self.metrics.record_conflict(conflict)
+                self.end_transaction(transactionId)
+                raise Exception('Transaction Prepare Fail')
+            self.hold_prepared(transactionId)
+
+    '''
+    -int reap_transactions(int max_work)
+        *Roll back transactions past their deadline, looking at no more than
+        max_work of them, and return how many were rolled back. Prepared
+        transactions are left to their coordinator. Called by createTransaction,
+        call it periodically when transactions are rarely begun.
+    '''
+
+    def reap_transactions(self, max_work: int = REAP_WORK):
+        due = self.transaction_deadlines.pop_due(self.clock(), max_work)
+        reaped = 0
+        for transactionId in due:
+            current_transaction = self.transaction.get(transactionId)
+            if current_transaction == None:
+                continue
+            # Hold its keys so a commit of it is not half way through
+            with self.lock_keys(list(current_transaction['transaction_uuid'])):
+                if self.transaction.get(transactionId) is current_transaction and \
+                        not current_transaction.get('prepared'):
+                    self.end_transaction(transactionId)
+                    reaped += 1
+        self.reaped_transactions += reaped
+        return reaped
 
-        if update:
+    # A transaction past its deadline can not commit any more, roll it back
+    def check_deadline(self, transactionId: str):
+        deadline = self.transaction_deadlines.get(transactionId)
+        if deadline != None and deadline <= self.clock() and \
+                not self.transaction[transactionId].get('prepared'):
+            self.end_transaction(transactionId)
+            self.reaped_transactions += 1
+            raise Exception("Error, transaction timed out")
+
+    # First time a transaction touch key: a prepared one can not, a pessimistic
+    # one lock it and is rolled back when that fails
+    def first_touch(self, transactionId: str, key: str):
+        self.check_not_prepared(transactionId)
+        if self.transaction[transactionId].get('pessimistic'):
             try:
-                for key in transaction_keys:
-                    self.db[key] = self.transaction[transactionId]['value'][key]
-                    self.db_transaction_id[key] = uuid.uuid4()
-                del self.transaction[transactionId]
+                self.lock_manager.acquire(transactionId, key)
             except Exception as error:
-                # restore transaction incase transaction fail
-                self.transaction[transactionId] = current_transaction
+                if self.metrics != None:
+                    self.metrics.record_conflict(key)
+                self.end_transaction(transactionId)
                 raise error
-        else:
-            self.rollbackTransaction(transactionId)
-            raise Exception('Transaction Commit Fail')
+
+    # A prepared transaction only holds the keys it had, it can not touch new ones
+    def check_not_prepared(self, transactionId: str):
+        if self.transaction[transactionId].get('prepared'):
+            raise Exception("Error, transaction is prepared")
+
+    def hold_prepared(self, transactionId: str):
+        current_transaction = self.transaction[transactionId]
+        current_transaction['prepared'] = True
+        self.prepared.update(dict.fromkeys(current_transaction['transaction_uuid'],
+                                           transactionId))
+        self.prepared.update(dict.fromkeys(self.merge_keys(current_transaction),
+                                           transactionId))
+
+    # Keys the transaction merges into without having read them
+    def merge_keys(self, current_transaction):
+        if not current_transaction.get('merges'):
+            return []
+        return [key for key, value in current_transaction['value'].items()
+                if type(value) == Merge]
+
+    # First merged key held by another prepared transaction or whose merge can
+    # not apply to its committed value, None when there is none. Called with the
+    # keys locked.
+    def find_merge_conflict(self, transactionId: str, merge_keys):
+        write_set = self.transaction[transactionId]['value']
+        for key in merge_keys:
+            if self.prepared.get(key, transactionId) != transactionId:
+                return key
+            try:
+                self.resolve_merges({key: write_set[key]})
+            except Exception:
+                return key
+        return None
+
+    # Split a transaction write set of {key: value or TOMBSTONE} into the puts
+    # and deletes taken by apply_writes
+    def split_write_set(self, write_set):
+        deletes = [key for key, value in write_set.items() if value is TOMBSTONE]
+        if deletes:
+            write_set = {key: value for key, value in write_set.items()
+                         if value is not TOMBSTONE}
+        return write_set, deletes
+
+    # Apply puts of {key: value} and deletes of [key] to db under one commit
+    # sequence number
+    def apply_writes(self, puts, deletes=(), expires=None):
+        if self.prepared:
+            for key in chain(puts, deletes):
+                if key in self.prepared:
+                    raise Exception("Error, key is held by a prepared transaction")
+        # Extractors of value indexes may raise, run them before anything is applied
+        index_changes = [(index, index.changes(self.db, puts, deletes))
+                         for index in self.value_indexes.values()]
+        commit_seq = self.next_commit_seq()
+        logged = False
+        try:
+            # Log first, nothing is applied if the commit can not be made durable
+            if self.wal != None:
+                self.wal.append(commit_seq, puts, deletes, expires)
+                logged = True
+            self.update_expiry(puts, deletes, expires)
+            if self.memory_limit != None:
+                self.memory_limit.track(self.db, puts, deletes)
+            if self.key_index != None:
+                self.update_key_index(puts, deletes)
+            for index, changes in index_changes:
+                index.apply(changes)
+            if self.transaction:
+                for key in puts:
+                    self.save_history(key)
+                for key in deletes:
+                    self.save_history(key)
+                    self.history_of(key).append((commit_seq, TOMBSTONE))
+                    self.history_versions += 1
+            if deletes:
+                db_pop = self.db.pop
+                version_pop = self.db_transaction_id.pop
+                for key in deletes:
+                    db_pop(key, None)
+                    version_pop(key, None)
+            self.db.update(puts)
+            self.db_transaction_id.update(dict.fromkeys(puts, commit_seq))
+        except Exception as error:
+            # Failed once logged (storage, memory tracking...), cancel the record
+            # so a replay does not apply what the caller was told failed
+            if logged:
+                try:
+                    self.wal.abort(commit_seq)
+                except Exception:
+                    pass
+            # The changefeed wait for every sequence number, fill this one whatever
+            # failed
+            if self.changefeed != None:
+                self.changefeed.publish(commit_seq, {})
+            raise error
+        if self.changefeed != None:
+            self.changefeed.publish(commit_seq, puts, deletes, expires)
+        return commit_seq
+
+    # Apply a commit of a replication primary under its own commit sequence
+    # number, see replication.py
+    def replicate(self, commit_seq: int, puts, deletes=(), expires=None):
+        with self.lock_keys(chain(puts, deletes)):
+            with self.seq_lock:
+                self.commit_seq = commit_seq - 1
+            self.apply_writes(puts, deletes, expires)
+
+    # Add keys created by puts to the ordered index, remove deleted keys
+    def update_key_index(self, puts, deletes=()):
+        for key in deletes:
+            if key in self.db:
+                self.key_index.remove(key)
+        for key in puts:
+            if key not in self.db:
+                self.key_index.add(key)
+
+    # Keep the current version of key in db_history before it is overwritten. A
+    # key that did not exist needs none, a snapshot finding no version before its
+    # own reads it as missing.
+    def save_history(self, key: str):
+        if key in self.db:
+            self.history_of(key).append((self.db_transaction_id[key], self.db[key]))
+            self.history_versions += 1
+
+    # Versions of key in db_history, an empty list added the first time
+    def history_of(self, key: str):
+        history = self.db_history.get(key)
+        if history == None:
+            history = self.db_history[key] = []
+            if self.history_index != None:
+                self.history_index.add(key)
+        return history
+
+    def drop_history(self, key: str):
+        del self.db_history[key]
+        if self.history_index != None:
+            self.history_index.remove(key)
+
+    # Drop the versions no open transaction can read: of a key, every snapshot
+    # from the oldest one reads the last version committed at or before it or
+    # later ones. Called holding no key, every key is held meanwhile.
+    def prune_history(self):
+        with self.lock_all():
+            with self.transaction_lock:
+                snapshots = [self.get_snapshot(transactionId) for transactionId in self.transaction]
+            if not snapshots:
+                return
+            oldest = min(snapshots)
+            versions = 0
+            for key, history in list(self.db_history.items()):
+                version = self.db_transaction_id.get(key)
+                if version != None and version <= oldest:
+                    # Every snapshot reads the current version
+                    self.drop_history(key)
+                    continue
+                start = 0
+                for i, (commit_seq, _) in enumerate(history):
+                    if commit_seq > oldest:
+                        break
+                    start = i
+                # A snapshot finding no version reads the key as missing
+                while start < len(history) and history[start][1] is TOMBSTONE:
+                    start += 1
+                if start == len(history):
+                    self.drop_history(key)
+                    continue
+                del history[:start]
+                versions += len(history)
+            self.history_versions = versions
+            self.history_prune_at = max(HISTORY_PRUNE_MIN, 2 * versions)
+
+    # Set the deadline of puts in expires, clear the TTL of other puts and deletes
+    def update_expiry(self, puts, deletes=(), expires=None):
+        if not (self.expiry.deadlines or expires):
+            return
+        for key in deletes:
+            self.expiry.remove(key)
+        for key in puts:
+            deadline = expires.get(key) if expires else None
+            if deadline == None:
+                self.expiry.remove(key)
+            else:
+                self.expiry.set(key, deadline)
+
+    '''
+    -bool expire_if_due(String key)
+        *Delete key if its TTL has passed, the delete is a commit like any other,
+        so transactions holding the key fail to commit. Return True when the key
+        is due but left in db because expire_locally is off (replicas), readers
+        then hide it
+    -int expire_cycle(int max_work)
+        *Active expiry, meant to be called periodically (e.g. once per event loop
+        tick). Look at no more than max_work of the soonest deadlines, delete the
+        keys due in one commit and return how many were deleted
+    -float get_ttl(String key)
+        *Seconds left before key expire, None if it has no TTL
+        *Throws an exception or returns an error on failure
+
+    NOTE: Expired keys are hidden as soon as they are accessed without transaction.
+    A transaction read from its snapshot, so a key that expire after the
+    transaction was created stay visible to it, like any later delete.
+    '''
+
+    def expire_if_due(self, key: str):
+        deadline = self.expiry.get(key)
+        if deadline == None or deadline > self.clock():
+            return False
+        if not self.expire_locally:
+            return True
+        if key in self.prepared:
+            return False
+        with self.lock_key(key):
+            if self.expiry.get(key) == deadline and key in self.db:
+                self.apply_writes({}, (key,))
+        return False
+
+    def expire_cycle(self, max_work: int = 20):
+        if not self.expire_locally:
+            return 0
+        now = self.clock()
+        due = self.expiry.pop_due(now, max_work)
+        if not due:
+            return 0
+        with self.lock_keys(due):
+            # Deadline may have been reset while waiting for the locks
+            expired = [key for key in due if key in self.db and key not in self.prepared
+                       and self.expiry.get(key) != None and self.expiry.get(key) <= now]
+            # Keys held by prepared transactions were popped from the heap, put
+            # them back so they expire once released
+            for key in due:
+                if key in self.prepared and self.expiry.get(key) != None:
+                    self.expiry.set(key, self.expiry.get(key))
+            if expired:
+                self.apply_writes({}, expired)
+        return len(expired)
+
+    def get_ttl(self, key: str):
+        if not checkStr(key):
+            raise TypeError
+        if (self.expiry.deadlines and self.expire_if_due(key)) or key not in self.db:
+            raise Exception("Error, key not in db")
+        deadline = self.expiry.get(key)
+        if deadline == None:
+            return None
+        return max(deadline - self.clock(), 0.0)
+
+    '''
+    -void check_memory()
+        *With noeviction, throws an exception when a write would go over maxmemory
+    -void evict_if_needed()
+        *Evict keys picked by the eviction policy until memory is under maxmemory.
+        Each eviction is a delete commit, transactions holding the key fail.
+        Called after a write once its locks are released.
+    -Dict memory_stats()
+        *Estimated used memory, maxmemory, policy and eviction counters
+    '''
+
+    def check_memory(self):
+        memory_limit = self.memory_limit
+        if memory_limit != None and memory_limit.policy == None and \
+                memory_limit.over_limit():
+            memory_limit.rejected_writes += 1
+            raise Exception("Error, maxmemory reached")
+
+    def evict_if_needed(self):
+        memory_limit = self.memory_limit
+        if memory_limit == None:
+            return
+        while memory_limit.over_limit():
+            # Keys held by prepared transactions can not be evicted, the next
+            # candidate is taken instead
+            key = memory_limit.victim(self.prepared)
+            if key == None:
+                return
+            with self.lock_key(key):
+                if key in self.db:
+                    self.apply_writes({}, (key,))
+                    memory_limit.evicted_keys += 1
+                else:
+                    memory_limit.forget(key)
+
+    def memory_stats(self):
+        if self.memory_limit == None:
+            return {}
+        return self.memory_limit.stats()
+
+    '''
+    -Iterator[Change] changes(int since, bool wait, float timeout)
+        *Yields the commits made after commit sequence number "since" (from now
+        when not given) in order, as Change(commit_seq, puts, deletes). With wait
+        it then waits for new ones, until timeout seconds pass without any.
+        *Throws an exception when commits after "since" are no longer kept
+    -AsyncIterator[Change] changes_async(int since)
+        *Same as changes with wait, for asyncio
+    -int watch(Callable callback, String key, String prefix)
+        *Call callback(key, value, commit_seq) for every committed change of "key",
+        or of keys starting with "prefix", or of every key. value is None for a
+        delete. Callbacks run on a dispatcher thread after the commit. Return the
+        watchId to pass to unwatch.
+    -void unwatch(int watchId)
+        *Stop a watch
+    *All require SimpleDB(changefeed=capacity)
+    '''
+
+    def changes(self, since: int = None, wait: bool = False, timeout: float = None):
+        changefeed = self.get_changefeed()
+        if since == None:
+            since = changefeed.last_seq()
+        elif type(since) != int:
+            raise TypeError
+        # Checked now rather than on the first next()
+        changefeed.read(since, 0)
+        return changefeed.changes(since, wait, timeout)
+
+    def changes_async(self, since: int = None):
+        changefeed = self.get_changefeed()
+        if since == None:
+            since = changefeed.last_seq()
+        elif type(since) != int:
+            raise TypeError
+        changefeed.read(since, 0)
+        return changefeed.changes_async(since)
+
+    def watch(self, callback, key: str = None, prefix: str = None):
+        if not callable(callback):
+            raise TypeError
+        if (key != None and not checkStr(key)) or (prefix != None and not checkStr(prefix)):
+            raise TypeError
+        return self.get_changefeed().watch(callback, key, prefix)
+
+    def unwatch(self, watchId: int):
+        self.get_changefeed().unwatch(watchId)
+
+    def get_changefeed(self):
+        if self.changefeed == None:
+            raise Exception("Error, changefeed is not enabled")
+        return self.changefeed
+
+    '''
+    -void enable_metrics()
+        *Start counting operations, timing them into latency histograms, counting
+        commits and conflicts per key prefix (up to the first ':') and sampling
+        hot keys, see metrics.py
+    -void disable_metrics()
+        *Stop and drop the metrics, operations then run exactly as without them
+    -Dict stats()
+        *Gauges of the database (keys, open transactions, commit sequence number,
+        memory) and, when metrics are on, operations, prefixes and hot_keys
+    -String prometheus()
+        *Same as stats in the Prometheus text exposition format
+    '''
+
+    def enable_metrics(self):
+        if self.metrics == None:
+            self.metrics = Metrics()
+            self.metrics.instrument(self)
+
+    def disable_metrics(self):
+        if self.metrics != None:
+            Metrics.uninstrument(self)
+            self.metrics = None
+
+    def gauges(self):
+        gauges = {
+            'keys': len(self.db),
+            'open_transactions': len(self.transaction),
+            'prepared_keys': len(self.prepared),
+            'commit_seq': self.commit_seq,
+            'expiring_keys': len(self.expiry.deadlines),
+            'history_keys': len(self.db_history),
+        }
+        if self.memory_limit != None:
+            gauges['used_memory_bytes'] = self.memory_limit.used_memory
+        return gauges
+
+    def counters(self):
+        return {
+            'reaped_transactions': self.reaped_transactions,
+            'rejected_transactions': self.rejected_transactions,
+        }
+
+    def stats(self):
+        stats = self.gauges()
+        stats.update(self.counters())
+        if self.metrics != None:
+            stats.update(self.metrics.stats())
+        return stats
+
+    def prometheus(self):
+        metrics = self.metrics
+        if metrics == None:
+            metrics = Metrics()
+        return metrics.prometheus(self.gauges(), self.counters())
@@ -0,0 +1,265 @@
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Memory ceiling and eviction policies
+
+Memory is estimated per key when it is written, as the size of the key and
+value objects plus a fixed ENTRY_OVERHEAD for the slots the key take in db,
+db_transaction_id and the policy. Nothing ever walk db to measure it.
+
+Policies (eviction_policy):
+    'noeviction'   - reject writes while over the ceiling
+    'lru'          - evict the least recently used key
+    'lfu'          - evict the least frequently used key among a random sample,
+                     counters are logarithmic and decay over time
+    'random'       - evict a random key
+    'volatile-ttl' - evict the key with the soonest TTL deadline first, a random
+                     key once no key has a TTL
+'''
+
+ENTRY_OVERHEAD = 120
+
+POLICIES = ('noeviction', 'lru', 'lfu', 'random', 'volatile-ttl')
+
+# Random keys drawn before giving up when every one drawn is held
+RANDOM_TRIES = 5
+
+
+def entry_size(key, value):
+    size = sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD
+    # A memoryview's own size does not count the bytes it keeps alive
+    if type(value) == memoryview:
+        size += value.nbytes
+    return size
+
+
+class KeySampler(object):
+    '''
+    Keys in a list plus their position, so a random key is picked in O(1) and a
+    key is removed in O(1) by moving the last one into its slot
+    '''
+
+    def __init__(self):
+        self.keys = []
+        self.position = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        if key not in self.position:
+            self.position[key] = len(self.keys)
+            self.keys.append(key)
+
+    def remove(self, key):
+        index = self.position.pop(key, None)
+        if index == None:
+            return
+        last = self.keys.pop()
+        if index < len(self.keys):
+            self.keys[index] = last
+            self.position[last] = index
+
+    def sample(self, count: int):
+        if not self.keys:
+            return []
+        return [self.keys[random.randrange(len(self.keys))] for _ in range(count)]
+
+
+class LRUPolicy(object):
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def on_insert(self, key):
+        self.order[key] = None
+        self.order.move_to_end(key)
+
+    def on_access(self, key):
+        if key in self.order:
+            self.order.move_to_end(key)
+
+    def on_delete(self, key):
+        self.order.pop(key, None)
+
+    def victim(self, held=()):
+        for key in self.order:
+            if key not in held:
+                return key
+        return None
+
+
+class RandomPolicy(object):
+    def __init__(self):
+        self.sampler = KeySampler()
+
+    def on_insert(self, key):
+        self.sampler.add(key)
+
+    def on_access(self, key):
+        pass
+
+    def on_delete(self, key):
+        self.sampler.remove(key)
+
+    def victim(self, held=()):
+        for key in self.sampler.sample(RANDOM_TRIES):
+            if key not in held:
+                return key
+        return None
+
+
+class LFUPolicy(RandomPolicy):
+    '''
+    Each key hold a logarithmic access counter: the more it has been accessed the
+    less likely the next access increment it. The counter lose one for every
+    decay_seconds the key was not accessed. The victim is the lowest counter
+    among sample_size random keys.
+    '''
+
+    INITIAL = 5
+    MAXIMUM = 255
+
+    def __init__(self, log_factor: int = 10, decay_seconds: float = 60.0,
+                 sample_size: int = 5, clock=time.monotonic):
+        super().__init__()
+        self.log_factor = log_factor
+        self.decay_seconds = decay_seconds
+        self.sample_size = sample_size
+        self.clock = clock
+        # {key: [counter, last access time]}
+        self.counters = {}
+
+    def on_insert(self, key):
+        super().on_insert(key)
+        if key in self.counters:
+            self.on_access(key)
+        else:
+            self.counters[key] = [self.INITIAL, self.clock()]
+
+    def decayed(self, key, now: float):
+        counter, last_access = self.counters[key]
+        periods = int((now - last_access) / self.decay_seconds) \
+            if self.decay_seconds > 0 else 0
+        return max(counter - periods, 0)
+
+    def on_access(self, key):
+        entry = self.counters.get(key)
+        if entry == None:
+            return
+        now = self.clock()
+        counter = self.decayed(key, now)
+        if counter < self.MAXIMUM:
+            base = max(counter - self.INITIAL, 0)
+            if random.random() < 1.0 / (base * self.log_factor + 1):
+                counter += 1
+        entry[0] = counter
+        entry[1] = now
+
+    def on_delete(self, key):
+        super().on_delete(key)
+        self.counters.pop(key, None)
+
+    def victim(self, held=()):
+        sample = [key for key in self.sampler.sample(self.sample_size) if key not in held]
+        if not sample:
+            return None
+        now = self.clock()
+        return min(sample, key=lambda key: self.decayed(key, now))
+
+
+class TTLPolicy(RandomPolicy):
+    def __init__(self, expiry):
+        super().__init__()
+        self.expiry = expiry
+
+    def victim(self, held=()):
+        soonest = self.expiry.peek(held)
+        if soonest != None:
+            return soonest[1]
+        return super().victim(held)
+
+
+def make_policy(name: str, expiry=None):
+    if name == 'noeviction':
+        return None
+    if name == 'lru':
+        return LRUPolicy()
+    if name == 'lfu':
+        return LFUPolicy()
+    if name == 'random':
+        return RandomPolicy()
+    if name == 'volatile-ttl':
+        return TTLPolicy(expiry)
+    raise ValueError("Error, eviction policy must be one of %s" % ', '.join(POLICIES))
+
+
+class MemoryLimit(object):
+    def __init__(self, maxmemory: int, policy: str = 'lru', expiry=None):
+        if type(maxmemory) != int:
+            raise TypeError
+        self.maxmemory = maxmemory
+        self.policy_name = policy
+        self.policy = make_policy(policy, expiry)
+        self.used_memory = 0
+        self.evicted_keys = 0
+        self.rejected_writes = 0
+        # Policy structures are shared by every writer and reader
+        self.lock = threading.Lock()
+
+    # Count data already in db, done once on startup
+    def load(self, db):
+        with self.lock:
+            for key, value in db.items():
+                self.used_memory += entry_size(key, value)
+                if self.policy != None:
+                    self.policy.on_insert(key)
+
+    # Account for puts {key: value} and deletes [key] about to be applied to db
+    def track(self, db, puts, deletes=()):
+        with self.lock:
+            for key in deletes:
+                if key in db:
+                    self.used_memory -= entry_size(key, db[key])
+                    if self.policy != None:
+                        self.policy.on_delete(key)
+            for key, value in puts.items():
+                if key in db:
+                    self.used_memory -= entry_size(key, db[key])
+                self.used_memory += entry_size(key, value)
+                if self.policy != None:
+                    self.policy.on_insert(key)
+
+    def on_access(self, key):
+        if self.policy != None:
+            with self.lock:
+                self.policy.on_access(key)
+
+    def over_limit(self):
+        return self.used_memory > self.maxmemory
+
+    # Key to evict next, None when there is nothing to evict. Keys in held can
+    # not be evicted and are passed over.
+    def victim(self, held=()):
+        if self.policy == None:
+            return None
+        with self.lock:
+            return self.policy.victim(held)
+
+    # Drop a key the policy hold but db does not
+    def forget(self, key):
+        if self.policy != None:
+            with self.lock:
+                self.policy.on_delete(key)
+
+    def stats(self):
+        return {
+            'used_memory': self.used_memory,
+            'maxmemory': self.maxmemory,
+            'eviction_policy': self.policy_name,
+            'evicted_keys': self.evicted_keys,
+            'rejected_writes': self.rejected_writes,
+        }
@@ -0,0 +1,75 @@
+import heapq
+import threading
+
+
+class ExpiryIndex(object):
+    '''
+    Deadline of every key that has a TTL, plus a min-heap of (deadline, key) so
+    the keys due first are found without scanning db. Setting a new deadline or
+    removing a key leave its old heap entry behind, such stale entries are
+    skipped when popped and the heap is rebuilt once they outnumber live ones.
+    '''
+
+    def __init__(self):
+        self.deadlines = {}
+        self.heap = []
+        # Heap operations are not atomic, writers on different key stripes share it
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def get(self, key: str):
+        return self.deadlines.get(key)
+
+    def set(self, key: str, deadline: float):
+        with self.lock:
+            self.deadlines[key] = deadline
+            heapq.heappush(self.heap, (deadline, key))
+            if len(self.heap) > 2 * len(self.deadlines) + 64:
+                self.compact()
+
+    def remove(self, key: str):
+        self.deadlines.pop(key, None)
+
+    # Soonest deadline, None when no key has a TTL
+    def next_deadline(self):
+        soonest = self.peek()
+        return None if soonest == None else soonest[0]
+
+    # (deadline, key) of the key expiring first, None when no key has a TTL.
+    # Keys in skip are passed over, the heap is then walked past its top.
+    def peek(self, skip=()):
+        with self.lock:
+            while self.heap:
+                deadline, key = self.heap[0]
+                if self.deadlines.get(key) == deadline:
+                    if key not in skip:
+                        return deadline, key
+                    break
+                heapq.heappop(self.heap)
+            else:
+                return None
+            live = [(deadline, key) for deadline, key in self.heap
+                    if key not in skip and self.deadlines.get(key) == deadline]
+            return min(live) if live else None
+
+    # Pop at most limit heap entries that are due at now, return the keys among
+    # them that are still set to expire at that deadline
+    def pop_due(self, now: float, limit: int):
+        due = []
+        with self.lock:
+            while self.heap and limit > 0 and self.heap[0][0] <= now:
+                deadline, key = heapq.heappop(self.heap)
+                limit -= 1
+                if self.deadlines.get(key) == deadline:
+                    due.append(key)
+        return due
+
+    # Drop stale entries, called with the lock held
+    def compact(self):
+        self.heap = [(deadline, key) for key, deadline in self.deadlines.items()]
+        heapq.heapify(self.heap)
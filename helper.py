@@ -3,4 +3,9 @@ def checkStr(*args):
         for val in args:
             if type(val) != str:
                 return False
-        return True
\ No newline at end of file
+        return True
+
+
+# Same as checkStr but for a whole collection, type check run at C level
+def checkAllStr(values):
+        return set(map(type, values)) <= {str}
@@ -0,0 +1,90 @@
+import threading
+import time
+
+'''
+Key locks of pessimistic transactions
+
+A pessimistic transaction locks every key it touches, exclusively, until it
+ends. A transaction asking for a key held by another one waits for it to end,
+unless that would deadlock: a transaction waits for one key at a time, so the
+waits form chains, and the one whose wait would close a chain into a cycle is
+aborted instead. A wait lasting more than wait_timeout seconds is aborted too,
+in case the holder was abandoned.
+
+Without wait (a database that is not thread safe, where waiting would block the
+only thread) every conflict is aborted at once.
+'''
+
+LOCK_WAIT_TIMEOUT = 5.0
+
+
+class LockManager(object):
+    def __init__(self, wait: bool = True, wait_timeout: float = LOCK_WAIT_TIMEOUT):
+        self.wait = wait
+        self.wait_timeout = wait_timeout
+        self.condition = threading.Condition()
+        # {key: transactionId holding it}, {transactionId: set of keys held}
+        self.owners = {}
+        self.held = {}
+        # Wait-for graph as {transactionId: key it waits for}
+        self.waiting = {}
+        self.waits = 0
+        self.deadlocks = 0
+        self.timeouts = 0
+
+    def begin(self, transactionId: str):
+        with self.condition:
+            self.held[transactionId] = set()
+
+    # Whether transactionId waiting for key would wait for itself through the
+    # chain of holders and what they wait for. Called with the condition held.
+    def would_deadlock(self, transactionId: str, key: str):
+        owner = self.owners.get(key)
+        while owner != None:
+            if owner == transactionId:
+                return True
+            waited = self.waiting.get(owner)
+            owner = None if waited == None else self.owners.get(waited)
+        return False
+
+    # Lock key for transactionId, waiting while another transaction hold it
+    def acquire(self, transactionId: str, key: str):
+        with self.condition:
+            deadline = None
+            try:
+                while True:
+                    owner = self.owners.get(key)
+                    if owner == None or owner == transactionId:
+                        self.owners[key] = transactionId
+                        self.held[transactionId].add(key)
+                        return
+                    if not self.wait or self.would_deadlock(transactionId, key):
+                        self.deadlocks += 1
+                        raise Exception("Error, key is locked by another transaction")
+                    if deadline == None:
+                        deadline = time.monotonic() + self.wait_timeout
+                        self.waits += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise Exception("Error, timed out waiting for key lock")
+                    self.waiting[transactionId] = key
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting.pop(transactionId, None)
+
+    # Release every key of transactionId and wake the transactions waiting
+    def release(self, transactionId: str):
+        with self.condition:
+            for key in self.held.pop(transactionId, ()):
+                if self.owners.get(key) == transactionId:
+                    del self.owners[key]
+            self.condition.notify_all()
+
+    def stats(self):
+        return {
+            'locked_keys': len(self.owners),
+            'lock_waits': self.waits,
+            'lock_deadlocks': self.deadlocks,
+            'lock_timeouts': self.timeouts,
+        }
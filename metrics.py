@@ -0,0 +1,268 @@
+import threading
+import time
+from functools import wraps
+
+'''
+Instrumentation for SimpleDB
+
+Metrics hold per operation counters and latency histograms, commit and conflict
+counts per key prefix, and a sample of the hottest keys.
+
+Turning metrics on wraps the instrumented methods of one SimpleDB instance with
+timed versions set as instance attributes. Turning them off deletes those
+attributes, so the class methods are called again directly with no check left
+on the hot path.
+
+Histogram is HDR-style: values are counted in log-linear buckets, SUB_BUCKETS
+per power of two, so any percentile is within 1 / SUB_BUCKETS of the truth
+whatever the range of values, in constant memory.
+
+Latencies are recorded without taking the lock, the increments of two threads
+may then race and one be lost. Counts stay close enough for monitoring and an
+operation does not pay for a lock.
+'''
+
+# Methods timed when metrics are on, those taking a key first also sample it
+INSTRUMENTED = ('get', 'put', 'delete', 'get_many', 'put_many', 'delete_many', 'incr',
+                'decr', 'append', 'cas', 'getset', 'setnx', 'createTransaction',
+                'commitTransaction', 'rollbackTransaction')
+KEY_METHODS = ('get', 'put', 'delete', 'incr', 'decr', 'append', 'cas', 'getset', 'setnx')
+
+SUB_BITS = 3
+SUB_BUCKETS = 1 << SUB_BITS
+
+
+class Histogram(object):
+    '''
+    Latencies in microseconds. Values under 2 * SUB_BUCKETS have a bucket
+    each, larger ones share SUB_BUCKETS buckets per power of two.
+    '''
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket_of(value: int):
+        if value < 2 * SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - SUB_BITS - 1
+        return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+    # Lowest value counted in bucket
+    @staticmethod
+    def bucket_value(bucket: int):
+        if bucket < 2 * SUB_BUCKETS:
+            return bucket
+        shift = bucket // SUB_BUCKETS - 1
+        return (bucket % SUB_BUCKETS + SUB_BUCKETS) << shift
+
+    def record(self, value: int):
+        if value < 2 * SUB_BUCKETS:
+            bucket = value
+        else:
+            shift = value.bit_length() - SUB_BITS - 1
+            bucket = (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+        if bucket >= len(self.counts):
+            self.counts.extend([0] * (bucket + 1 - len(self.counts)))
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # Upper bound of the bucket holding the quantile (0 to 1) of the values
+    def percentile(self, quantile: float):
+        if self.count == 0:
+            return 0
+        rank = quantile * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.bucket_value(bucket + 1) - 1, self.max)
+        return self.max
+
+    # Cumulative (upper bound, count) of every non empty bucket
+    def cumulative(self):
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            if count:
+                seen += count
+                yield self.bucket_value(bucket + 1) - 1, seen
+
+
+class HotKeys(object):
+    '''
+    Space-saving top-k: counts of at most capacity sampled keys, a new key
+    replace the least counted one and inherit its count so heavy hitters stay.
+    '''
+
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, key: str):
+        if key in self.counts or len(self.counts) < self.capacity:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            return
+        coldest = min(self.counts, key=self.counts.get)
+        self.counts[key] = self.counts.pop(coldest) + 1
+
+    def top(self, count: int = 10):
+        return sorted(self.counts.items(), key=lambda item: -item[1])[:count]
+
+
+class Metrics(object):
+    def __init__(self, sample_every: int = 16, prefix_separator: str = ':',
+                 clock=time.perf_counter):
+        self.sample_every = sample_every
+        self.prefix_separator = prefix_separator
+        self.clock = clock
+        self.lock = threading.Lock()
+        # {operation: Histogram}, its count is the number of calls, and
+        # {operation: failed calls}
+        self.errors = {}
+        self.latencies = {}
+        # {key prefix: [commits, conflicts]}
+        self.prefixes = {}
+        self.hot_keys = HotKeys()
+        self.sampled = 0
+
+    def prefix_of(self, key: str):
+        prefix, separator, _ = key.partition(self.prefix_separator)
+        return prefix + separator if separator else ''
+
+    def histogram(self, operation: str):
+        with self.lock:
+            histogram = self.latencies.get(operation)
+            if histogram == None:
+                histogram = self.latencies[operation] = Histogram()
+            return histogram
+
+    def record_error(self, operation: str):
+        with self.lock:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def sample_key(self, key):
+        if type(key) == str:
+            with self.lock:
+                self.hot_keys.add(key)
+
+    def record_commit(self, keys):
+        with self.lock:
+            for prefix in {self.prefix_of(key) for key in keys}:
+                self.prefixes.setdefault(prefix, [0, 0])[0] += 1
+
+    def record_conflict(self, key: str):
+        with self.lock:
+            self.prefixes.setdefault(self.prefix_of(key), [0, 0])[1] += 1
+
+    # Wrap the instrumented methods of db with timed ones
+    def instrument(self, db):
+        for name in INSTRUMENTED:
+            setattr(db, name, self.timed(name, getattr(type(db), name).__get__(db),
+                                         name in KEY_METHODS))
+
+    @staticmethod
+    def uninstrument(db):
+        for name in INSTRUMENTED:
+            db.__dict__.pop(name, None)
+
+    def timed(self, name: str, method, samples_key: bool):
+        clock = self.clock
+        histogram = self.histogram(name)
+
+        @wraps(method)
+        def timed_method(*args, **kwargs):
+            if samples_key:
+                self.sampled += 1
+                if self.sampled % self.sample_every == 0 and args:
+                    self.sample_key(args[0])
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                self.record_error(name)
+                raise
+            finally:
+                histogram.record(int((clock() - start) * 1e6))
+        return timed_method
+
+    def stats(self):
+        with self.lock:
+            operations = {}
+            for name, histogram in self.latencies.items():
+                if histogram.count == 0:
+                    continue
+                operations[name] = {
+                    'count': histogram.count,
+                    'errors': self.errors.get(name, 0),
+                    'mean_us': histogram.total / histogram.count,
+                    'p50_us': histogram.percentile(0.5),
+                    'p99_us': histogram.percentile(0.99),
+                    'p999_us': histogram.percentile(0.999),
+                    'max_us': histogram.max,
+                }
+            prefixes = {}
+            for prefix, (commits, conflicts) in self.prefixes.items():
+                prefixes[prefix] = {
+                    'commits': commits,
+                    'conflicts': conflicts,
+                    'conflict_rate': conflicts / (commits + conflicts),
+                }
+            return {
+                'operations': operations,
+                'prefixes': prefixes,
+                'hot_keys': self.hot_keys.top(),
+            }
+
+    # Prometheus text exposition of the metrics, after the gauges and counters
+    # of the database as {name: value}
+    def prometheus(self, gauges, counters=None):
+        lines = []
+        for name, value in gauges.items():
+            lines.append('# TYPE simpledb_%s gauge' % name)
+            lines.append('simpledb_%s %s' % (name, value))
+        for name, value in (counters or {}).items():
+            lines.append('# TYPE simpledb_%s_total counter' % name)
+            lines.append('simpledb_%s_total %s' % (name, value))
+        with self.lock:
+            lines.append('# TYPE simpledb_operations_total counter')
+            for name, histogram in self.latencies.items():
+                lines.append('simpledb_operations_total{op="%s"} %d' % (name, histogram.count))
+            lines.append('# TYPE simpledb_operation_errors_total counter')
+            for name, count in self.errors.items():
+                lines.append('simpledb_operation_errors_total{op="%s"} %d' % (name, count))
+            lines.append('# TYPE simpledb_operation_latency_seconds histogram')
+            for name, histogram in self.latencies.items():
+                if histogram.count == 0:
+                    continue
+                for upper, count in histogram.cumulative():
+                    lines.append('simpledb_operation_latency_seconds_bucket{op="%s",le="%g"} %d'
+                                 % (name, (upper + 1) / 1e6, count))
+                lines.append('simpledb_operation_latency_seconds_bucket{op="%s",le="+Inf"} %d'
+                             % (name, histogram.count))
+                lines.append('simpledb_operation_latency_seconds_sum{op="%s"} %g'
+                             % (name, histogram.total / 1e6))
+                lines.append('simpledb_operation_latency_seconds_count{op="%s"} %d'
+                             % (name, histogram.count))
+            # Samples of a metric follow its own TYPE line
+            lines.append('# TYPE simpledb_commits_total counter')
+            for prefix, (commits, _) in self.prefixes.items():
+                lines.append('simpledb_commits_total{prefix="%s"} %d'
+                             % (escape_label(prefix), commits))
+            lines.append('# TYPE simpledb_conflicts_total counter')
+            for prefix, (_, conflicts) in self.prefixes.items():
+                lines.append('simpledb_conflicts_total{prefix="%s"} %d'
+                             % (escape_label(prefix), conflicts))
+            lines.append('# TYPE simpledb_hot_key_samples gauge')
+            for key, count in self.hot_keys.top():
+                lines.append('simpledb_hot_key_samples{key="%s"} %d' % (escape_label(key), count))
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value: str):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,190 @@
+import base64
+import json
+import threading
+from bisect import bisect_left, bisect_right
+
+'''
+Ordered key index for range scans
+
+Keys are kept sorted in a list of chunks of at most 2 * CHUNK_SIZE keys, with
+the largest key of every chunk in maxes. A key is found by bisecting maxes then
+its chunk, so insert and remove only shift the keys of one chunk instead of the
+whole index (a flat sorted-array / B-tree hybrid).
+
+irange() is lazy: it copies one chunk at a time under the lock and seeks the
+next one from the last key it returned, so writes made while iterating never
+break it. Keys written meanwhile may or may not be returned.
+'''
+
+CHUNK_SIZE = 512
+
+
+# Opaque token of a scan_page cursor: the last key examined and the end bound
+def encode_cursor(last_key: str, end: str = None):
+    return base64.urlsafe_b64encode(json.dumps([last_key, end]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str):
+    try:
+        last_key, end = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError("Error, invalid cursor")
+    if type(last_key) != str or (end != None and type(end) != str):
+        raise ValueError("Error, invalid cursor")
+    return last_key, end
+
+
+# Smallest string greater than every string starting with prefix, None when
+# there is none
+def prefix_end(prefix: str):
+    while prefix and prefix[-1] == chr(0x10FFFF):
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class OrderedKeyIndex(object):
+    def __init__(self, keys=()):
+        self.chunks = []
+        self.maxes = []
+        self.size = 0
+        # Writers on different key stripes share the index
+        self.lock = threading.Lock()
+        self.load(keys)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return self.irange()
+
+    def __contains__(self, key):
+        i = bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return False
+        chunk = self.chunks[i]
+        return chunk[bisect_left(chunk, key)] == key
+
+    # Replace the index with keys, sorted once instead of inserted one by one
+    def load(self, keys):
+        keys = sorted(keys)
+        with self.lock:
+            self.chunks = [keys[i:i + CHUNK_SIZE]
+                           for i in range(0, len(keys), CHUNK_SIZE)]
+            self.maxes = [chunk[-1] for chunk in self.chunks]
+            self.size = len(keys)
+
+    def add(self, key):
+        with self.lock:
+            if not self.chunks:
+                self.chunks.append([key])
+                self.maxes.append(key)
+                self.size += 1
+                return
+            i = bisect_left(self.maxes, key)
+            if i == len(self.maxes):
+                # Greater than every key, append to the last chunk
+                i -= 1
+                chunk = self.chunks[i]
+                chunk.append(key)
+                self.maxes[i] = key
+            else:
+                chunk = self.chunks[i]
+                j = bisect_left(chunk, key)
+                if chunk[j] == key:
+                    return
+                chunk.insert(j, key)
+            self.size += 1
+            if len(chunk) > 2 * CHUNK_SIZE:
+                self.chunks[i:i + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+                self.maxes[i:i + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+    def remove(self, key):
+        with self.lock:
+            i = bisect_left(self.maxes, key)
+            if i == len(self.maxes):
+                return
+            chunk = self.chunks[i]
+            j = bisect_left(chunk, key)
+            if chunk[j] != key:
+                return
+            del chunk[j]
+            self.size -= 1
+            if not chunk:
+                del self.chunks[i]
+                del self.maxes[i]
+                return
+            self.maxes[i] = chunk[-1]
+            # Merge a chunk that shrank too much into its neighbour
+            if len(chunk) < CHUNK_SIZE // 4 and len(self.chunks) > 1:
+                if i == len(self.chunks) - 1:
+                    i -= 1
+                merged = self.chunks[i] + self.chunks[i + 1]
+                if len(merged) > 2 * CHUNK_SIZE:
+                    half = len(merged) // 2
+                    self.chunks[i:i + 2] = [merged[:half], merged[half:]]
+                    self.maxes[i:i + 2] = [merged[half - 1], merged[-1]]
+                else:
+                    self.chunks[i:i + 2] = [merged]
+                    self.maxes[i:i + 2] = [merged[-1]]
+
+    '''
+    Yield keys from start (inclusive) to end (exclusive) in order, or in
+    reverse order when reverse is True. None means unbounded. Going forward,
+    start is skipped when inclusive is False.
+    '''
+
+    def irange(self, start: str = None, end: str = None, reverse: bool = False,
+               inclusive: bool = True):
+        if start != None and end != None and start >= end:
+            return
+        if reverse:
+            batch = self.batch_before(end, start)
+            while batch:
+                yield from reversed(batch)
+                batch = self.batch_before(batch[0], start)
+        else:
+            batch = self.batch_after(start, inclusive, end)
+            while batch:
+                yield from batch
+                batch = self.batch_after(batch[-1], False, end)
+
+    # Copy of the keys after key (from key when inclusive) up to the end of its
+    # chunk, stopping before end
+    def batch_after(self, key, inclusive: bool, end):
+        with self.lock:
+            if not self.chunks:
+                return []
+            if key == None:
+                batch = self.chunks[0][:]
+            else:
+                seek = bisect_left if inclusive else bisect_right
+                i = seek(self.maxes, key)
+                if i == len(self.maxes):
+                    return []
+                chunk = self.chunks[i]
+                batch = chunk[seek(chunk, key):]
+            if end != None and batch and batch[-1] >= end:
+                return batch[:bisect_left(batch, end)]
+            return batch
+
+    # Copy of the keys before key down to the start of their chunk, stopping at
+    # start
+    def batch_before(self, key, start):
+        with self.lock:
+            if not self.chunks:
+                return []
+            if key == None:
+                batch = self.chunks[-1][:]
+            else:
+                i = bisect_left(self.maxes, key)
+                batch = []
+                if i < len(self.chunks):
+                    chunk = self.chunks[i]
+                    batch = chunk[:bisect_left(chunk, key)]
+                if not batch and i > 0:
+                    batch = self.chunks[i - 1][:]
+            if start != None and batch and batch[0] < start:
+                return batch[bisect_left(batch, start):]
+            return batch
@@ -0,0 +1,215 @@
+from codec import BYTES_TYPES, VALUE_TYPES
+
+'''
+RESP-like wire protocol
+
+Requests are arrays of typed arguments:
+    *<count>\r\n then for every argument
+    $<byte length>\r\n<utf-8 bytes>\r\n   a str
+    &<byte length>\r\n<bytes>\r\n        a bytes value
+    :<integer>\r\n                       an int value
+    ,<repr>\r\n                          a float value
+    $-1\r\n                              absent (None), only where
+                                         NULLABLE_ARGS allow it
+
+Replies:
+    +OK\r\n                 success without value
+    $<length>\r\n<bytes>\r\n a str value as utf-8
+    &<length>\r\n<bytes>\r\n a bytes value as it is
+    :<integer>\r\n          an int value or an integer result
+    ,<repr>\r\n             a float value
+    $-1\r\n                 no value (None)
+    -<KIND> <message>\r\n   an error, KIND is ERR, KEYERROR or TYPEERROR so the
+                            client can raise the same exception as SimpleDB
+
+Every value type of codec.py so comes back as the type it was put with.
+
+Parsers take a buffer and an offset and return (message, next offset), or None
+when the buffer does not hold a complete message yet, so pipelined requests are
+parsed out of one read without copying.
+'''
+
+CRLF = b'\r\n'
+OK = b'+OK\r\n'
+NIL = b'$-1\r\n'
+
+# Longest request line and argument accepted, larger ones are protocol errors
+MAX_LINE = 64
+MAX_ARGUMENT = 512 * 1024 * 1024
+
+ERROR_KINDS = {KeyError: 'KEYERROR', TypeError: 'TYPEERROR'}
+
+# Position of the argument that may be None per command: the expected value of
+# CAS, None for only if the key does not exist
+NULLABLE_ARGS = {'CAS': 2}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ReplyError(Exception):
+    pass
+
+
+# Whether every argument can be sent, str or a value type of codec.py, None
+# where NULLABLE_ARGS allow it
+def check_args(args):
+    args = tuple(args)
+    nullable = NULLABLE_ARGS.get(args[0].upper()) if args and type(args[0]) == str else None
+    return all(type(arg) in VALUE_TYPES or (arg is None and index == nullable)
+               for index, arg in enumerate(args))
+
+
+def encode_command(*args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        parts.append(NIL if arg is None else encode_typed(arg))
+    return b''.join(parts)
+
+
+# Argument or value as its typed element, None is not a value
+def encode_typed(value):
+    value_type = type(value)
+    if value_type == str:
+        data = value.encode('utf-8')
+        return b'$%d\r\n%s\r\n' % (len(data), data)
+    if value_type == int:
+        return encode_integer(value)
+    if value_type == float:
+        return b',%s\r\n' % repr(value).encode('ascii')
+    if value_type in BYTES_TYPES:
+        return b'&%d\r\n%s\r\n' % (len(value), bytes(value))
+    raise TypeError
+
+
+def encode_value(value):
+    if value is None:
+        return NIL
+    return encode_typed(value)
+
+
+def encode_integer(value: int):
+    return b':%d\r\n' % value
+
+
+def encode_error(error: Exception):
+    kind = ERROR_KINDS.get(type(error), 'ERR')
+    # str(KeyError) quote its key, use the arguments as they were given
+    message = ' '.join(map(str, error.args)).replace('\r', ' ').replace('\n', ' ')
+    return ('-%s %s\r\n' % (kind, message)).encode('utf-8')
+
+
+# Return (content after the type byte, next offset) of the line starting at
+# offset, None if it is not complete
+def _read_line(buffer, offset: int):
+    end = buffer.find(CRLF, offset)
+    if end == -1:
+        if len(buffer) - offset > MAX_LINE:
+            raise ProtocolError("Error, line too long")
+        return None
+    return buffer[offset + 1:end], end + 2
+
+
+def _read_length(buffer, offset: int, limit: int):
+    line = _read_line(buffer, offset)
+    if line == None:
+        return None
+    try:
+        length = int(line[0])
+    except ValueError:
+        raise ProtocolError("Error, invalid length")
+    if length > limit:
+        raise ProtocolError("Error, length too large")
+    return length, line[1]
+
+
+# Parse one request, return ([argument], next offset) or None
+def parse_command(buffer, offset: int = 0):
+    if offset >= len(buffer):
+        return None
+    if buffer[offset] != ord('*'):
+        raise ProtocolError("Error, expected an array")
+    header = _read_length(buffer, offset, MAX_LINE)
+    if header == None:
+        return None
+    count, offset = header
+    if count < 1:
+        raise ProtocolError("Error, empty command")
+    args = []
+    for _ in range(count):
+        if offset >= len(buffer):
+            return None
+        kind = buffer[offset]
+        if kind == ord('$') or kind == ord('&'):
+            header = _read_length(buffer, offset, MAX_ARGUMENT)
+            if header == None:
+                return None
+            length, offset = header
+            if length == -1 and kind == ord('$'):
+                args.append(None)
+                continue
+            if length < 0:
+                raise ProtocolError("Error, invalid length")
+            if len(buffer) < offset + length + 2:
+                return None
+            data = buffer[offset:offset + length]
+            args.append(data.decode('utf-8') if kind == ord('$') else bytes(data))
+            offset += length + 2
+        elif kind == ord(':') or kind == ord(','):
+            line = _read_line(buffer, offset)
+            if line == None:
+                return None
+            args.append(_parse_number(kind, line[0]))
+            offset = line[1]
+        else:
+            raise ProtocolError("Error, expected a bulk string or a number")
+    return args, offset
+
+
+def _parse_number(kind: int, line):
+    try:
+        return int(line) if kind == ord(':') else float(line)
+    except ValueError:
+        raise ProtocolError("Error, invalid number")
+
+
+# Parse one reply, return (value, next offset) or None. Values are str, bytes,
+# int, float, None for OK or no value, or a ReplyError carrying the error kind
+# and message.
+def parse_reply(buffer, offset: int = 0):
+    if offset >= len(buffer):
+        return None
+    kind = buffer[offset]
+    if kind == ord('$') or kind == ord('&'):
+        header = _read_length(buffer, offset, MAX_ARGUMENT)
+        if header == None:
+            return None
+        length, offset = header
+        if length < 0:
+            return None, offset
+        if len(buffer) < offset + length + 2:
+            return None
+        data = buffer[offset:offset + length]
+        return data.decode('utf-8') if kind == ord('$') else bytes(data), offset + length + 2
+    end = buffer.find(CRLF, offset)
+    if end == -1:
+        return None
+    line = buffer[offset + 1:end].decode('utf-8')
+    if kind == ord('+'):
+        return None, end + 2
+    if kind == ord(':') or kind == ord(','):
+        return _parse_number(kind, line), end + 2
+    if kind == ord('-'):
+        return ReplyError(line), end + 2
+    raise ProtocolError("Error, unknown reply type")
+
+
+# Exception SimpleDB raised for an error reply
+def reply_exception(reply: ReplyError):
+    kind, _, message = str(reply).partition(' ')
+    if kind == 'KEYERROR':
+        return KeyError(message)
+    if kind == 'TYPEERROR':
+        return TypeError(message)
+    return Exception(message)
@@ -0,0 +1,330 @@
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from db import SimpleDB
+from snapshot import encode_snapshot
+from wal import HEADER as RECORD_HEADER, decode_payload, encode_record
+
+'''
+Primary / replica replication over TCP
+
+The primary serves its changefeed: a replica connects and sends the commit
+sequence number it has applied, the primary streams every commit after it as
+a write-ahead log record (wal.py), each with its own length and crc. A replica
+that is new, or further behind than the changefeed holds, is first sent a
+snapshot (snapshot.py) taken while every key is locked, then the commits after
+it.
+
+Messages from the primary are a MESSAGE header (kind, payload length) then the
+payload:
+    SNAPSHOT   snapshot bytes
+    CHANGE     log record of one commit
+    HEARTBEAT  SEQ, the last commit sequence number of the primary, sent after
+               every batch of changes and every HEARTBEAT_INTERVAL when idle
+
+The replica applies commits in order under the primary's commit sequence
+numbers, serves reads from its local SimpleDB and report its lag: how many
+commits it is behind the last heartbeat and for how long it has not been caught
+up. It reconnects after RECONNECT_DELAY when the connection drops, resuming
+from the last commit it applied. Keys with a TTL are not expired by the replica
+itself, they are hidden from reads once due and go when the delete of the
+primary's expiry is applied.
+'''
+
+MESSAGE = struct.Struct('<cQ')
+SEQ = struct.Struct('<q')
+
+SNAPSHOT = b'S'
+CHANGE = b'C'
+HEARTBEAT = b'H'
+
+HEARTBEAT_INTERVAL = 0.1
+RECONNECT_DELAY = 0.1
+
+# Options a replica can not take, its data come from the primary. Evictions
+# would commit under sequence numbers of the primary.
+PRIMARY_OPTIONS = ('preset_data', 'wal_path', 'snapshot_path', 'changefeed', 'maxmemory')
+
+
+def encode_message(kind: bytes, payload: bytes):
+    return MESSAGE.pack(kind, len(payload)) + payload
+
+
+# Read exactly length bytes from the buffered reader, None at end of stream
+def read_exact(reader, length: int):
+    data = reader.read(length)
+    if len(data) < length:
+        return None
+    return data
+
+
+class ReplicationServer(object):
+    def __init__(self, db: SimpleDB, host: str = '127.0.0.1', port: int = 6390):
+        if db.changefeed == None or db.key_locks == None:
+            raise ValueError("Error, replication needs SimpleDB(thread_safe=True, changefeed=...)")
+        self.db = db
+        self.host = host
+        self.port = port
+        self.listener = None
+        self.thread = None
+        # Sockets of connected replicas
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.snapshots_sent = 0
+
+    def start(self):
+        self.listener = socket.create_server((self.host, self.port))
+        # Port 0 pick a free port, report the one actually bound
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.accept, daemon=True)
+        self.thread.start()
+
+    def accept(self):
+        while not self.closed:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connections.add(connection)
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        try:
+            with connection.makefile('rb') as reader:
+                data = read_exact(reader, SEQ.size)
+                if data == None:
+                    return
+                self.stream(connection, SEQ.unpack(data)[0])
+        except Exception:
+            # Disconnected, or fell behind the changefeed: the replica reconnects
+            # and is sent a snapshot
+            pass
+        finally:
+            with self.lock:
+                self.connections.discard(connection)
+            connection.close()
+
+    # Send the commits after since, a snapshot first when they are not all kept
+    def stream(self, connection, since: int):
+        changefeed = self.db.changefeed
+        if since < 0 or since + 1 < changefeed.oldest_seq() or since > changefeed.last_seq():
+            since = self.send_snapshot(connection)
+        while not self.closed:
+            batch = changefeed.read(since)
+            if batch:
+                messages = [encode_message(CHANGE, encode_record(
+                    change.commit_seq, change.puts, change.deletes, change.expires))
+                    for change in batch]
+                since = batch[-1].commit_seq
+                messages.append(encode_message(HEARTBEAT, SEQ.pack(changefeed.last_seq())))
+                connection.sendall(b''.join(messages))
+            elif changefeed.closed:
+                # The primary's database is closed, no commit will follow
+                return
+            elif not changefeed.wait(since, HEARTBEAT_INTERVAL) and not changefeed.closed:
+                connection.sendall(encode_message(HEARTBEAT, SEQ.pack(changefeed.last_seq())))
+
+    # Snapshot taken holding every key, so it is exactly at one commit
+    def send_snapshot(self, connection):
+        db = self.db
+        with db.lock_all():
+            commit_seq = db.commit_seq
+            blocks = encode_snapshot(db.db, commit_seq, dict(db.expiry.deadlines))
+        connection.sendall(MESSAGE.pack(SNAPSHOT, sum(map(len, blocks))))
+        for block in blocks:
+            connection.sendall(block)
+        self.snapshots_sent += 1
+        return commit_seq
+
+    def close(self):
+        self.closed = True
+        if self.listener != None:
+            # Closing alone does not wake a blocked accept
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.thread != None:
+            self.thread.join()
+
+
+class Replica(object):
+    '''
+    Read-only copy of a primary. Reads go to the local SimpleDB built from
+    options, which is replaced when a snapshot is loaded.
+    '''
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 6390, **options):
+        for name in PRIMARY_OPTIONS:
+            if options.get(name) != None:
+                raise ValueError("Error, a replica can not use %s" % name)
+        # Commits are applied on the follower thread while reads run on others
+        options.setdefault('thread_safe', True)
+        self.host = host
+        self.port = port
+        self.options = options
+        self.db = self.make_db()
+        # Last commit applied (-1 before the first snapshot) and last commit of
+        # the primary heard of
+        self.applied_seq = -1
+        self.primary_seq = 0
+        self.behind_since = None
+        self.connected = False
+        self.condition = threading.Condition()
+        self.closed = False
+        self.socket = None
+        self.thread = threading.Thread(target=self.follow, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Local database, due keys are hidden until the primary's delete is applied
+    def make_db(self, **options):
+        db = SimpleDB(**options, **self.options)
+        db.expire_locally = False
+        return db
+
+    # Follower thread, connect and apply until closed
+    def follow(self):
+        while not self.closed:
+            try:
+                self.socket = socket.create_connection((self.host, self.port))
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.connected = True
+                self.socket.sendall(SEQ.pack(self.applied_seq))
+                with self.socket.makefile('rb') as reader:
+                    self.receive(reader)
+            except OSError:
+                pass
+            finally:
+                self.connected = False
+                if self.socket != None:
+                    self.socket.close()
+            if not self.closed:
+                time.sleep(RECONNECT_DELAY)
+
+    def receive(self, reader):
+        while not self.closed:
+            header = read_exact(reader, MESSAGE.size)
+            if header == None:
+                return
+            kind, length = MESSAGE.unpack(header)
+            payload = read_exact(reader, length)
+            if payload == None:
+                return
+            if kind == CHANGE:
+                self.apply_record(payload)
+            elif kind == SNAPSHOT:
+                self.load_snapshot(payload)
+            elif kind == HEARTBEAT:
+                self.heard(SEQ.unpack(payload)[0])
+
+    def apply_record(self, record):
+        _, _, commit_seq = RECORD_HEADER.unpack_from(record)
+        # Already applied before a reconnect
+        if commit_seq <= self.applied_seq:
+            return
+        puts, deletes, expires = decode_payload(record[RECORD_HEADER.size:])
+        self.db.replicate(commit_seq, puts, deletes, expires or None)
+        with self.condition:
+            self.applied_seq = commit_seq
+            self.condition.notify_all()
+
+    # Build a new local database from the snapshot, through a temporary file
+    # so it loads like any other snapshot
+    def load_snapshot(self, payload):
+        descriptor, path = tempfile.mkstemp(suffix='.snap')
+        try:
+            with os.fdopen(descriptor, 'wb') as snapshot_file:
+                snapshot_file.write(payload)
+            db = self.make_db(snapshot_path=path)
+            db.snapshot_path = None
+        finally:
+            os.remove(path)
+        old_db, self.db = self.db, db
+        old_db.close()
+        with self.condition:
+            self.applied_seq = db.commit_seq
+            self.condition.notify_all()
+
+    def heard(self, primary_seq: int):
+        with self.condition:
+            self.primary_seq = max(self.primary_seq, primary_seq)
+            if self.applied_seq >= self.primary_seq:
+                self.behind_since = None
+            elif self.behind_since == None:
+                self.behind_since = time.monotonic()
+
+    '''
+    -Dict lag()
+        *commits: how many commits of the primary are not applied yet, seconds:
+        for how long the replica has been behind, connected: whether it is
+        connected to the primary
+    -bool wait_for(int commit_seq, float timeout)
+        *Wait until the commit commit_seq of the primary is applied, return False
+        after timeout seconds
+    '''
+
+    def lag(self):
+        with self.condition:
+            behind = self.behind_since
+            return {
+                'commits': max(self.primary_seq - self.applied_seq, 0),
+                'seconds': 0.0 if behind == None else time.monotonic() - behind,
+                'connected': self.connected,
+            }
+
+    def wait_for(self, commit_seq: int, timeout: float = None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.applied_seq >= commit_seq, timeout)
+
+    def get(self, key: str):
+        return self.db.get(key)
+
+    def get_many(self, keys):
+        return self.db.get_many(keys)
+
+    def get_ttl(self, key: str):
+        return self.db.get_ttl(key)
+
+    def scan(self, start: str = None, end: str = None, reverse: bool = False,
+             limit: int = None, offset: int = 0):
+        return self.db.scan(start, end, reverse, limit, offset)
+
+    def prefix(self, prefix: str, reverse: bool = False, limit: int = None, offset: int = 0):
+        return self.db.prefix(prefix, reverse, limit, offset)
+
+    def scan_page(self, cursor: str = None, count: int = 100, start: str = None,
+                  end: str = None):
+        return self.db.scan_page(cursor, count, start, end)
+
+    def getDB(self):
+        return self.db.getDB()
+
+    def close(self):
+        self.closed = True
+        if self.socket != None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.thread.join()
+        self.db.close()
@@ -0,0 +1,181 @@
+import asyncio
+from protocol import OK, ProtocolError, encode_error, encode_integer, encode_value, \
+    parse_command
+
+'''
+asyncio network server for SimpleDB, speaking the protocol of protocol.py
+
+Commands:
+    GET key [transactionId]
+    PUT key value [transactionId]
+    DELETE key [transactionId]
+    INCR key [amount [transactionId]]
+    DECR key [amount [transactionId]]
+    APPEND key value [transactionId]
+    CAS key expected value [transactionId]     reply 1 if set, 0 if not
+    GETSET key value [transactionId]
+    SETNX key value [transactionId]            reply 1 if set, 0 if not
+    BEGIN transactionId
+    COMMIT transactionId
+    ROLLBACK transactionId
+    PING
+
+Values are sent and replied with their type (protocol.py), str, bytes, int or
+float.
+
+Pipelining: every request found in one read is run in order and all their
+replies are sent with one write.
+Backpressure: nothing more is read from a connection until its replies are
+drained to the socket, and a long pipeline is flushed every OUTPUT_LIMIT bytes
+of replies, so a client that does not read its replies stop being served
+instead of growing buffers.
+
+Commands run on the event loop thread one after the other, the database does
+not need thread_safe mode. Transactions a connection began and did not finish
+are rolled back when it closes.
+'''
+
+READ_SIZE = 64 * 1024
+OUTPUT_LIMIT = 256 * 1024
+
+# Command name: (lowest, highest) number of arguments
+COMMANDS = {
+    'GET': (1, 2),
+    'PUT': (2, 3),
+    'DELETE': (1, 2),
+    'INCR': (1, 3),
+    'DECR': (1, 3),
+    'APPEND': (2, 3),
+    'CAS': (3, 4),
+    'GETSET': (2, 3),
+    'SETNX': (2, 3),
+    'BEGIN': (1, 1),
+    'COMMIT': (1, 1),
+    'ROLLBACK': (1, 1),
+    'PING': (0, 0),
+}
+
+
+class Server(object):
+    def __init__(self, db, host: str = '127.0.0.1', port: int = 6380):
+        self.db = db
+        self.host = host
+        self.port = port
+        self.server = None
+        # Open connections as {writer: task serving it}
+        self.connections = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port,
+                                                 limit=READ_SIZE)
+        # Port 0 pick a free port, report the one actually bound
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self.server == None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server != None:
+            self.server.close()
+            await self.server.wait_closed()
+        tasks = list(self.connections.values())
+        for writer in list(self.connections):
+            writer.close()
+        # Let every handler see its connection close and roll back
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        # Transactions begun on this connection and not finished yet
+        transactions = set()
+        self.connections[writer] = asyncio.current_task()
+        buffer = bytearray()
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    return
+                buffer += data
+                offset = 0
+                replies = []
+                output = 0
+                while True:
+                    try:
+                        parsed = parse_command(buffer, offset)
+                    except (ProtocolError, UnicodeDecodeError) as error:
+                        replies.append(encode_error(error))
+                        writer.write(b''.join(replies))
+                        await writer.drain()
+                        return
+                    if parsed == None:
+                        break
+                    args, offset = parsed
+                    reply = self.execute(args, transactions)
+                    replies.append(reply)
+                    output += len(reply)
+                    if output >= OUTPUT_LIMIT:
+                        writer.write(b''.join(replies))
+                        replies = []
+                        output = 0
+                        await writer.drain()
+                del buffer[:offset]
+                if replies:
+                    writer.write(b''.join(replies))
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self.connections[writer]
+            for transactionId in transactions:
+                if transactionId in self.db.transaction:
+                    self.db.rollbackTransaction(transactionId)
+            writer.close()
+
+    # Run one request, return its encoded reply
+    def execute(self, args, transactions):
+        if type(args[0]) != str:
+            return encode_error(TypeError("Error, command name must be a str"))
+        name = args[0].upper()
+        arity = COMMANDS.get(name)
+        if arity == None:
+            return encode_error(Exception("Error, unknown command %s" % args[0]))
+        if not arity[0] <= len(args) - 1 <= arity[1]:
+            return encode_error(Exception("Error, wrong number of arguments for %s" % name))
+        try:
+            if name == 'GET':
+                return encode_value(self.db.get(*args[1:]))
+            if name == 'INCR' or name == 'DECR':
+                amount = int(args[2]) if len(args) > 2 else 1
+                method = self.db.incr if name == 'INCR' else self.db.decr
+                return encode_value(method(args[1], amount, *args[3:]))
+            if name == 'APPEND' or name == 'GETSET':
+                method = self.db.append if name == 'APPEND' else self.db.getset
+                return encode_value(method(*args[1:]))
+            if name == 'CAS' or name == 'SETNX':
+                method = self.db.cas if name == 'CAS' else self.db.setnx
+                return encode_integer(int(method(*args[1:])))
+            if name == 'PUT':
+                self.db.put(*args[1:])
+            elif name == 'DELETE':
+                self.db.delete(*args[1:])
+            elif name == 'BEGIN':
+                self.db.createTransaction(args[1])
+                transactions.add(args[1])
+            elif name == 'COMMIT':
+                transactions.discard(args[1])
+                self.db.commitTransaction(args[1])
+            elif name == 'ROLLBACK':
+                transactions.discard(args[1])
+                self.db.rollbackTransaction(args[1])
+            return OK
+        except Exception as error:
+            return encode_error(error)
+
+
+if __name__ == '__main__':
+    import sys
+    from db import SimpleDB
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 6380
+    asyncio.run(Server(SimpleDB(), '127.0.0.1', port).serve_forever())
@@ -0,0 +1,387 @@
+import multiprocessing
+import os
+import threading
+import uuid
+import zlib
+from helper import checkStr, checkAllStr
+from codec import VALUE_TYPES, check_value
+
+'''
+Sharded SimpleDB over a pool of worker processes
+
+Keys are hash partitioned (crc32, stable across restarts) across shards worker
+processes, each owning its own SimpleDB, so shards run on separate cores
+instead of sharing one GIL. The front-end talks to every worker over a pipe:
+a message is a batch of calls and the reply the batch of their results, calls
+for several shards are sent to all of them before any reply is read so the
+shards work in parallel.
+
+Transactions begin on a shard the first time they touch one of its keys, and
+read from that shard's snapshot taken then. A transaction that touched one
+shard commits with commitTransaction as before. One that touched several uses
+two-phase commit: prepareTransaction validates and holds its keys on every
+shard, then commitTransaction applies on all of them, or the prepared ones are
+rolled back if any shard failed to prepare. Keys merged into (incr, append)
+are held and checked at prepare too. Should a shard still fail to apply, the
+transaction raises PartialCommitError telling which shards committed.
+'''
+
+# SimpleDB methods a worker run
+WORKER_METHODS = {
+    'get', 'put', 'delete', 'get_many', 'put_many', 'delete_many', 'getDB',
+    'incr', 'decr', 'append', 'cas', 'getset', 'setnx',
+    'createTransaction', 'prepareTransaction', 'commitTransaction',
+    'rollbackTransaction', 'get_ttl', 'expire_cycle', 'save_snapshot',
+}
+
+# Options holding a file path, each shard get its own file suffixed with its index
+PATH_OPTIONS = ('wal_path', 'snapshot_path')
+
+
+class PartialCommitError(Exception):
+    '''
+    A transaction over several shards committed on some of them only: committed
+    holds their indexes, failed the error of every other shard as {shard: error}.
+    '''
+
+    def __init__(self, transactionId: str, committed, failed):
+        super().__init__("Error, transaction %s partially committed: shards %s committed, shards %s failed (%s)"
+                         % (transactionId, committed, sorted(failed),
+                            '; '.join(str(error) for error in failed.values())))
+        self.committed = committed
+        self.failed = failed
+
+
+# Values are pickled to the shard processes, a memoryview can not be
+def shard_value(value):
+    value = check_value(value)
+    return value.tobytes() if type(value) == memoryview else value
+
+
+def serve_shard(connection, options):
+    # Imported here so the worker build its database after the fork
+    from db import SimpleDB
+    db = SimpleDB(**options)
+    try:
+        while True:
+            try:
+                batch = connection.recv()
+            except EOFError:
+                return
+            if batch == None:
+                return
+            results = []
+            for name, args in batch:
+                try:
+                    if name not in WORKER_METHODS:
+                        raise Exception("Error, unknown method %s" % name)
+                    results.append((True, getattr(db, name)(*args)))
+                except Exception as error:
+                    results.append((False, error))
+            connection.send(results)
+    finally:
+        db.close()
+
+
+class ShardedDB(object):
+    def __init__(self, shards: int = None, **options):
+        if shards == None:
+            shards = os.cpu_count() or 1
+        if shards < 1:
+            raise ValueError("Error, shards must be at least 1")
+        self.shards = shards
+        self.connections = []
+        self.processes = []
+        # One request at a time per pipe, batches for several shards take the
+        # locks in ascending order
+        self.locks = [threading.Lock() for _ in range(shards)]
+        # Shards each open transaction has begun on as {transactionId: set}
+        self.transactions = {}
+        self.transaction_lock = threading.Lock()
+        for shard in range(shards):
+            shard_options = dict(options)
+            for name in PATH_OPTIONS:
+                if shard_options.get(name) != None:
+                    shard_options[name] = '%s.%d' % (shard_options[name], shard)
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve_shard, args=(child, shard_options),
+                                              daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for shard, connection in enumerate(self.connections):
+            with self.locks[shard]:
+                try:
+                    connection.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+        for process in self.processes:
+            process.join()
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.processes = []
+
+    def shard_of(self, key: str):
+        return zlib.crc32(key.encode('utf-8')) % self.shards
+
+    '''
+    Send batches {shard: [(method, args)]} to their shards at once, return
+    {shard: [(ok, result)]} once every shard replied
+    '''
+
+    def run(self, batches):
+        shards = sorted(batches)
+        for shard in shards:
+            self.locks[shard].acquire()
+        try:
+            for shard in shards:
+                self.connections[shard].send(batches[shard])
+            return {shard: self.connections[shard].recv() for shard in shards}
+        finally:
+            for shard in reversed(shards):
+                self.locks[shard].release()
+
+    # Run one call on shard, return its result or raise its exception
+    def call(self, shard: int, name: str, *args):
+        ok, result = self.run({shard: [(name, args)]})[shard][0]
+        if not ok:
+            raise result
+        return result
+
+    # Prefix the batch of a transaction with its begin on shards it has not
+    # touched yet, return {shard: (batch, begun)}
+    def transaction_batches(self, transactionId: str, batches):
+        with self.transaction_lock:
+            if transactionId not in self.transactions:
+                raise Exception("Error, transactionId not in db")
+            begun = self.transactions[transactionId]
+            new_shards = [shard for shard in batches if shard not in begun]
+            begun.update(new_shards)
+        for shard in new_shards:
+            batches[shard].insert(0, ('createTransaction', (transactionId,)))
+        return batches, set(new_shards)
+
+    # Run batches within a transaction, return {shard: [result]} without the
+    # result of the begin calls, raise the first error
+    def run_transaction(self, transactionId: str, batches):
+        batches, new_shards = self.transaction_batches(transactionId, batches)
+        replies = self.run(batches)
+        results = {}
+        error = None
+        for shard, shard_results in replies.items():
+            if shard in new_shards:
+                shard_results = shard_results[1:]
+            for ok, result in shard_results:
+                if not ok and error == None:
+                    error = result
+            results[shard] = [result for _, result in shard_results]
+        if error != None:
+            raise error
+        return results
+
+    def group(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.shard_of(key), []).append(key)
+        return groups
+
+    def get(self, key: str, transactionId: str = None):
+        if not checkStr(key):
+            raise TypeError
+        shard = self.shard_of(key)
+        if transactionId == None:
+            return self.call(shard, 'get', key)
+        return self.run_transaction(transactionId, {
+            shard: [('get', (key, transactionId))]})[shard][0]
+
+    def put(self, key: str, value: str, transactionId: str = None, ttl: float = None):
+        if not checkStr(key):
+            raise TypeError
+        if type(value) not in VALUE_TYPES:
+            value = shard_value(value)
+        shard = self.shard_of(key)
+        if transactionId == None:
+            self.call(shard, 'put', key, value, None, ttl)
+        else:
+            self.run_transaction(transactionId, {
+                shard: [('put', (key, value, transactionId, ttl))]})
+
+    def delete(self, key: str, transactionId: str = None):
+        if not checkStr(key):
+            raise TypeError
+        shard = self.shard_of(key)
+        if transactionId == None:
+            self.call(shard, 'delete', key)
+        else:
+            self.run_transaction(transactionId, {
+                shard: [('delete', (key, transactionId))]})
+
+    # Run a method of the key's shard, within transactionId when given. args
+    # are the arguments between the key and transactionId, extra the ones
+    # after it.
+    def call_key(self, method: str, key: str, args=(), transactionId: str = None, extra=()):
+        if not checkStr(key):
+            raise TypeError
+        shard = self.shard_of(key)
+        if transactionId == None:
+            return self.call(shard, method, key, *args, None, *extra)
+        return self.run_transaction(transactionId, {
+            shard: [(method, (key,) + tuple(args) + (transactionId,) + tuple(extra))]})[shard][0]
+
+    def incr(self, key: str, amount: int = 1, transactionId: str = None):
+        return self.call_key('incr', key, (amount,), transactionId)
+
+    def decr(self, key: str, amount: int = 1, transactionId: str = None):
+        return self.call_key('decr', key, (amount,), transactionId)
+
+    def append(self, key: str, value: str, transactionId: str = None):
+        return self.call_key('append', key, (shard_value(value),), transactionId)
+
+    def cas(self, key: str, expected, value, transactionId: str = None, ttl: float = None):
+        if expected is not None:
+            expected = shard_value(expected)
+        return self.call_key('cas', key, (expected, shard_value(value)), transactionId, (ttl,))
+
+    def getset(self, key: str, value, transactionId: str = None, ttl: float = None):
+        return self.call_key('getset', key, (shard_value(value),), transactionId, (ttl,))
+
+    def setnx(self, key: str, value, transactionId: str = None, ttl: float = None):
+        return self.call_key('setnx', key, (shard_value(value),), transactionId, (ttl,))
+
+    def get_many(self, keys, transactionId: str = None):
+        keys = list(keys)
+        if not checkAllStr(keys):
+            raise TypeError
+        groups = self.group(keys)
+        batches = {shard: [('get_many', (shard_keys, transactionId))]
+                   for shard, shard_keys in groups.items()}
+        if transactionId == None:
+            results = {}
+            for shard, [(ok, result)] in self.run(batches).items():
+                if not ok:
+                    raise result
+                results[shard] = [result]
+        else:
+            results = self.run_transaction(transactionId, batches)
+        values = {}
+        for shard, shard_keys in groups.items():
+            values.update(zip(shard_keys, results[shard][0]))
+        return [values[key] for key in keys]
+
+    # A write batch over several shards without transaction still commit
+    # atomically, through a transaction of its own
+    def write_many(self, method: str, keys, args, transactionId: str = None):
+        groups = self.group(keys)
+        if transactionId == None and len(groups) <= 1:
+            for shard in groups:
+                self.call(shard, method, *args(groups[shard]), None)
+            return
+        own_transaction = transactionId == None
+        if own_transaction:
+            transactionId = str(uuid.uuid4())
+            self.createTransaction(transactionId)
+        try:
+            self.run_transaction(transactionId, {
+                shard: [(method, args(shard_keys) + (transactionId,))]
+                for shard, shard_keys in groups.items()})
+        except Exception:
+            if own_transaction:
+                self.rollbackTransaction(transactionId)
+            raise
+        if own_transaction:
+            self.commitTransaction(transactionId)
+
+    def put_many(self, items, transactionId: str = None):
+        items = dict(items)
+        if not checkAllStr(items):
+            raise TypeError
+        if not set(map(type, items.values())) <= VALUE_TYPES:
+            items = {key: shard_value(value) for key, value in items.items()}
+        self.write_many('put_many', list(items),
+                        lambda keys: ({key: items[key] for key in keys},), transactionId)
+
+    def delete_many(self, keys, transactionId: str = None):
+        keys = list(keys)
+        if not checkAllStr(keys):
+            raise TypeError
+        self.write_many('delete_many', keys, lambda keys: (keys,), transactionId)
+
+    # Merged data of every shard
+    def getDB(self):
+        data = {}
+        for ok, result in (replies[0] for replies in self.run(
+                {shard: [('getDB', ())] for shard in range(self.shards)}).values()):
+            if not ok:
+                raise result
+            data.update(result)
+        return data
+
+    def createTransaction(self, transactionId: str):
+        if not checkStr(transactionId):
+            raise TypeError
+        with self.transaction_lock:
+            if transactionId in self.transactions:
+                raise Exception("Error, Transaction Key already exists")
+            self.transactions[transactionId] = set()
+
+    def end_transaction(self, transactionId: str):
+        with self.transaction_lock:
+            if transactionId not in self.transactions:
+                raise Exception("Error, transactionId not in db")
+            return self.transactions.pop(transactionId)
+
+    def rollbackTransaction(self, transactionId: str):
+        if not checkStr(transactionId):
+            raise TypeError
+        shards = self.end_transaction(transactionId)
+        self.run({shard: [('rollbackTransaction', (transactionId,))] for shard in shards})
+
+    def commitTransaction(self, transactionId: str):
+        if not checkStr(transactionId):
+            raise TypeError
+        shards = self.end_transaction(transactionId)
+        if len(shards) == 1:
+            self.call(shards.pop(), 'commitTransaction', transactionId)
+            return
+        if not shards:
+            return
+
+        # Phase one, a shard that fail to prepare has already rolled back
+        prepared = []
+        error = None
+        for shard, [(ok, result)] in self.run(
+                {shard: [('prepareTransaction', (transactionId,))] for shard in shards}).items():
+            if ok:
+                prepared.append(shard)
+            elif error == None:
+                error = result
+        if error != None:
+            self.run({shard: [('rollbackTransaction', (transactionId,))] for shard in prepared})
+            raise Exception('Transaction Commit Fail')
+
+        # Phase two, prepared transactions can not conflict any more but a shard
+        # can still fail to apply (write-ahead log...). Failed ones are rolled back
+        # so they do not hold their keys, the outcome is then partial.
+        committed = []
+        failed = {}
+        for shard, [(ok, result)] in self.run(
+                {shard: [('commitTransaction', (transactionId,))] for shard in shards}).items():
+            if ok:
+                committed.append(shard)
+            else:
+                failed[shard] = result
+        if failed:
+            self.run({shard: [('rollbackTransaction', (transactionId,))] for shard in failed})
+            if not committed:
+                raise Exception('Transaction Commit Fail')
+            raise PartialCommitError(transactionId, sorted(committed), failed)
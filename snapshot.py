@@ -0,0 +1,149 @@
+import mmap
+import os
+import struct
+from array import array
+from codec import decode_value, encode_value
+from helper import checkAllStr
+
+'''
+Point-in-time snapshot file
+
+    header:  magic, flags (uint32), commit_seq (uint64), count (uint64),
+             keys length (uint64), values length (uint64),
+             expire count (uint64), expires length (uint64)
+    keys:    every key utf-8
+    values:  every value utf-8, in the same order as keys
+    expires: uint32 byte lengths and utf-8 of the keys with a TTL, then their
+             deadlines as float64
+
+When no key or value contain '\0' (FLAG_SEPARATED), keys and values are joined
+with '\0' and are split back in one call on load. Otherwise each block start
+with an array of uint32 byte lengths, one per entry.
+
+When a value is not a str (FLAG_TYPED, see codec.py) the values block start
+with the uint8 type of every value, then their lengths and bytes; only keys
+are then joined when FLAG_SEPARATED.
+
+Loading map the file instead of reading it, keys and values are decoded
+straight out of the mapping.
+'''
+
+MAGIC = b'SDBSNAP2'
+FLAG_SEPARATED = 1
+FLAG_TYPED = 2
+
+HEADER = struct.Struct('<8sIQQQQQQ')
+SEPARATOR = '\0'
+
+
+# Write data {key: value} and the deadlines {key: deadline} of keys with a TTL
+# as of commit_seq to path, atomically replace any existing snapshot
+def write_snapshot(path: str, data, commit_seq: int, expires=None):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as snapshot_file:
+        for block in encode_snapshot(data, commit_seq, expires):
+            snapshot_file.write(block)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temp_path, path)
+
+
+# Blocks of bytes making the snapshot of data, see write_snapshot
+def encode_snapshot(data, commit_seq: int, expires=None):
+    keys = list(data)
+    values = [data[key] for key in keys]
+    typed = not checkAllStr(values)
+    keys_text = SEPARATOR.join(keys)
+    values_text = '' if typed else SEPARATOR.join(values)
+    # Joined text contain exactly one separator less than entries unless a key or
+    # value has one of its own
+    separated = (keys_text.count(SEPARATOR) == len(keys) - 1 or not keys) and \
+        (typed or values_text.count(SEPARATOR) == len(values) - 1 or not values)
+
+    if separated:
+        flags = FLAG_SEPARATED
+        keys_block = keys_text.encode('utf-8')
+        values_block = values_text.encode('utf-8')
+    else:
+        flags = 0
+        keys_block = _length_prefixed([key.encode('utf-8') for key in keys])
+        values_block = b'' if typed else \
+            _length_prefixed([value.encode('utf-8') for value in values])
+    if typed:
+        flags |= FLAG_TYPED
+        tags, encoded = zip(*map(encode_value, values))
+        values_block = bytes(tags) + _length_prefixed(encoded)
+
+    expires = expires or {}
+    expires_block = _length_prefixed([key.encode('utf-8') for key in expires]) + \
+        array('d', expires.values()).tobytes()
+
+    header = HEADER.pack(MAGIC, flags, commit_seq, len(keys), len(keys_block),
+                         len(values_block), len(expires), len(expires_block))
+    return [header, keys_block, values_block, expires_block]
+
+
+def _length_prefixed(encoded):
+    lengths = array('I', map(len, encoded))
+    return lengths.tobytes() + b''.join(encoded)
+
+
+# Return (commit_seq, {key: value}, {key: deadline}) from the snapshot at path
+def load_snapshot(path: str):
+    with open(path, 'rb') as snapshot_file:
+        if os.fstat(snapshot_file.fileno()).st_size < HEADER.size:
+            raise ValueError("Error, %s is not a snapshot" % path)
+        with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                return _decode(view, path)
+            finally:
+                view.release()
+
+
+def _decode(view, path: str):
+    magic, flags, commit_seq, count, keys_length, values_length, \
+        expire_count, expires_length = HEADER.unpack_from(view)
+    values_start = HEADER.size + keys_length
+    expires_start = values_start + values_length
+    if magic != MAGIC or len(view) != expires_start + expires_length:
+        raise ValueError("Error, %s is not a snapshot" % path)
+    keys_block = view[HEADER.size:values_start]
+    values_block = view[values_start:expires_start]
+
+    expires = {}
+    if expire_count:
+        expires_block = view[expires_start:]
+        expire_keys = _split_length_prefixed(expires_block, expire_count)
+        deadlines = array('d')
+        deadlines.frombytes(expires_block[-expire_count * deadlines.itemsize:])
+        expires = dict(zip(expire_keys, deadlines))
+    if count == 0:
+        return commit_seq, {}, expires
+
+    if flags & FLAG_SEPARATED:
+        keys = str(keys_block, 'utf-8').split(SEPARATOR)
+    else:
+        keys = _split_length_prefixed(keys_block, count)
+    if flags & FLAG_TYPED:
+        values = _split_length_prefixed(values_block[count:], count, values_block[:count])
+    elif flags & FLAG_SEPARATED:
+        values = str(values_block, 'utf-8').split(SEPARATOR)
+    else:
+        values = _split_length_prefixed(values_block, count)
+    if len(keys) != count or len(values) != count:
+        raise ValueError("Error, %s is corrupted" % path)
+    return commit_seq, dict(zip(keys, values)), expires
+
+
+# Entries of a length prefixed block, utf-8 or of the codec types tags
+def _split_length_prefixed(block, count: int, tags=None):
+    lengths = array('I')
+    lengths.frombytes(block[:count * 4])
+    entries = []
+    offset = count * 4
+    for i, length in enumerate(lengths):
+        data = block[offset:offset + length]
+        entries.append(str(data, 'utf-8') if tags == None else decode_value(tags[i], data))
+        offset += length
+    return entries
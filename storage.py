@@ -0,0 +1,380 @@
+import struct
+import threading
+import zlib
+from array import array
+from collections.abc import MutableMapping
+from codec import TYPE_STR, decode_value, encode_value
+from tiered import TieredStore, TieredVersionView
+
+'''
+Compact storage
+
+ArenaStore is a drop-in replacement for the dicts holding db and its versions
+(db_transaction_id). It is an open addressing hash table whose slots are three
+arrays: where the key's record start in one bytearray arena, a fragment of the
+key's hash, and the key's version. No Python object is kept per key.
+
+A record is the header (key length, payload length, flags), the utf-8 key then
+the payload: the value's bytes (codec.py, its type in the flags above
+TYPE_SHIFT), their zlib compression (COMPRESSED) or the offset of a shared
+value (INTERNED).
+
+Arena space is handed out in power-of-two size classes of at least MIN_CAPACITY
+bytes, so offsets are multiples of it and stored divided by it. Freed space
+goes on a free list per class and is reused by the next record of that class, a
+record rewritten within its class is overwritten in place.
+
+Values up to intern_max bytes are interned: equal values share one copy with a
+reference count. It only pays off for values repeated across many keys, it is
+off by default. Values from compress_min bytes are compressed when that make
+them smaller. Both are transparent to get and put.
+'''
+
+MIN_CAPACITY = 16
+
+COMPRESSED = 1
+INTERNED = 2
+TYPE_SHIFT = 2
+
+HEADER = struct.Struct('<IIB')
+SHARED_LENGTH = struct.Struct('<I')
+SHARED_OFFSET = struct.Struct('<q')
+
+# Slot states in offsets, live slots hold the record offset / MIN_CAPACITY
+EMPTY = -1
+DELETED = -2
+HASH_MASK = 0x7FFFFFFF
+
+
+def capacity_of(length: int):
+    return max(MIN_CAPACITY, 1 << (length - 1).bit_length())
+
+
+class ArenaStore(MutableMapping):
+    def __init__(self, data=None, intern_max: int = 0, compress_min: int = 512):
+        self.intern_max = intern_max
+        self.compress_min = compress_min
+        self.arena = bytearray()
+        # Offsets of freed space per capacity
+        self.free = {}
+        # Interned values as {utf-8 bytes: offset} and their reference counts
+        # as {offset: count}
+        self.interned = {}
+        self.references = {}
+        # Writers on different key stripes share the table
+        self.lock = threading.RLock()
+        self.offsets = None
+        self.resize(8)
+        if data:
+            self.update(data)
+
+    # Rebuild the slots with room for capacity keys, dropping deleted ones
+    def resize(self, capacity: int):
+        old_offsets = self.offsets
+        if old_offsets != None:
+            old_hashes = self.hashes
+            old_versions = self.versions
+        self.offsets = array('i', [EMPTY]) * capacity
+        self.hashes = array('i', [0]) * capacity
+        self.versions = array('q', [0]) * capacity
+        self.mask = capacity - 1
+        self.count = 0
+        # Live and deleted slots, kept under 2 / 3 of capacity
+        self.filled = 0
+        if old_offsets == None:
+            return
+        for slot, unit in enumerate(old_offsets):
+            if unit >= 0:
+                i = old_hashes[slot] & self.mask
+                while self.offsets[i] != EMPTY:
+                    i = (i + 1) & self.mask
+                self.offsets[i] = unit
+                self.hashes[i] = old_hashes[slot]
+                self.versions[i] = old_versions[slot]
+                self.count += 1
+                self.filled += 1
+
+    def __len__(self):
+        return self.count
+
+    # Slot holding key, -1 when it is not in the table
+    def find(self, key: str):
+        key_bytes = key.encode('utf-8')
+        fragment = hash(key) & HASH_MASK
+        offsets = self.offsets
+        i = fragment & self.mask
+        while True:
+            unit = offsets[i]
+            if unit == EMPTY:
+                return -1
+            if unit >= 0 and self.hashes[i] == fragment:
+                offset = unit * MIN_CAPACITY
+                key_length = HEADER.unpack_from(self.arena, offset)[0]
+                start = offset + HEADER.size
+                if self.arena[start:start + key_length] == key_bytes:
+                    return i
+            i = (i + 1) & self.mask
+
+    def __contains__(self, key):
+        if type(key) != str:
+            return False
+        with self.lock:
+            return self.find(key) >= 0
+
+    def __getitem__(self, key):
+        with self.lock:
+            i = self.find(key)
+            if i < 0:
+                raise KeyError(key)
+            return self.read_value(self.offsets[i] * MIN_CAPACITY)
+
+    def get(self, key, default=None):
+        with self.lock:
+            i = self.find(key)
+            if i < 0:
+                return default
+            return self.read_value(self.offsets[i] * MIN_CAPACITY)
+
+    def read_value(self, offset: int):
+        key_length, length, flags = HEADER.unpack_from(self.arena, offset)
+        start = offset + HEADER.size + key_length
+        if flags & INTERNED:
+            start = SHARED_OFFSET.unpack_from(self.arena, start)[0]
+            length = SHARED_LENGTH.unpack_from(self.arena, start)[0]
+            start += SHARED_LENGTH.size
+        data = self.arena[start:start + length]
+        if flags & COMPRESSED:
+            data = zlib.decompress(data)
+        tag = flags >> TYPE_SHIFT
+        if tag == TYPE_STR:
+            return data.decode('utf-8')
+        return decode_value(tag, data)
+
+    def read_key(self, offset: int):
+        key_length = HEADER.unpack_from(self.arena, offset)[0]
+        start = offset + HEADER.size
+        return self.arena[start:start + key_length].decode('utf-8')
+
+    def __setitem__(self, key, value):
+        key_bytes = key.encode('utf-8')
+        if type(value) == str:
+            payload = value.encode('utf-8')
+            type_flags = 0
+        else:
+            tag, payload = encode_value(value)
+            type_flags = tag << TYPE_SHIFT
+        flags = 0
+        if len(payload) >= self.compress_min:
+            compressed = zlib.compress(payload, 1)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags = COMPRESSED
+        with self.lock:
+            if flags == 0 and len(payload) <= self.intern_max:
+                payload = SHARED_OFFSET.pack(self.intern(bytes(payload)))
+                flags = INTERNED
+            flags |= type_flags
+            record = HEADER.pack(len(key_bytes), len(payload), flags) + key_bytes + payload
+            i = self.find(key)
+            if i >= 0:
+                offset = self.offsets[i] * MIN_CAPACITY
+                old_length = self.record_length(offset)
+                self.release_shared(offset)
+                if capacity_of(old_length) == capacity_of(len(record)):
+                    # Same size class, overwrite in place
+                    self.arena[offset:offset + len(record)] = record
+                    return
+                self.free_space(offset, old_length)
+                self.offsets[i] = self.allocate(record) // MIN_CAPACITY
+                return
+            if (self.filled + 1) * 3 > len(self.offsets) * 2:
+                self.resize(capacity_of(max(self.count * 3, 8)))
+            fragment = hash(key) & HASH_MASK
+            i = fragment & self.mask
+            while self.offsets[i] >= 0:
+                i = (i + 1) & self.mask
+            if self.offsets[i] == EMPTY:
+                self.filled += 1
+            self.offsets[i] = self.allocate(record) // MIN_CAPACITY
+            self.hashes[i] = fragment
+            self.versions[i] = 0
+            self.count += 1
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key, *default):
+        with self.lock:
+            i = self.find(key)
+            if i < 0:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            offset = self.offsets[i] * MIN_CAPACITY
+            value = self.read_value(offset)
+            self.release_shared(offset)
+            self.free_space(offset, self.record_length(offset))
+            self.offsets[i] = DELETED
+            self.count -= 1
+            return value
+
+    def __iter__(self):
+        return iter(self.keys_list())
+
+    def keys_list(self):
+        with self.lock:
+            return [self.read_key(unit * MIN_CAPACITY) for unit in self.offsets if unit >= 0]
+
+    def items(self):
+        with self.lock:
+            return [(self.read_key(unit * MIN_CAPACITY), self.read_value(unit * MIN_CAPACITY))
+                    for unit in self.offsets if unit >= 0]
+
+    def record_length(self, offset: int):
+        key_length, length, _ = HEADER.unpack_from(self.arena, offset)
+        return HEADER.size + key_length + length
+
+    # Copy data into free space of its size class, or at the end of the arena,
+    # return its offset. Called with the lock held.
+    def allocate(self, data):
+        capacity = capacity_of(len(data))
+        free = self.free.get(capacity)
+        if free:
+            offset = free.pop()
+            self.arena[offset:offset + len(data)] = data
+        else:
+            offset = len(self.arena)
+            self.arena += data
+            self.arena += bytes(capacity - len(data))
+        return offset
+
+    def free_space(self, offset: int, length: int):
+        self.free.setdefault(capacity_of(length), []).append(offset)
+
+    # Offset of the shared copy of data, with one more reference
+    def intern(self, data):
+        offset = self.interned.get(data)
+        if offset == None:
+            offset = self.allocate(SHARED_LENGTH.pack(len(data)) + data)
+            self.interned[data] = offset
+        self.references[offset] = self.references.get(offset, 0) + 1
+        return offset
+
+    # Drop the reference the record at offset hold on a shared value
+    def release_shared(self, offset: int):
+        key_length, _, flags = HEADER.unpack_from(self.arena, offset)
+        if not flags & INTERNED:
+            return
+        shared = SHARED_OFFSET.unpack_from(self.arena, offset + HEADER.size + key_length)[0]
+        self.references[shared] -= 1
+        if self.references[shared]:
+            return
+        del self.references[shared]
+        length = SHARED_LENGTH.unpack_from(self.arena, shared)[0]
+        start = shared + SHARED_LENGTH.size
+        del self.interned[bytes(self.arena[start:start + length])]
+        self.free_space(shared, SHARED_LENGTH.size + length)
+
+    def stats(self):
+        free_bytes = sum(capacity * len(offsets) for capacity, offsets in self.free.items())
+        return {
+            'keys': self.count,
+            'slots': len(self.offsets),
+            'arena_bytes': len(self.arena),
+            'free_bytes': free_bytes,
+            'interned_values': len(self.interned),
+        }
+
+
+class VersionView(MutableMapping):
+    '''
+    db_transaction_id of an ArenaStore: the version of every key kept in the
+    table's version array. A version exists exactly while its key does, so
+    setting the version of a missing key raise KeyError and removing a version
+    leave it to the key's own removal.
+    '''
+
+    def __init__(self, store: ArenaStore):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __getitem__(self, key):
+        with self.store.lock:
+            i = self.store.find(key)
+            if i < 0:
+                raise KeyError(key)
+            return self.store.versions[i]
+
+    def get(self, key, default=None):
+        with self.store.lock:
+            i = self.store.find(key)
+            return default if i < 0 else self.store.versions[i]
+
+    def __setitem__(self, key, version: int):
+        with self.store.lock:
+            i = self.store.find(key)
+            if i < 0:
+                raise KeyError(key)
+            self.store.versions[i] = version
+
+    def __delitem__(self, key):
+        if key not in self.store:
+            raise KeyError(key)
+
+    def pop(self, key, *default):
+        version = self.get(key)
+        if version == None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return version
+
+
+STORAGE_BACKENDS = ('dict', 'arena', 'tiered')
+
+
+# Mapping holding db for the storage option of SimpleDB, filled with data
+def make_storage(storage, data=None):
+    if isinstance(storage, (ArenaStore, TieredStore)):
+        if data:
+            storage.update(data)
+        return storage
+    if storage == 'dict':
+        return {} if data == None else data
+    if storage == 'arena':
+        return ArenaStore(data)
+    if storage == 'tiered':
+        return TieredStore(data=data)
+    raise ValueError("Error, storage must be one of %s" % ', '.join(STORAGE_BACKENDS))
+
+
+# db_transaction_id for db, every key stamped with version
+def version_map(db, version: int = None):
+    if isinstance(db, ArenaStore):
+        if version != None:
+            db.versions = array('q', [version]) * len(db.versions)
+        return VersionView(db)
+    if isinstance(db, TieredStore):
+        if version != None:
+            db.set_all_versions(version)
+        return TieredVersionView(db)
+    return dict.fromkeys(db, version)
+
+
+# Release what the storage holds outside memory
+def close_storage(db):
+    if isinstance(db, TieredStore):
+        db.close()
+
+
+# Whether a forked child can read db, a sqlite connection must not cross a fork
+def forkable(db):
+    return not isinstance(db, TieredStore)
@@ -0,0 +1,50 @@
+import threading
+
+
+class StripedLock(object):
+    '''
+    Fixed pool of locks, a key is guarded by the lock at hash(key) % stripes.
+    Keys on different stripes can be written by different threads at the same
+    time, while one commit still hold every key it touch.
+    '''
+
+    def __init__(self, stripes: int = 64):
+        if stripes < 1:
+            raise ValueError("Error, stripes must be at least 1")
+        self.stripes = stripes
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    # Lock guarding a single key
+    def for_key(self, key):
+        return self.locks[hash(key) % self.stripes]
+
+    # Context manager holding the locks of all keys
+    def hold(self, keys):
+        return _HeldStripes(self, {hash(key) % self.stripes for key in keys})
+
+    # Context manager holding every stripe, nothing else can commit meanwhile
+    def hold_all(self):
+        return _HeldStripes(self, range(self.stripes))
+
+
+class _HeldStripes(object):
+    def __init__(self, striped_lock: StripedLock, stripes):
+        # Always lock in ascending order so two commits can not deadlock
+        self.locks = [striped_lock.locks[i] for i in sorted(stripes)]
+
+    def __enter__(self):
+        acquired = []
+        try:
+            for lock in self.locks:
+                lock.acquire()
+                acquired.append(lock)
+        except BaseException:
+            for lock in reversed(acquired):
+                lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self.locks):
+            lock.release()
+        return False
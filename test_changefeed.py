@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+import unittest
+from changefeed import Change, ChangeFeed
+
+
+class TestChangeFeed(unittest.TestCase):
+    def test_publish_in_order(self):
+        feed = ChangeFeed(capacity=8, next_seq=5)
+        feed.publish(6, {'b': 'bar'})
+        # 6 waits for 5
+        self.assertEqual(feed.read(4), [])
+        feed.publish(5, {'a': 'foo'}, ['c'])
+        self.assertEqual(feed.read(4), [Change(5, {'a': 'foo'}, ('c',)),
+                                        Change(6, {'b': 'bar'}, ())])
+        self.assertEqual(feed.read(5), [Change(6, {'b': 'bar'}, ())])
+        self.assertEqual(feed.read(6), [])
+        self.assertEqual(feed.last_seq(), 6)
+
+    def test_ring(self):
+        feed = ChangeFeed(capacity=4)
+        for seq in range(1, 11):
+            feed.publish(seq, {'key': str(seq)})
+        self.assertEqual(feed.oldest_seq(), 7)
+        self.assertEqual([change.commit_seq for change in feed.changes(6)], [7, 8, 9, 10])
+        self.assertEqual([change.commit_seq for change in feed.read(8, 1)], [9])
+        with self.assertRaises(Exception):
+            feed.read(5)
+        with self.assertRaises(ValueError):
+            ChangeFeed(capacity=0)
+
+    def test_wait(self):
+        feed = ChangeFeed()
+        received = []
+
+        def consumer():
+            for change in feed.changes(0, wait=True, timeout=5):
+                received.append(change.commit_seq)
+                if change.commit_seq == 3:
+                    return
+
+        thread = threading.Thread(target=consumer)
+        thread.start()
+        for seq in range(1, 4):
+            feed.publish(seq, {'key': str(seq)})
+        thread.join()
+        self.assertEqual(received, [1, 2, 3])
+        self.assertEqual(list(feed.changes(3, wait=True, timeout=0.01)), [])
+
+    def test_async(self):
+        feed = ChangeFeed()
+
+        async def consume():
+            received = []
+            async for change in feed.changes_async(0):
+                received.append(change.commit_seq)
+                if change.commit_seq == 2:
+                    break
+            return received
+
+        async def run():
+            task = asyncio.ensure_future(consume())
+            await asyncio.sleep(0.01)
+            feed.publish(1, {'a': 'foo'})
+            # From another thread too
+            threading.Thread(target=feed.publish, args=(2, {'b': 'bar'})).start()
+            return await asyncio.wait_for(task, 5)
+
+        self.assertEqual(asyncio.run(run()), [1, 2])
+        self.assertEqual(feed.async_waiters, set())
+
+    def test_watch(self):
+        feed = ChangeFeed()
+        calls = []
+        done = threading.Event()
+
+        def failing(key, value, commit_seq):
+            raise Exception("Error, bad callback")
+
+        feed.watch(lambda *args: calls.append(('key',) + args), key='user:1')
+        feed.watch(lambda *args: calls.append(('prefix',) + args), prefix='user:')
+        watchId = feed.watch(failing)
+        feed.watch(lambda *args: done.set(), key='done')
+        feed.publish(1, {'user:1': 'foo', 'order:1': 'bar'})
+        feed.publish(2, {}, ['user:2'])
+        feed.publish(3, {'done': 'yes'})
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, [('key', 'user:1', 'foo', 1), ('prefix', 'user:1', 'foo', 1),
+                                 ('prefix', 'user:2', None, 2)])
+        self.assertEqual(feed.callback_errors, 4)
+        feed.unwatch(watchId)
+        with self.assertRaises(Exception):
+            feed.unwatch(watchId)
+        feed.close()
+        self.assertFalse(feed.dispatcher.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
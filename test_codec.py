@@ -0,0 +1,47 @@
+import unittest
+from codec import (TYPE_BYTES, TYPE_FLOAT, TYPE_INT, TYPE_STR, check_items, check_value,
+                   decode_value, encode_value, type_of)
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        for value in ('', 'välue', b'', b'\x00\xff', 0, -1, 127, 128, -129, 2 ** 100, -2 ** 100,
+                      0.0, -1.5, float('inf')):
+            tag, data = encode_value(value)
+            self.assertEqual(tag, type_of(value))
+            decoded = decode_value(tag, memoryview(bytes(data)))
+            self.assertEqual((type(decoded), decoded), (type(value), value))
+        self.assertEqual(encode_value(memoryview(b'abc')), (TYPE_BYTES, memoryview(b'abc')))
+        self.assertEqual([type_of(value) for value in ('a', b'a', 1, 1.0)],
+                         [TYPE_STR, TYPE_BYTES, TYPE_INT, TYPE_FLOAT])
+        with self.assertRaises(ValueError):
+            decode_value(9, b'')
+        with self.assertRaises(TypeError):
+            encode_value(None)
+
+    def test_check_value(self):
+        data = b'payload'
+        self.assertTrue(check_value(data) is data)
+        view = memoryview(data)[1:4]
+        # A view over bytes is kept, no copy
+        self.assertTrue(check_value(view) is view)
+        # Mutable buffers are copied
+        buffer = bytearray(b'abc')
+        checked = [check_value(value) for value in (buffer, memoryview(buffer),
+                                                    memoryview(data)[::2],
+                                                    memoryview(data).cast('c'))]
+        buffer[0] = ord('x')
+        self.assertEqual(checked, [b'abc', b'abc', b'pyod', b'payload'])
+        self.assertEqual(set(map(type, checked)), {bytes})
+        for value in (None, True, [1], {'a': 1}):
+            with self.assertRaises(TypeError):
+                check_value(value)
+        items = {'a': 'x', 'b': 1}
+        self.assertTrue(check_items(items) is items)
+        self.assertEqual(check_items({'a': bytearray(b'x')}), {'a': b'x'})
+        with self.assertRaises(TypeError):
+            check_items({'a': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
+import threading
 import unittest
 import uuid
-from db import SimpleDB
+import db
+from db import SimpleDB, TOMBSTONE
+from eviction import entry_size
+from tiered import TieredStore
 
 
 class TestSimpleDB(unittest.TestCase):
@@ -30,16 +34,21 @@ class TestSimpleDB(unittest.TestCase):
         self.test_db.insert_transaction(expected_trans)
         self.assertEqual(self.test_db.getTransaction(), expected_trans)
 
-    def test_check_commit_immediately(self):
-        commit_immediately, transID = self.test_db.check_commit_immediately(
-            None)
-        self.assertTrue(commit_immediately)
-        self.assertTrue(transID != None)
+    def test_commit_seq(self):
+        start_seq = self.test_db.commit_seq
+        self.test_db.put('test_key', 'test_value')
+        self.assertEqual(self.test_db.commit_seq, start_seq + 1)
+        self.assertEqual(
+            self.test_db.db_transaction_id['test_key'], start_seq + 1)
 
-        commit_immediately, transID = self.test_db.check_commit_immediately(
-            'uuid')
-        self.assertFalse(commit_immediately)
-        self.assertEqual(transID, 'uuid')
+        # Commit stamp the key with the next sequence number
+        self.test_db.createTransaction('test_seq_transID')
+        self.test_db.put('test_key', 'test_value_2', 'test_seq_transID')
+        self.test_db.commitTransaction('test_seq_transID')
+        self.assertEqual(
+            self.test_db.db_transaction_id['test_key'], start_seq + 2)
+        self.assertTrue(self.test_db.db_transaction_id['test_get_key']
+                        < self.test_db.db_transaction_id['test_key'])
 
     def test_get_DB_no_transac(self):
         expected_val = 'test_val_1'
@@ -158,12 +167,15 @@ class TestSimpleDB(unittest.TestCase):
             self.test_db.put('test_bad_key', 'test_bad_val', 123)
 
     def test_del_DB_transac(self):
+        # Deleted key is kept as a tombstone in the write set
         expected_trans = {
             'test_del_transactionID': {
                 'value': {
+                    'test_del_key_1': TOMBSTONE,
                     'test_del_key_2': 'test_val_2',
                 },
                 'transaction_uuid': {
+                    'test_del_key_1': 'uuid_1',
                     'test_del_key_2': 'uuid_2',
                 }
             }
@@ -183,16 +195,73 @@ class TestSimpleDB(unittest.TestCase):
         self.test_db.delete('test_del_key_1', 'test_del_transactionID')
         self.assertEqual(self.test_db.getTransaction(), expected_trans)
 
+        with self.assertRaises(Exception):
+            self.test_db.get('test_del_key_1', 'test_del_transactionID')
+        # Deleting twice or deleting a key not in db fail
+        with self.assertRaises(Exception):
+            self.test_db.delete('test_del_key_1', 'test_del_transactionID')
+        with self.assertRaises(Exception):
+            self.test_db.delete('test_bad_key', 'test_del_transactionID')
         with self.assertRaises(Exception):
             self.test_db.delete('test_bad_key', 'bad_transID')
         with self.assertRaises(Exception):
             self.test_db.delete('test_bad_key', 123)
 
+    def test_batch_no_transac(self):
+        self.test_db.put_many({'test_key_1': 'val_1', 'test_key_2': 'val_2'})
+        self.test_db.put_many([('test_key_3', 'val_3')])
+        self.assertEqual(self.test_db.get_many(
+            ['test_key_1', 'test_key_3', 'test_bad_key']), ['val_1', 'val_3', None])
+        # One commit for the whole batch
+        self.assertEqual(self.test_db.db_transaction_id['test_key_1'],
+                         self.test_db.db_transaction_id['test_key_2'])
+
+        self.test_db.delete_many(['test_key_1', 'test_key_2'])
+        self.assertEqual(self.test_db.getDB(), {
+            'test_get_key': 'test_val_1',
+            'test_key_3': 'val_3',
+        })
+
+        # Nothing is applied when any item is invalid
+        with self.assertRaises(Exception):
+            self.test_db.put_many({'test_key_4': 'val_4', 123: 'val'})
+        with self.assertRaises(Exception):
+            self.test_db.put_many({'test_key_4': 'val_4', 'test_key_5': [123]})
+        with self.assertRaises(Exception):
+            self.test_db.delete_many(['test_key_3', 'test_bad_key'])
+        with self.assertRaises(Exception):
+            self.test_db.get_many(['test_key_3', 123])
+        self.assertEqual(self.test_db.getDB(), {
+            'test_get_key': 'test_val_1',
+            'test_key_3': 'val_3',
+        })
+
+    def test_batch_transac(self):
+        self.test_db.createTransaction('test_batch_transID')
+        self.test_db.put_many(
+            {'test_key_1': 'val_1', 'test_key_2': 'val_2'}, 'test_batch_transID')
+        self.test_db.delete_many(
+            ['test_key_1', 'test_get_key'], 'test_batch_transID')
+        self.assertEqual(self.test_db.get_many(
+            ['test_key_1', 'test_key_2'], 'test_batch_transID'), [None, 'val_2'])
+        self.assertEqual(self.test_db.getDB(), {'test_get_key': 'test_val_1'})
+
+        self.test_db.commitTransaction('test_batch_transID')
+        self.assertEqual(self.test_db.getDB(), {'test_key_2': 'val_2'})
+
+        with self.assertRaises(Exception):
+            self.test_db.put_many({'test_key': 'val'}, 'bad_transID')
+        with self.assertRaises(Exception):
+            self.test_db.get_many(['test_key'], 'bad_transID')
+        with self.assertRaises(Exception):
+            self.test_db.delete_many(['test_key_2'], 'bad_transID')
+
     def test_createTransaction(self):
         expected_trans = {
             'Test_transID': {
                 'value': {},
-                'transaction_uuid': {}
+                'transaction_uuid': {},
+                'snapshot': self.test_db.commit_seq
             }
         }
         self.test_db.createTransaction('Test_transID')
@@ -338,17 +407,9 @@ class TestSimpleDB_Scenario(unittest.TestCase):
         self.test_db.createTransaction('def')
         self.test_db.put('b', 'foo', 'def')
 
-        '''
-        NOTE: in the example this is return as bar but base on the API descibtion
-        ● String get(String key, String transactionId)
-            ○ Returns the value associated with “key” within the transaction with ID
-            “transactionId”
-            ○ Throws an exception or returns an error on failure
-        This following command get('a', 'def') should throw an exception since
-        the key 'a' was never assign any value within the transaction 'def'
-        '''
-        with self.assertRaises(Exception):
-            self.test_db.get('a', 'def')
+        #  // returns 'bar', read from the snapshot of transaction 'def'
+        receive_val = self.test_db.get('a', 'def')
+        self.assertEqual(receive_val, 'bar')
 
         #  // returns 'foo'
         receive_val = self.test_db.get('b', 'def')
@@ -360,6 +421,1160 @@ class TestSimpleDB_Scenario(unittest.TestCase):
         with self.assertRaises(Exception):
             self.test_db.get('b')
 
+    def test_flow_autocommit_put(self):
+        self.test_db.put('a', 'foo')
+        self.assertEqual(self.test_db.getTransaction(), {})
+
+        # Autocommit put should invalidate open transaction on the same key
+        self.test_db.createTransaction('abc')
+        self.test_db.put('a', 'bar', 'abc')
+        self.test_db.put('a', 'baz')
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('abc')
+
+        receive_val = self.test_db.get('a')
+        self.assertEqual(receive_val, 'baz')
+
+    def test_flow_multi_key_transaction(self):
+        self.test_db.put('a', 'foo')
+        self.test_db.put('b', 'foo')
+
+        self.test_db.createTransaction('abc')
+        for i in range(1000):
+            self.test_db.put('key_%d' % i, 'val_%d' % i, 'abc')
+        self.test_db.put('a', 'bar', 'abc')
+        self.test_db.delete('b', 'abc')
+
+        # Nothing is visible before commit
+        with self.assertRaises(Exception):
+            self.test_db.get('key_0')
+        self.assertEqual(self.test_db.get('b'), 'foo')
+
+        seq_before = self.test_db.commit_seq
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.commit_seq, seq_before + 1)
+        self.assertEqual(self.test_db.get('key_999'), 'val_999')
+        self.assertEqual(self.test_db.get('a'), 'bar')
+        with self.assertRaises(Exception):
+            self.test_db.get('b')
+        self.assertEqual(len(self.test_db.getDB()), 1001)
+
+        # A conflict on any key abort the whole transaction
+        self.test_db.createTransaction('def')
+        self.test_db.put('key_0', 'new_val', 'def')
+        self.test_db.put('key_1', 'new_val', 'def')
+        self.test_db.put('key_1', 'dirty_val')
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('def')
+        self.assertEqual(self.test_db.get('key_0'), 'val_0')
+        self.assertEqual(self.test_db.get('key_1'), 'dirty_val')
+        self.assertEqual(self.test_db.getTransaction(), {})
+
+    def test_flow_snapshot_read(self):
+        self.test_db.put_many({'a': 'foo', 'b': 'foo', 'c': 'foo'})
+        self.test_db.createTransaction('abc')
+        # Nothing is copied when a transaction start
+        self.assertEqual(self.test_db.db_history, {})
+
+        self.test_db.put('a', 'bar')
+        self.test_db.delete('b')
+        self.test_db.put('d', 'bar')
+
+        # Commits after the transaction start are not visible
+        self.assertEqual(self.test_db.get('a', 'abc'), 'foo')
+        self.assertEqual(self.test_db.get('b', 'abc'), 'foo')
+        with self.assertRaises(Exception):
+            self.test_db.get('d', 'abc')
+        self.assertEqual(self.test_db.get_many(['a', 'd'], 'abc'), ['foo', None])
+
+        # Read your own writes
+        self.test_db.put('c', 'baz', 'abc')
+        self.assertEqual(self.test_db.get('c', 'abc'), 'baz')
+        self.assertEqual(self.test_db.get('c'), 'foo')
+
+        # Key read by the transaction was changed, commit fail
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.get('c'), 'foo')
+        self.assertEqual(self.test_db.db_history, {})
+
+        # Only unchanged keys are read, commit succeed
+        self.test_db.createTransaction('def')
+        self.test_db.put('a', 'new_val')
+        self.assertEqual(self.test_db.get('c', 'def'), 'foo')
+        self.test_db.put('c', 'new_val', 'def')
+        self.test_db.commitTransaction('def')
+        self.assertEqual(self.test_db.get('c'), 'new_val')
+        self.assertEqual(self.test_db.db_history, {})
+
+    def test_flow_history_pruned(self):
+        self.test_db.put_many({'counter': '0', 'key_0': 'foo'})
+        # Always one transaction open, each started before the previous one ends
+        self.test_db.createTransaction('txn_0')
+        history_keys = []
+        for i in range(1, 20000):
+            self.test_db.createTransaction('txn_%d' % i)
+            self.test_db.put('counter', str(i))
+            self.test_db.put('key_%d' % i, 'foo')
+            self.test_db.delete('key_%d' % (i - 1))
+            self.test_db.rollbackTransaction('txn_%d' % (i - 1))
+            history_keys.append(self.test_db.stats()['history_keys'])
+        self.assertTrue(max(history_keys) <= 3 * db.HISTORY_PRUNE_MIN)
+        # The open snapshot still reads what it saw
+        self.test_db.put('counter', 'new')
+        self.assertEqual(self.test_db.get('counter', 'txn_19999'), '19998')
+        self.assertEqual(self.test_db.get('key_19998', 'txn_19999'), 'foo')
+        with self.assertRaises(KeyError):
+            self.test_db.get('key_19999', 'txn_19999')
+
+    def test_flow_prepare(self):
+        self.test_db.put_many({'a': 'foo', 'b': 'foo', 'c': 'foo'})
+        self.test_db.createTransaction('abc')
+        self.test_db.put('a', 'bar', 'abc')
+        self.assertEqual(self.test_db.get('b', 'abc'), 'foo')
+        self.test_db.prepareTransaction('abc')
+
+        # Keys of a prepared transaction can not be committed by anything else
+        with self.assertRaises(Exception):
+            self.test_db.put('a', 'baz')
+        with self.assertRaises(Exception):
+            self.test_db.delete('b')
+        self.test_db.createTransaction('def')
+        self.test_db.put('b', 'baz', 'def')
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('def')
+        # Nor can the prepared transaction touch new keys
+        with self.assertRaises(Exception):
+            self.test_db.put('c', 'bar', 'abc')
+        self.test_db.put('c', 'baz')
+
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.getDB(), {'a': 'bar', 'b': 'foo', 'c': 'baz'})
+        self.assertEqual(self.test_db.prepared, {})
+        self.test_db.put('a', 'baz')
+
+        # Rollback release the keys, a conflicting prepare roll back
+        self.test_db.createTransaction('ghi')
+        self.test_db.put('a', 'qux', 'ghi')
+        self.test_db.prepareTransaction('ghi')
+        self.test_db.rollbackTransaction('ghi')
+        self.assertEqual(self.test_db.prepared, {})
+        self.test_db.createTransaction('jkl')
+        self.test_db.put('a', 'qux', 'jkl')
+        self.test_db.put('a', 'foo')
+        with self.assertRaises(Exception):
+            self.test_db.prepareTransaction('jkl')
+        self.assertFalse('jkl' in self.test_db.transaction)
+        self.assertEqual(self.test_db.get('a'), 'foo')
+
+
+class TestSimpleDB_Expiry(unittest.TestCase):
+    def setUp(self):
+        self.test_db = SimpleDB()
+        self.now = 1000.0
+        self.test_db.clock = lambda: self.now
+
+    def test_flow_ttl(self):
+        self.test_db.put('a', 'foo', ttl=10)
+        self.test_db.put('b', 'foo', ttl=20)
+        self.test_db.put('c', 'foo')
+        self.assertEqual(self.test_db.get_ttl('a'), 10)
+        self.assertEqual(self.test_db.get_ttl('c'), None)
+
+        self.now += 15
+        # Lazily hidden on access
+        with self.assertRaises(Exception):
+            self.test_db.get('a')
+        self.assertFalse('a' in self.test_db.getDB())
+        self.assertEqual(self.test_db.get('b'), 'foo')
+
+        # Put without ttl clear it
+        self.test_db.put('b', 'bar')
+        self.now += 10
+        self.assertEqual(self.test_db.get('b'), 'bar')
+        self.assertEqual(self.test_db.get_ttl('b'), None)
+
+        with self.assertRaises(Exception):
+            self.test_db.put('d', 'foo', ttl=0)
+        with self.assertRaises(Exception):
+            self.test_db.put('d', 'foo', ttl='10')
+
+    def test_expire_cycle(self):
+        self.test_db.put_many({'key_%d' % i: 'val' for i in range(50)}, ttl=10)
+        self.test_db.put('keep', 'val', ttl=100)
+        self.now += 10
+
+        # Bounded amount of work per call
+        self.assertEqual(self.test_db.expire_cycle(20), 20)
+        self.assertEqual(len(self.test_db.getDB()), 31)
+        self.assertEqual(self.test_db.expire_cycle(100), 30)
+        self.assertEqual(self.test_db.getDB(), {'keep': 'val'})
+        self.assertEqual(self.test_db.expire_cycle(), 0)
+        self.assertEqual(self.test_db.expiry.next_deadline(), 1100.0)
+
+    def test_ttl_transac(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.put('a', 'foo', 'abc', ttl=10)
+        self.test_db.put_many({'b': 'foo', 'c': 'foo'}, 'abc', ttl=10)
+        self.test_db.put('c', 'bar', 'abc')
+        self.now += 5
+        # Deadline start on commit
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.get_ttl('a'), 10)
+        self.assertEqual(self.test_db.get_ttl('c'), None)
+
+        # Expiry is a commit, transactions holding the key fail
+        self.test_db.createTransaction('def')
+        self.test_db.put('a', 'bar', 'def')
+        self.now += 10
+        self.assertEqual(self.test_db.expire_cycle(), 2)
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('def')
+        self.assertEqual(self.test_db.getDB(), {'c': 'bar'})
+
+    def test_expire_prepared(self):
+        self.test_db.put('k', 'foo', ttl=10)
+        self.test_db.createTransaction('abc')
+        self.test_db.put('other', 'bar', 'abc')
+        self.test_db.delete('k', 'abc')
+        self.test_db.prepareTransaction('abc')
+        self.now += 10
+        # Held, left for a later cycle
+        self.assertEqual(self.test_db.expire_cycle(), 0)
+        self.assertTrue('k' in self.test_db.getDB())
+        self.test_db.rollbackTransaction('abc')
+        self.assertEqual(self.test_db.expire_cycle(), 1)
+        self.assertEqual(self.test_db.getDB(), {})
+
+
+class TestSimpleDB_Eviction(unittest.TestCase):
+    def test_evict_lru(self):
+        size = entry_size('key_00', 'val')
+        test_db = SimpleDB(maxmemory=size * 10)
+        for i in range(10):
+            test_db.put('key_%02d' % i, 'val')
+        test_db.get('key_00')
+        test_db.put('key_10', 'val')
+        # Least recently used key is evicted
+        self.assertFalse('key_01' in test_db.getDB())
+        self.assertTrue('key_00' in test_db.getDB())
+        self.assertEqual(len(test_db.getDB()), 10)
+
+        test_db.put_many({'many%d' % i: 'val' for i in range(5)})
+        self.assertEqual(len(test_db.getDB()), 10)
+        stats = test_db.memory_stats()
+        self.assertEqual(stats['evicted_keys'], 6)
+        self.assertTrue(stats['used_memory'] <= stats['maxmemory'])
+
+    def test_evict_lru_reads(self):
+        size = entry_size('key_00', 'val')
+        test_db = SimpleDB(maxmemory=size * 4, ordered_index=True)
+        for i in range(4):
+            test_db.put('key_%02d' % i, 'val')
+        # Every read path refresh recency, key_03 is left least recently used
+        test_db.get_many(['key_00'])
+        list(test_db.scan('key_01', 'key_02'))
+        test_db.scan_page(None, 1, 'key_02')
+        test_db.put('key_04', 'val')
+        self.assertEqual(sorted(test_db.getDB()), ['key_00', 'key_01', 'key_02', 'key_04'])
+        test_db.createTransaction('abc')
+        test_db.get('key_00', 'abc')
+        test_db.rollbackTransaction('abc')
+        test_db.put('key_05', 'val')
+        self.assertEqual(sorted(test_db.getDB()), ['key_00', 'key_02', 'key_04', 'key_05'])
+
+    def test_evict_transac(self):
+        size = entry_size('key_0', 'val')
+        test_db = SimpleDB(maxmemory=size * 5, eviction_policy='random')
+        test_db.put('key_0', 'val')
+        test_db.createTransaction('abc')
+        test_db.put('key_0', 'new_val', 'abc')
+        test_db.put_many({'key_%d' % i: 'val' for i in range(1, 10)})
+        self.assertEqual(len(test_db.getDB()), 5)
+        if 'key_0' not in test_db.getDB():
+            # Eviction is a commit, the transaction holding the key fail
+            with self.assertRaises(Exception):
+                test_db.commitTransaction('abc')
+
+    def test_evict_prepared(self):
+        size = entry_size('key_00', 'val')
+        test_db = SimpleDB(maxmemory=size * 5)
+        test_db.put('key_00', 'val')
+        test_db.createTransaction('abc')
+        test_db.put('key_00', 'new', 'abc')
+        test_db.prepareTransaction('abc')
+        # The oldest key is held, the next ones are evicted in its place
+        for i in range(1, 50):
+            test_db.put('key_%02d' % i, 'val')
+        stats = test_db.memory_stats()
+        self.assertTrue(stats['used_memory'] <= stats['maxmemory'])
+        self.assertEqual(stats['evicted_keys'], 45)
+        self.assertTrue('key_00' in test_db.getDB())
+        test_db.commitTransaction('abc')
+        self.assertEqual(test_db.get('key_00'), 'new')
+
+    def test_noeviction(self):
+        size = entry_size('key_0', 'val')
+        test_db = SimpleDB(maxmemory=size * 2, eviction_policy='noeviction')
+        test_db.put('key_0', 'val')
+        test_db.put('key_1', 'val')
+        test_db.put('key_2', 'val')
+        with self.assertRaises(Exception):
+            test_db.put('key_3', 'val')
+        self.assertEqual(test_db.memory_stats()['rejected_writes'], 1)
+        # Deletes are still allowed and free memory
+        test_db.delete('key_0')
+        test_db.delete('key_1')
+        test_db.put('key_3', 'val')
+
+        with self.assertRaises(Exception):
+            SimpleDB(maxmemory=size, eviction_policy='bad_policy')
+
+    def test_evict_ttl_first(self):
+        size = entry_size('key_0', 'val')
+        test_db = SimpleDB(maxmemory=size * 3, eviction_policy='volatile-ttl')
+        test_db.put('key_0', 'val')
+        test_db.put('key_1', 'val', ttl=100)
+        test_db.put('key_2', 'val', ttl=50)
+        test_db.put('key_3', 'val')
+        self.assertEqual(sorted(test_db.getDB()), ['key_0', 'key_1', 'key_3'])
+
+
+class TestSimpleDB_Scan(unittest.TestCase):
+    def setUp(self):
+        self.test_db = SimpleDB({'user:1:name': 'foo', 'user:1:mail': 'foo@bar',
+                                 'user:2:name': 'bar', 'item:1': 'baz'},
+                                ordered_index=True)
+
+    def test_scan(self):
+        self.assertEqual(list(self.test_db.scan()), sorted(self.test_db.getDB().items()))
+        self.assertEqual([key for key, _ in self.test_db.scan('user:1', 'user:2')],
+                         ['user:1:mail', 'user:1:name'])
+        self.assertEqual([key for key, _ in self.test_db.scan(reverse=True, limit=2)],
+                         ['user:2:name', 'user:1:name'])
+        self.assertEqual([key for key, _ in self.test_db.scan(offset=1, limit=2)],
+                         ['user:1:mail', 'user:1:name'])
+        self.assertEqual(list(self.test_db.scan(limit=0)), [])
+        with self.assertRaises(TypeError):
+            self.test_db.scan(1)
+        with self.assertRaises(Exception):
+            self.test_db.scan(offset=-1)
+        with self.assertRaises(Exception):
+            SimpleDB().scan()
+
+    def test_prefix(self):
+        self.assertEqual(list(self.test_db.prefix('user:1:')),
+                         [('user:1:mail', 'foo@bar'), ('user:1:name', 'foo')])
+        self.assertEqual([key for key, _ in self.test_db.prefix('user:', reverse=True)],
+                         ['user:2:name', 'user:1:name', 'user:1:mail'])
+        self.assertEqual(list(self.test_db.prefix('bad:')), [])
+        with self.assertRaises(TypeError):
+            self.test_db.prefix(None)
+
+    def test_scan_write(self):
+        self.test_db.put('user:1:age', '42')
+        self.test_db.delete('user:1:mail')
+        self.test_db.put_many({'user:3:name': 'qux', 'user:1:name': 'new'})
+        self.test_db.createTransaction('abc')
+        self.test_db.put('user:1:zip', '00000', 'abc')
+        self.test_db.delete('item:1', 'abc')
+        self.assertEqual(list(self.test_db.prefix('user:1:')),
+                         [('user:1:age', '42'), ('user:1:name', 'new')])
+        self.test_db.commitTransaction('abc')
+        self.assertEqual([key for key, _ in self.test_db.scan()],
+                         ['user:1:age', 'user:1:name', 'user:1:zip', 'user:2:name',
+                          'user:3:name'])
+
+        # Keys deleted while iterating are skipped
+        keys = []
+        for key, _ in self.test_db.prefix('user:'):
+            keys.append(key)
+            if key == 'user:1:age':
+                self.test_db.delete('user:1:name')
+        self.assertFalse('user:1:name' in keys)
+
+    def test_scan_expired(self):
+        self.now = 1000.0
+        self.test_db.clock = lambda: self.now
+        self.test_db.put('user:1:token', 'secret', ttl=10)
+        self.assertEqual(len(list(self.test_db.prefix('user:1:'))), 3)
+        self.now += 11
+        self.assertEqual(len(list(self.test_db.prefix('user:1:'))), 2)
+        self.assertFalse('user:1:token' in self.test_db.key_index)
+
+    def test_scan_page(self):
+        cursor, page = self.test_db.scan_page(count=3)
+        self.assertEqual([key for key, _ in page], ['item:1', 'user:1:mail', 'user:1:name'])
+        cursor, page = self.test_db.scan_page(cursor, count=3)
+        self.assertEqual(page, [('user:2:name', 'bar')])
+        self.assertEqual(cursor, None)
+        cursor, page = self.test_db.scan_page(count=1, start='user:1', end='user:2')
+        self.assertEqual(page, [('user:1:mail', 'foo@bar')])
+        # The cursor holds the end bound
+        self.assertEqual(self.test_db.scan_page(cursor), (None, [('user:1:name', 'foo')]))
+        with self.assertRaises(Exception):
+            self.test_db.scan_page(cursor, end='z')
+        with self.assertRaises(ValueError):
+            self.test_db.scan_page('bad cursor')
+        with self.assertRaises(TypeError):
+            self.test_db.scan_page(count='1')
+        with self.assertRaises(Exception):
+            self.test_db.scan_page(count=0)
+        with self.assertRaises(Exception):
+            SimpleDB().scan_page()
+
+    def test_scan_page_write(self):
+        self.test_db.put_many({'key_%03d' % i: str(i) for i in range(100)})
+        keys = []
+        cursor, page = self.test_db.scan_page(count=7)
+        while True:
+            keys.extend(key for key, _ in page)
+            # The last key of the page is gone, the next page resumes after it
+            self.test_db.delete(page[-1][0])
+            self.test_db.put('key_%03d' % (len(keys) + 100), 'new')
+            if cursor == None:
+                break
+            cursor, page = self.test_db.scan_page(cursor, count=7)
+        self.assertEqual(keys, sorted(set(keys)))
+        self.assertTrue(set('key_%03d' % i for i in range(100)) <= set(keys))
+
+    def test_scan_page_transaction(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.put('user:1:zip', '00000', 'abc')
+        self.test_db.delete('item:1', 'abc')
+        cursor, page = self.test_db.scan_page(count=2, transactionId='abc')
+        self.assertEqual(page, [('user:1:mail', 'foo@bar'), ('user:1:name', 'foo')])
+        # Commits made meanwhile are not seen
+        self.test_db.delete('user:2:name')
+        self.test_db.put('user:1:pet', 'cat')
+        self.test_db.put('user:3:name', 'qux')
+        cursor, page = self.test_db.scan_page(cursor, count=2, transactionId='abc')
+        self.assertEqual(page, [('user:1:zip', '00000'), ('user:2:name', 'bar')])
+        self.assertEqual(self.test_db.scan_page(cursor, transactionId='abc'), (None, []))
+        # Only keys in the range paged are looked at, history and writes of others too
+        self.assertEqual(list(self.test_db.history_index), sorted(self.test_db.db_history))
+        self.assertEqual(self.test_db.scan_page(start='user:2', end='user:3', transactionId='abc'),
+                         (None, [('user:2:name', 'bar')]))
+        # Nothing tracked, the commit does not fail
+        self.test_db.commitTransaction('abc')
+        with self.assertRaises(Exception):
+            self.test_db.scan_page(transactionId='abc')
+
+
+class TestSimpleDB_Index(unittest.TestCase):
+    def setUp(self):
+        self.test_db = SimpleDB({'a': 'red', 'b': 'blue', 'c': 'red', 'd': 'green'})
+        self.test_db.create_index('color')
+        self.test_db.create_index('first', 'prefix')
+
+    def test_find(self):
+        self.assertEqual(sorted(self.test_db.find('color', 'red')),
+                         [('a', 'red'), ('c', 'red')])
+        self.assertEqual(list(self.test_db.find('first', prefix='gr')), [('d', 'green')])
+        self.assertEqual(list(self.test_db.find('first', 'blue')), [('b', 'blue')])
+        self.assertEqual(len(list(self.test_db.find('color', 'red', limit=1))), 1)
+        self.assertEqual(list(self.test_db.find('color', 'pink')), [])
+
+        self.test_db.put('e', 'red')
+        self.test_db.put('a', 'pink')
+        self.test_db.delete('c')
+        self.test_db.put_many({'f': 'grey', 'b': 'red'})
+        self.assertEqual(sorted(self.test_db.find('color', 'red')),
+                         [('b', 'red'), ('e', 'red')])
+        self.assertEqual(list(self.test_db.find('first', prefix='gr')),
+                         [('d', 'green'), ('f', 'grey')])
+
+        with self.assertRaises(Exception):
+            self.test_db.find('bad_index', 'red')
+        with self.assertRaises(Exception):
+            self.test_db.find('color', prefix='r')
+        with self.assertRaises(Exception):
+            self.test_db.find('color')
+        with self.assertRaises(Exception):
+            self.test_db.create_index('color')
+
+    def test_find_transac(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.put('b', 'red', 'abc')
+        self.test_db.delete('a', 'abc')
+        self.test_db.put('e', 'green', 'abc')
+        # Only the transaction see its writes
+        self.assertEqual(list(self.test_db.find('color', 'red', transactionId='abc')),
+                         [('c', 'red'), ('b', 'red')])
+        self.assertEqual(sorted(self.test_db.find('color', 'red')),
+                         [('a', 'red'), ('c', 'red')])
+        self.assertEqual(sorted(self.test_db.find('first', prefix='g',
+                                                  transactionId='abc')),
+                         [('d', 'green'), ('e', 'green')])
+
+        # Rolled back writes never reach the index
+        self.test_db.rollbackTransaction('abc')
+        self.assertEqual(sorted(self.test_db.find('color', 'red')),
+                         [('a', 'red'), ('c', 'red')])
+
+        self.test_db.createTransaction('def')
+        self.test_db.put('b', 'red', 'def')
+        self.test_db.delete('a', 'def')
+        self.test_db.commitTransaction('def')
+        self.assertEqual(sorted(self.test_db.find('color', 'red')),
+                         [('b', 'red'), ('c', 'red')])
+
+    def test_extractor(self):
+        self.test_db.create_index('length', extractor=len)
+        self.assertEqual(sorted(key for key, _ in self.test_db.find('length', 3)),
+                         ['a', 'c'])
+        self.test_db.create_index('bad', 'prefix',
+                                  extractor=lambda value: 1 if value == 'pink' else value)
+        # Failing extractor reject the write before anything is applied
+        with self.assertRaises(TypeError):
+            self.test_db.put('a', 'pink')
+        self.assertEqual(self.test_db.get('a'), 'red')
+        self.test_db.drop_index('bad')
+        self.test_db.put('a', 'pink')
+        self.assertEqual(sorted(key for key, _ in self.test_db.find('length', 4)),
+                         ['a', 'b'])
+
+    def test_find_thread_safe(self):
+        test_db = SimpleDB({'a': 'red'}, thread_safe=True)
+        test_db.create_index('color')
+        test_db.put('b', 'red')
+        self.assertEqual(sorted(test_db.find('color', 'red')), [('a', 'red'), ('b', 'red')])
+
+
+class TestSimpleDB_Storage(unittest.TestCase):
+    def test_arena(self):
+        test_db = SimpleDB({'a': 'foo'}, storage='arena')
+        test_db.put('b', 'bar')
+        test_db.put_many({'c': 'baz' * 500, 'a': 'qux'})
+        test_db.createTransaction('abc')
+        test_db.delete('b', 'abc')
+        test_db.put('d', 'foo', 'abc')
+        test_db.commitTransaction('abc')
+        self.assertEqual(test_db.getDB(), {'a': 'qux', 'c': 'baz' * 500, 'd': 'foo'})
+        self.assertEqual(test_db.get('c'), 'baz' * 500)
+        with self.assertRaises(Exception):
+            test_db.get('b')
+        with self.assertRaises(Exception):
+            SimpleDB(storage='bad_storage')
+
+    def test_tiered(self):
+        test_db = SimpleDB({'a': 'foo', 'b': 'bar'}, storage=TieredStore(hot_keys=2, batch_size=2))
+        test_db.createTransaction('abc')
+        self.assertEqual(test_db.get('a', 'abc'), 'foo')
+        test_db.put('a', 'baz')
+        # Push a out of memory, its version is checked from disk
+        test_db.put_many({'c': 'x', 'd': 'y', 'e': 'z'})
+        self.assertTrue('a' not in test_db.getDB().hot)
+        test_db.put('b', 'qux', 'abc')
+        with self.assertRaises(Exception):
+            test_db.commitTransaction('abc')
+        test_db.createTransaction('def')
+        self.assertEqual(test_db.get('a', 'def'), 'baz')
+        test_db.delete('c', 'def')
+        test_db.put('f', b'\x00', 'def')
+        test_db.commitTransaction('def')
+        self.assertEqual(test_db.getDB(), {'a': 'baz', 'b': 'bar', 'd': 'y', 'e': 'z', 'f': b'\x00'})
+        test_db.close()
+
+
+class TestSimpleDB_Metrics(unittest.TestCase):
+    def test_stats(self):
+        test_db = SimpleDB({'user:1': 'foo'}, metrics=True)
+        test_db.put('user:2', 'bar')
+        test_db.get('user:1')
+        with self.assertRaises(Exception):
+            test_db.get('user:3')
+        test_db.createTransaction('abc')
+        test_db.get('user:1', 'abc')
+        test_db.put('user:1', 'baz')
+        with self.assertRaises(Exception):
+            test_db.commitTransaction('abc')
+        test_db.createTransaction('def')
+        test_db.put('order:1', 'foo', 'def')
+        test_db.commitTransaction('def')
+        test_db.createTransaction('ghi')
+        stats = test_db.stats()
+        self.assertEqual(stats['keys'], 3)
+        self.assertEqual(stats['open_transactions'], 1)
+        self.assertEqual(stats['operations']['get']['count'], 3)
+        self.assertEqual(stats['operations']['get']['errors'], 1)
+        self.assertEqual(stats['operations']['commitTransaction']['count'], 2)
+        self.assertEqual(stats['operations']['commitTransaction']['errors'], 1)
+        # The conflicting commit is not also counted as a rollback
+        self.assertTrue('rollbackTransaction' not in stats['operations'])
+        self.assertEqual(stats['prefixes']['user:']['conflicts'], 1)
+        self.assertEqual(stats['prefixes']['order:']['commits'], 1)
+        self.assertTrue('simpledb_open_transactions 1' in test_db.prometheus().splitlines())
+
+    def test_disable(self):
+        test_db = SimpleDB(metrics=True)
+        test_db.disable_metrics()
+        # Methods are the class ones again
+        self.assertTrue('put' not in test_db.__dict__)
+        test_db.put('a', 'foo')
+        self.assertEqual(test_db.stats(), {'keys': 1, 'open_transactions': 0,
+                                           'prepared_keys': 0, 'commit_seq': 1,
+                                           'expiring_keys': 0, 'history_keys': 0,
+                                           'reaped_transactions': 0,
+                                           'rejected_transactions': 0})
+        self.assertTrue('simpledb_keys 1' in test_db.prometheus().splitlines())
+        test_db.enable_metrics()
+        test_db.put('b', 'foo')
+        self.assertEqual(test_db.stats()['operations']['put']['count'], 1)
+
+
+class TestSimpleDB_Lifecycle(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.test_db = SimpleDB({'a': 'foo'}, transaction_timeout=10, max_transactions=3)
+        self.test_db.clock = lambda: self.now
+
+    def test_timeout(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.put('a', 'bar', 'abc')
+        self.test_db.createTransaction('def', timeout=60)
+        self.now += 11
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('abc')
+        self.assertEqual(list(self.test_db.getTransaction()), ['def'])
+        self.test_db.put('a', 'baz', 'def')
+        self.test_db.commitTransaction('def')
+        self.assertEqual(self.test_db.get('a'), 'baz')
+        self.assertEqual(self.test_db.stats()['reaped_transactions'], 1)
+        with self.assertRaises(Exception):
+            self.test_db.createTransaction('ghi', timeout=0)
+
+    def test_reap(self):
+        for i in range(3):
+            self.test_db.createTransaction('trans_%d' % i)
+            self.now += 1
+        self.now += 7.5
+        self.assertEqual(self.test_db.reap_transactions(), 1)
+        self.assertEqual(sorted(self.test_db.getTransaction()), ['trans_1', 'trans_2'])
+        # Prepared transactions are left to their coordinator
+        self.test_db.prepareTransaction('trans_1')
+        self.now += 5
+        self.assertEqual(self.test_db.reap_transactions(), 1)
+        self.assertEqual(list(self.test_db.getTransaction()), ['trans_1'])
+        self.test_db.commitTransaction('trans_1')
+        self.assertEqual(self.test_db.getTransaction(), {})
+        self.assertEqual(self.test_db.transaction_deadlines.deadlines, {})
+
+    def test_max_transactions(self):
+        for i in range(3):
+            self.test_db.createTransaction('trans_%d' % i)
+        with self.assertRaises(Exception):
+            self.test_db.createTransaction('trans_3')
+        self.assertEqual(self.test_db.stats()['rejected_transactions'], 1)
+        self.test_db.rollbackTransaction('trans_0')
+        self.test_db.createTransaction('trans_3')
+        # Full of stale transactions, begin reap them to make room
+        self.now += 11
+        self.test_db.createTransaction('trans_4')
+        self.assertEqual(list(self.test_db.getTransaction()), ['trans_4'])
+        with self.assertRaises(ValueError):
+            SimpleDB(max_transactions=0)
+
+
+class TestSimpleDB_Pessimistic(unittest.TestCase):
+    def setUp(self):
+        self.test_db = SimpleDB({'a': '1', 'b': 'foo'}, concurrency='pessimistic')
+
+    def test_lock(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.createTransaction('def')
+        self.assertEqual(self.test_db.get('a', 'abc'), '1')
+        # Single threaded a conflict can not wait, the transaction is rolled back
+        with self.assertRaises(Exception):
+            self.test_db.put('a', '2', 'def')
+        self.assertEqual(list(self.test_db.getTransaction()), ['abc'])
+        self.test_db.put('a', '3', 'abc')
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.get('a'), '3')
+        self.assertEqual(self.test_db.lock_manager.owners, {})
+
+    def test_failed_commit(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.put('a', '2', 'abc')
+
+        def fail(puts, deletes, expires):
+            raise MemoryError
+
+        self.test_db.update_expiry = fail
+        with self.assertRaises(MemoryError):
+            self.test_db.commitTransaction('abc')
+        del self.test_db.update_expiry
+        # Restored still holding its locks
+        self.test_db.createTransaction('def')
+        with self.assertRaises(Exception):
+            self.test_db.put('a', '3', 'def')
+        self.test_db.put('b', 'bar', 'abc')
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.get_many(['a', 'b']), ['2', 'bar'])
+        self.assertEqual(self.test_db.lock_manager.owners, {})
+
+    def test_latest_read(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.put('a', '2')
+        # No snapshot, the key is read as committed when it is locked
+        self.assertEqual(self.test_db.get('a', 'abc'), '2')
+        self.test_db.put('a', '3', 'abc')
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.get('a'), '3')
+        # A write without transaction still fail the holder
+        self.test_db.createTransaction('def')
+        self.test_db.get('b', 'def')
+        self.test_db.put('b', 'bar')
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('def')
+        self.assertEqual(self.test_db.lock_manager.owners, {})
+
+    def test_mixed(self):
+        test_db = SimpleDB({'a': '1'})
+        test_db.createTransaction('abc', pessimistic=True)
+        test_db.createTransaction('def')
+        test_db.get('a', 'abc')
+        # Optimistic transactions take no lock
+        test_db.put('a', '2', 'def')
+        test_db.commitTransaction('def')
+        with self.assertRaises(Exception):
+            test_db.commitTransaction('abc')
+        with self.assertRaises(ValueError):
+            SimpleDB(concurrency='bad_concurrency')
+
+    def test_threads(self):
+        test_db = SimpleDB({'counter': '0'}, thread_safe=True, concurrency='pessimistic')
+        aborts = []
+
+        def worker(i):
+            done = 0
+            while done < 50:
+                transactionId = 'trans_%d_%d' % (i, done)
+                try:
+                    test_db.createTransaction(transactionId)
+                    value = int(test_db.get('counter', transactionId))
+                    test_db.put('counter', str(value + 1), transactionId)
+                    test_db.commitTransaction(transactionId)
+                    done += 1
+                except Exception:
+                    aborts.append(transactionId)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(test_db.get('counter'), '200')
+        self.assertEqual(test_db.getTransaction(), {})
+        self.assertEqual(test_db.lock_manager.owners, {})
+
+
+class TestSimpleDB_Merge(unittest.TestCase):
+    def setUp(self):
+        self.test_db = SimpleDB({'a': '1', 'b': 'foo'})
+
+    def test_autocommit(self):
+        self.assertEqual(self.test_db.incr('a'), 2)
+        self.assertEqual(self.test_db.incr('a', -5), -3)
+        self.assertEqual(self.test_db.incr('c', 3), 3)
+        self.assertEqual(self.test_db.append('b', 'bar'), 6)
+        self.assertEqual(self.test_db.append('d', 'baz'), 3)
+        self.assertEqual(self.test_db.getDB(), {'a': '-3', 'b': 'foobar', 'c': '3', 'd': 'baz'})
+        with self.assertRaises(Exception):
+            self.test_db.incr('b')
+        with self.assertRaises(TypeError):
+            self.test_db.incr('a', '1')
+        with self.assertRaises(TypeError):
+            self.test_db.append('b', 1)
+
+    def test_no_conflict(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.createTransaction('def')
+        self.test_db.incr('a', 2, 'abc')
+        self.test_db.incr('a', 3, 'abc')
+        self.test_db.append('b', 'bar', 'abc')
+        self.test_db.incr('a', 10, 'def')
+        self.test_db.commitTransaction('def')
+        self.test_db.put('b', 'baz')
+        # Merged on the values committed meanwhile
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.getDB(), {'a': '16', 'b': 'bazbar'})
+
+    def test_read_merged(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.incr('a', 2, 'abc')
+        self.test_db.append('a', '0', 'abc')
+        self.assertEqual(self.test_db.get('a', 'abc'), '30')
+        self.test_db.put('c', '5', 'abc')
+        self.test_db.incr('c', 1, 'abc')
+        self.test_db.delete('b', 'abc')
+        self.test_db.append('b', 'bar', 'abc')
+        self.assertEqual(self.test_db.getTransaction()['abc']['value'], {'a': '30', 'c': '6', 'b': 'bar'})
+        # a was read, a commit of it now conflicts
+        self.test_db.put('a', '7')
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('abc')
+
+    def test_ttl(self):
+        self.test_db.put('a', '1', ttl=100)
+        self.test_db.createTransaction('abc')
+        self.test_db.incr('a', 1, 'abc')
+        self.test_db.commitTransaction('abc')
+        self.test_db.incr('a')
+        self.assertEqual(self.test_db.get('a'), '3')
+        self.assertTrue(self.test_db.get_ttl('a') > 99)
+
+    def test_prepare(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.incr('a', 2, 'abc')
+        self.test_db.prepareTransaction('abc')
+        # A prepared merge holds its key, it can not fail on commit
+        with self.assertRaises(Exception):
+            self.test_db.put('a', 'foo')
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.get('a'), '3')
+        self.assertEqual(self.test_db.prepared, {})
+
+        self.test_db.createTransaction('def')
+        self.test_db.incr('b', 1, 'def')
+        with self.assertRaises(Exception):
+            self.test_db.prepareTransaction('def')
+        self.assertFalse('def' in self.test_db.getTransaction())
+
+
+class TestSimpleDB_Typed(unittest.TestCase):
+    def setUp(self):
+        self.test_db = SimpleDB({'a': 'foo'})
+
+    def test_values(self):
+        payload = b'\x00' * 1000
+        self.test_db.put('bytes', payload)
+        self.test_db.put('int', 2 ** 70)
+        self.test_db.put_many({'float': 0.5, 'buffer': bytearray(b'abc')})
+        # Stored as given, no copy
+        self.assertTrue(self.test_db.get('bytes') is payload)
+        self.assertEqual(self.test_db.get_many(['int', 'float', 'buffer']), [2 ** 70, 0.5, b'abc'])
+        for value in (None, True, ['a'], bytearray):
+            with self.assertRaises(TypeError):
+                self.test_db.put('bad', value)
+        with self.assertRaises(TypeError):
+            self.test_db.put_many({'a': 'bar', 'bad': None})
+        self.assertEqual(self.test_db.get('a'), 'foo')
+        self.test_db.createTransaction('abc')
+        self.test_db.put('int', 1, 'abc')
+        self.test_db.put('view', memoryview(payload)[:10], 'abc')
+        self.assertEqual(self.test_db.get('int', 'abc'), 1)
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.get('view'), b'\x00' * 10)
+
+    def test_get_view(self):
+        payload = b'0123456789'
+        self.test_db.put('bytes', payload)
+        view = self.test_db.get_view('bytes', 2, 5)
+        self.assertEqual(view, b'234')
+        # A view of the stored buffer itself
+        self.assertTrue(view.obj is payload)
+        self.assertEqual(self.test_db.get_view('bytes', 8), b'89')
+        self.test_db.createTransaction('abc')
+        self.test_db.put('bytes', b'abc', 'abc')
+        self.assertEqual(self.test_db.get_view('bytes', transactionId='abc'), b'abc')
+        with self.assertRaises(Exception):
+            self.test_db.get_view('a')
+        with self.assertRaises(KeyError):
+            self.test_db.get_view('missing')
+
+    def test_merge(self):
+        self.test_db.put('int', 5)
+        self.test_db.put('float', 0.5)
+        self.assertEqual(self.test_db.incr('int', 2), 7)
+        self.assertEqual(self.test_db.incr('float'), 1.5)
+        self.assertEqual(self.test_db.get('int'), 7)
+        self.assertEqual(self.test_db.append('bytes', b'ab'), 2)
+        self.assertEqual(self.test_db.append('bytes', memoryview(b'cd')), 4)
+        self.assertEqual(self.test_db.get('bytes'), b'abcd')
+        with self.assertRaises(Exception):
+            self.test_db.append('bytes', 'text')
+        with self.assertRaises(Exception):
+            self.test_db.append('a', b'bytes')
+        with self.assertRaises(Exception):
+            self.test_db.incr('bytes')
+        self.test_db.createTransaction('abc')
+        self.test_db.append('bytes', b'e', 'abc')
+        self.test_db.append('bytes', b'f', 'abc')
+        self.test_db.incr('int', 1, 'abc')
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.get_many(['bytes', 'int']), [b'abcdef', 8])
+
+    def test_storage(self):
+        for storage in ('dict', 'arena'):
+            test_db = SimpleDB(storage=storage, maxmemory=10 ** 6)
+            test_db.put_many({'bytes': memoryview(b'\x00\xff'), 'int': -3, 'float': 2.5})
+            self.assertEqual(test_db.getDB(), {'bytes': b'\x00\xff', 'int': -3, 'float': 2.5})
+            self.assertEqual(test_db.get_view('bytes', 1), b'\xff')
+        self.assertTrue(entry_size('a', memoryview(b'x' * 1000)) > 1000)
+
+
+class TestSimpleDB_Atomic(unittest.TestCase):
+    def setUp(self):
+        self.test_db = SimpleDB({'a': 'foo', 'n': '5'})
+
+    def test_autocommit(self):
+        self.assertEqual(self.test_db.decr('n', 2), 3)
+        self.assertEqual(self.test_db.decr('m'), -1)
+        self.assertTrue(self.test_db.cas('a', 'foo', 'bar'))
+        self.assertFalse(self.test_db.cas('a', 'foo', 'baz'))
+        # expected None: only when the key does not exist
+        self.assertFalse(self.test_db.cas('a', None, 'baz'))
+        self.assertTrue(self.test_db.cas('b', None, b'\x00'))
+        self.assertTrue(self.test_db.cas('b', memoryview(b'\x00'), 1))
+        self.assertEqual(self.test_db.getset('a', 'qux'), 'bar')
+        self.assertEqual(self.test_db.getset('c', 'new'), None)
+        self.assertTrue(self.test_db.setnx('d', 'x'))
+        self.assertFalse(self.test_db.setnx('d', 'y'))
+        self.assertEqual(self.test_db.getDB(), {'a': 'qux', 'b': 1, 'c': 'new', 'd': 'x',
+                                                'm': '-1', 'n': '3'})
+        with self.assertRaises(TypeError):
+            self.test_db.decr('n', '1')
+        with self.assertRaises(TypeError):
+            self.test_db.cas('a', 'qux', None)
+        with self.assertRaises(TypeError):
+            self.test_db.setnx(1, 'x')
+
+    def test_conflict(self):
+        self.test_db.createTransaction('abc')
+        self.assertEqual(self.test_db.get('a', 'abc'), 'foo')
+        commit_seq = self.test_db.commit_seq
+        # One commit with a new version, the open transaction that read a fails
+        self.assertTrue(self.test_db.cas('a', 'foo', 'bar'))
+        self.assertEqual(self.test_db.commit_seq, commit_seq + 1)
+        self.assertEqual(self.test_db.db_transaction_id['a'], commit_seq + 1)
+        self.test_db.put('a', 'baz', 'abc')
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('abc')
+        # A failed cas writes nothing
+        self.assertFalse(self.test_db.cas('a', 'foo', 'qux'))
+        self.assertEqual(self.test_db.commit_seq, commit_seq + 1)
+
+    def test_transaction(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.put('c', 'own', 'abc')
+        # Against what the transaction sees, its own writes first
+        self.assertTrue(self.test_db.cas('c', 'own', 'mine', 'abc'))
+        self.assertEqual(self.test_db.getset('a', 'bar', 'abc'), 'foo')
+        self.assertFalse(self.test_db.setnx('a', 'baz', 'abc'))
+        self.assertEqual(self.test_db.decr('n', 1, 'abc'), None)
+        self.assertEqual(self.test_db.getDB(), {'a': 'foo', 'n': '5'})
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.getDB(), {'a': 'bar', 'c': 'mine', 'n': '4'})
+
+        self.test_db.createTransaction('def')
+        self.assertTrue(self.test_db.setnx('d', 'x', 'def'))
+        self.test_db.put('d', 'y')
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('def')
+
+    def test_ttl(self):
+        now = [1000.0]
+        test_db = SimpleDB({'a': 'foo'})
+        test_db.clock = lambda: now[0]
+        self.assertTrue(test_db.setnx('b', 'x', ttl=10))
+        self.assertEqual(test_db.get_ttl('b'), 10)
+        now[0] += 11
+        # Expired keys count as missing
+        self.assertTrue(test_db.setnx('b', 'y'))
+        self.assertEqual(test_db.get_ttl('b'), None)
+        self.assertEqual(test_db.getset('b', 'z', ttl=5), 'y')
+        self.assertEqual(test_db.get_ttl('b'), 5)
+
+    def test_concurrent(self):
+        test_db = SimpleDB({'n': '0'}, thread_safe=True)
+
+        def worker():
+            for _ in range(200):
+                while True:
+                    current = test_db.get('n')
+                    if test_db.cas('n', current, str(int(current) + 1)):
+                        break
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(test_db.get('n'), '800')
+
+
+class TestSimpleDB_Changes(unittest.TestCase):
+    def setUp(self):
+        self.test_db = SimpleDB({'a': 'foo'}, changefeed=16)
+
+    def tearDown(self):
+        self.test_db.close()
+
+    def test_changes(self):
+        since = self.test_db.changefeed.last_seq()
+        self.test_db.put('b', 'bar')
+        self.test_db.createTransaction('abc')
+        self.test_db.put('c', 'baz', 'abc')
+        self.test_db.delete('a', 'abc')
+        self.test_db.commitTransaction('abc')
+        self.test_db.incr('d')
+        changes = list(self.test_db.changes(since))
+        self.assertEqual([(change.puts, change.deletes) for change in changes],
+                         [({'b': 'bar'}, ()), ({'c': 'baz'}, ('a',)), ({'d': '1'}, ())])
+        self.assertEqual([change.commit_seq for change in changes], [since + 1, since + 2, since + 3])
+        # From now by default
+        self.assertEqual(list(self.test_db.changes()), [])
+        for i in range(20):
+            self.test_db.put('e', str(i))
+        with self.assertRaises(Exception):
+            self.test_db.changes(since)
+        with self.assertRaises(Exception):
+            SimpleDB().changes()
+
+    def test_failed_commit(self):
+        since = self.test_db.changefeed.last_seq()
+
+        def fail(puts, deletes, expires):
+            raise MemoryError
+
+        # Fails after the commit took its sequence number
+        self.test_db.update_expiry = fail
+        with self.assertRaises(MemoryError):
+            self.test_db.put('b', 'bar', ttl=60)
+        del self.test_db.update_expiry
+        self.test_db.put('c', 'baz')
+        # The filler keep the feed moving to the next commit
+        changes = list(self.test_db.changes(since))
+        self.assertEqual([(change.commit_seq, change.puts) for change in changes],
+                         [(since + 1, {}), (since + 2, {'c': 'baz'})])
+
+    def test_watch(self):
+        calls = []
+        done = threading.Event()
+        self.test_db.watch(lambda *args: calls.append(args), prefix='user:')
+        self.test_db.watch(lambda *args: done.set(), key='done')
+        self.test_db.put('user:1', 'foo')
+        self.test_db.put('order:1', 'bar')
+        self.test_db.delete('user:1')
+        self.test_db.put('done', 'yes')
+        self.assertTrue(done.wait(5))
+        self.assertEqual([call[:2] for call in calls], [('user:1', 'foo'), ('user:1', None)])
+        with self.assertRaises(TypeError):
+            self.test_db.watch('not callable')
+
+    def test_concurrent_order(self):
+        test_db = SimpleDB(thread_safe=True, changefeed=4096)
+
+        def worker(i):
+            for j in range(200):
+                test_db.put('key_%d_%d' % (i, j), 'val')
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Every commit once, in commit sequence order
+        self.assertEqual([change.commit_seq for change in test_db.changes(0)],
+                         list(range(1, 801)))
+
+
+class TestSimpleDB_Concurrent(unittest.TestCase):
+    def setUp(self):
+        self.test_db = SimpleDB(thread_safe=True, lock_stripes=8)
+
+    def run_threads(self, target, count=8):
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_autocommit(self):
+        def worker(i):
+            for j in range(500):
+                self.test_db.put('key_%d_%d' % (i, j), 'val')
+            self.test_db.put_many({'many_%d_%d' % (i, j): 'val' for j in range(500)})
+            self.test_db.delete_many(['many_%d_%d' % (i, j) for j in range(250)])
+
+        self.run_threads(worker)
+        self.assertEqual(len(self.test_db.getDB()), 8 * 750)
+        self.assertEqual(len(self.test_db.db_transaction_id), 8 * 750)
+        self.assertEqual(self.test_db.commit_seq, 8 * 502)
+
+    def test_concurrent_counter(self):
+        self.test_db.put('counter', '0')
+
+        def worker(i):
+            done = 0
+            while done < 100:
+                transactionId = 'trans_%d_%d' % (i, done)
+                self.test_db.createTransaction(transactionId)
+                value = int(self.test_db.get('counter', transactionId))
+                self.test_db.put('counter', str(value + 1), transactionId)
+                try:
+                    self.test_db.commitTransaction(transactionId)
+                    done += 1
+                except Exception:
+                    pass
+
+        # Every increment that commit is counted exactly once
+        self.run_threads(worker)
+        self.assertEqual(self.test_db.get('counter'), str(8 * 100))
+        self.assertEqual(self.test_db.getTransaction(), {})
+
+    def test_concurrent_incr(self):
+        def worker(i):
+            for j in range(100):
+                transactionId = 'trans_%d_%d' % (i, j)
+                self.test_db.createTransaction(transactionId)
+                self.test_db.incr('counter', 1, transactionId)
+                self.test_db.append('log', 'x', transactionId)
+                # Merges never conflict
+                self.test_db.commitTransaction(transactionId)
+
+        self.run_threads(worker)
+        self.assertEqual(self.test_db.get('counter'), str(8 * 100))
+        self.assertEqual(self.test_db.get('log'), 'x' * 800)
+
+    def test_concurrent_snapshot(self):
+        accounts = ['account_%d' % i for i in range(10)]
+        self.test_db.put_many(dict.fromkeys(accounts, '100'))
+        errors = []
+
+        def transfer(i):
+            for j in range(200):
+                transactionId = 'transfer_%d_%d' % (i, j)
+                source, target = accounts[j % 10], accounts[(i + j + 1) % 10]
+                if source == target:
+                    continue
+                self.test_db.createTransaction(transactionId)
+                source_val, target_val = self.test_db.get_many(
+                    [source, target], transactionId)
+                self.test_db.put_many({
+                    source: str(int(source_val) - 1),
+                    target: str(int(target_val) + 1),
+                }, transactionId)
+                try:
+                    self.test_db.commitTransaction(transactionId)
+                except Exception:
+                    pass
+
+        def audit(i):
+            for j in range(200):
+                transactionId = 'audit_%d_%d' % (i, j)
+                self.test_db.createTransaction(transactionId)
+                total = sum(map(int, self.test_db.get_many(accounts, transactionId)))
+                self.test_db.rollbackTransaction(transactionId)
+                if total != 1000:
+                    errors.append(total)
+
+        # Each snapshot see the whole of a transfer or nothing of it
+        self.run_threads(lambda i: transfer(i) if i % 2 else audit(i))
+        self.assertEqual(errors, [])
+        self.assertEqual(sum(map(int, self.test_db.get_many(accounts))), 1000)
+
 
 if __name__ == '__main__':
     unittest.main()
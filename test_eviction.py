@@ -0,0 +1,93 @@
+import unittest
+from eviction import KeySampler, LRUPolicy, LFUPolicy, RandomPolicy, TTLPolicy, \
+    MemoryLimit, entry_size
+from expiry import ExpiryIndex
+
+
+class TestEviction(unittest.TestCase):
+    def test_key_sampler(self):
+        sampler = KeySampler()
+        for i in range(10):
+            sampler.add('test_key_%d' % i)
+        sampler.add('test_key_0')
+        self.assertEqual(len(sampler), 10)
+        sampler.remove('test_key_3')
+        sampler.remove('test_key_9')
+        sampler.remove('test_bad_key')
+        self.assertEqual(len(sampler), 8)
+        self.assertEqual(sorted(sampler.position.values()), list(range(8)))
+        for key in sampler.sample(50):
+            self.assertTrue(key not in ('test_key_3', 'test_key_9'))
+        self.assertEqual(KeySampler().sample(5), [])
+
+    def test_lru(self):
+        policy = LRUPolicy()
+        for key in ('a', 'b', 'c'):
+            policy.on_insert(key)
+        policy.on_access('a')
+        self.assertEqual(policy.victim(), 'b')
+        policy.on_delete('b')
+        self.assertEqual(policy.victim(), 'c')
+        policy.on_insert('c')
+        self.assertEqual(policy.victim(), 'a')
+        # Held keys are passed over
+        self.assertEqual(policy.victim({'a'}), 'c')
+        self.assertEqual(policy.victim({'a', 'c'}), None)
+
+    def test_lfu(self):
+        self.now = 0.0
+        policy = LFUPolicy(log_factor=0, decay_seconds=10, sample_size=50,
+                           clock=lambda: self.now)
+        policy.on_insert('hot')
+        policy.on_insert('cold')
+        for _ in range(20):
+            policy.on_access('hot')
+        self.assertEqual(policy.victim(), 'cold')
+
+        # Counters decay once keys are not accessed
+        self.now += 1000
+        self.assertEqual(policy.decayed('hot', self.now), 0)
+        policy.on_delete('cold')
+        self.assertEqual(policy.victim(), 'hot')
+
+    def test_random_ttl(self):
+        policy = RandomPolicy()
+        self.assertEqual(policy.victim(), None)
+        policy.on_insert('a')
+        self.assertEqual(policy.victim(), 'a')
+
+        expiry = ExpiryIndex()
+        policy = TTLPolicy(expiry)
+        policy.on_insert('a')
+        policy.on_insert('b')
+        expiry.set('b', 10.0)
+        self.assertEqual(policy.victim(), 'b')
+        expiry.set('a', 20.0)
+        self.assertEqual(policy.victim({'b'}), 'a')
+        expiry.remove('a')
+        expiry.remove('b')
+        self.assertTrue(policy.victim() in ('a', 'b'))
+
+    def test_memory_limit(self):
+        memory_limit = MemoryLimit(1000, 'lru')
+        db = {'a': 'foo'}
+        memory_limit.load(db)
+        self.assertEqual(memory_limit.used_memory, entry_size('a', 'foo'))
+
+        memory_limit.track(db, {'a': 'longer value', 'b': 'bar'})
+        db.update({'a': 'longer value', 'b': 'bar'})
+        self.assertEqual(memory_limit.used_memory,
+                         entry_size('a', 'longer value') + entry_size('b', 'bar'))
+        memory_limit.track(db, {}, ['a'])
+        del db['a']
+        self.assertEqual(memory_limit.used_memory, entry_size('b', 'bar'))
+        self.assertEqual(memory_limit.victim(), 'b')
+
+        with self.assertRaises(Exception):
+            MemoryLimit(1000, 'bad_policy')
+        with self.assertRaises(Exception):
+            MemoryLimit('1000')
+
+
+if __name__ == '__main__':
+    unittest.main()
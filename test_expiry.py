@@ -0,0 +1,40 @@
+import unittest
+from expiry import ExpiryIndex
+
+
+class TestExpiryIndex(unittest.TestCase):
+    def setUp(self):
+        self.test_index = ExpiryIndex()
+
+    def test_set_remove(self):
+        self.test_index.set('test_key_1', 10.0)
+        self.test_index.set('test_key_2', 5.0)
+        self.assertEqual(len(self.test_index), 2)
+        self.assertTrue('test_key_1' in self.test_index)
+        self.assertEqual(self.test_index.next_deadline(), 5.0)
+
+        self.test_index.remove('test_key_2')
+        self.assertEqual(self.test_index.get('test_key_2'), None)
+        self.assertEqual(self.test_index.next_deadline(), 10.0)
+        self.test_index.remove('test_bad_key')
+
+    def test_pop_due(self):
+        for i in range(10):
+            self.test_index.set('test_key_%d' % i, float(i))
+        # Reset deadline leave a stale heap entry behind
+        self.test_index.set('test_key_0', 100.0)
+
+        self.assertEqual(self.test_index.pop_due(4.5, 3), ['test_key_1', 'test_key_2'])
+        self.assertEqual(self.test_index.pop_due(4.5, 10), ['test_key_3', 'test_key_4'])
+        self.assertEqual(self.test_index.pop_due(4.5, 10), [])
+        self.assertEqual(self.test_index.next_deadline(), 5.0)
+
+    def test_compact(self):
+        for i in range(1000):
+            self.test_index.set('test_key', float(i))
+        self.assertTrue(len(self.test_index.heap) <= 2 * len(self.test_index) + 64)
+        self.assertEqual(self.test_index.pop_due(1000.0, 1000), ['test_key'])
+
+
+if __name__ == '__main__':
+    unittest.main()
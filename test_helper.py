@@ -1,5 +1,5 @@
 import unittest
-from helper import checkStr
+from helper import checkStr, checkAllStr
 
 
 class TestHelper(unittest.TestCase):
@@ -7,3 +7,8 @@ class TestHelper(unittest.TestCase):
     def test_checkStr(self):
         self.assertTrue(checkStr('test_str'))
         self.assertFalse(checkStr(123))
+
+    def test_checkAllStr(self):
+        self.assertTrue(checkAllStr(['test_str', 'test_str_2']))
+        self.assertTrue(checkAllStr([]))
+        self.assertFalse(checkAllStr(['test_str', 123]))
@@ -0,0 +1,75 @@
+import threading
+import time
+import unittest
+from lock_manager import LockManager
+
+
+class TestLockManager(unittest.TestCase):
+    def test_no_wait(self):
+        manager = LockManager(wait=False)
+        manager.begin('abc')
+        manager.begin('def')
+        manager.acquire('abc', 'a')
+        manager.acquire('abc', 'a')
+        manager.acquire('def', 'b')
+        with self.assertRaises(Exception):
+            manager.acquire('abc', 'b')
+        with self.assertRaises(Exception):
+            manager.acquire('def', 'a')
+        self.assertEqual(manager.stats(), {'locked_keys': 2, 'lock_waits': 0,
+                                           'lock_deadlocks': 2, 'lock_timeouts': 0})
+        manager.release('abc')
+        manager.acquire('def', 'a')
+        self.assertEqual(manager.owners, {'a': 'def', 'b': 'def'})
+
+    def test_wait(self):
+        manager = LockManager(wait=True)
+        manager.begin('abc')
+        manager.begin('def')
+        manager.acquire('abc', 'a')
+        manager.acquire('def', 'b')
+        acquired = []
+
+        def waiter():
+            manager.acquire('def', 'a')
+            acquired.append('def')
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        while manager.waits == 0:
+            time.sleep(0.001)
+        # def waits for abc, abc waiting for def would deadlock
+        with self.assertRaises(Exception):
+            manager.acquire('abc', 'b')
+        self.assertEqual(acquired, [])
+        manager.release('abc')
+        thread.join()
+        self.assertEqual(acquired, ['def'])
+        self.assertEqual(manager.waiting, {})
+        self.assertEqual(manager.stats()['lock_deadlocks'], 1)
+
+    def test_deadlock_chain(self):
+        manager = LockManager(wait=True)
+        for transactionId in ('abc', 'def', 'ghi'):
+            manager.begin(transactionId)
+        manager.acquire('abc', 'a')
+        manager.acquire('def', 'b')
+        manager.acquire('ghi', 'c')
+        manager.waiting = {'abc': 'b', 'def': 'c'}
+        self.assertTrue(manager.would_deadlock('ghi', 'a'))
+        self.assertFalse(manager.would_deadlock('ghi', 'd'))
+        self.assertFalse(manager.would_deadlock('abc', 'c'))
+
+    def test_wait_timeout(self):
+        manager = LockManager(wait=True, wait_timeout=0.01)
+        manager.begin('abc')
+        manager.begin('def')
+        manager.acquire('abc', 'a')
+        with self.assertRaises(Exception):
+            manager.acquire('def', 'a')
+        self.assertEqual(manager.stats()['lock_timeouts'], 1)
+        self.assertEqual(manager.waiting, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+from metrics import Histogram, HotKeys, Metrics, escape_label
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_buckets(self):
+        previous = -1
+        for value in range(5000):
+            bucket = Histogram.bucket_of(value)
+            # Buckets are in order and every bucket start where its values start
+            self.assertTrue(bucket in (previous, previous + 1))
+            self.assertTrue(Histogram.bucket_value(bucket) <= value < Histogram.bucket_value(bucket + 1))
+            previous = bucket
+
+    def test_histogram_percentile(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(0.5), 0)
+        for value in range(1, 1001):
+            histogram.record(value)
+        self.assertEqual(histogram.count, 1000)
+        self.assertEqual(histogram.max, 1000)
+        # Within one sub bucket of the exact percentile
+        for quantile in (0.5, 0.9, 0.99):
+            exact = quantile * 1000
+            self.assertTrue(exact <= histogram.percentile(quantile) <= exact * 1.125)
+        self.assertEqual(histogram.percentile(1), 1000)
+        self.assertEqual(list(histogram.cumulative())[-1], (1023, 1000))
+
+    def test_hot_keys(self):
+        hot_keys = HotKeys(capacity=4)
+        for i in range(100):
+            hot_keys.add('hot')
+            hot_keys.add('cold_%d' % i)
+        self.assertEqual(len(hot_keys.counts), 4)
+        self.assertEqual(hot_keys.top(1), [('hot', 100)])
+
+    def test_prefixes(self):
+        metrics = Metrics()
+        self.assertEqual(metrics.prefix_of('user:1:name'), 'user:')
+        self.assertEqual(metrics.prefix_of('plain'), '')
+        metrics.record_commit(['user:1', 'user:2', 'order:1'])
+        metrics.record_conflict('user:1')
+        self.assertEqual(metrics.stats()['prefixes'], {
+            'user:': {'commits': 1, 'conflicts': 1, 'conflict_rate': 0.5},
+            'order:': {'commits': 1, 'conflicts': 0, 'conflict_rate': 0.0},
+        })
+
+    def test_timed(self):
+        self.now = 0.0
+
+        def clock():
+            self.now += 0.25
+            return self.now
+
+        def method(key):
+            if key == 'bad':
+                raise KeyError(key)
+            return key
+
+        metrics = Metrics(sample_every=1, clock=clock)
+        timed = metrics.timed('get', method, True)
+        self.assertEqual(timed('test_key'), 'test_key')
+        with self.assertRaises(KeyError):
+            timed('bad')
+        stats = metrics.stats()
+        self.assertEqual(stats['operations']['get']['count'], 2)
+        self.assertEqual(stats['operations']['get']['errors'], 1)
+        self.assertEqual(stats['operations']['get']['max_us'], 250000)
+        self.assertEqual(stats['hot_keys'], [('test_key', 1), ('bad', 1)])
+
+    def test_prometheus(self):
+        metrics = Metrics(sample_every=1)
+        metrics.timed('put', lambda key, value: None, True)('say "hi"\n', 'value')
+        metrics.record_conflict('user:1')
+        text = metrics.prometheus({'keys': 3})
+        self.assertTrue(text.endswith('\n'))
+        lines = text.splitlines()
+        self.assertTrue('simpledb_keys 3' in lines)
+        self.assertTrue('simpledb_operations_total{op="put"} 1' in lines)
+        self.assertTrue('simpledb_operation_latency_seconds_bucket{op="put",le="+Inf"} 1' in lines)
+        self.assertTrue('simpledb_conflicts_total{prefix="user:"} 1' in lines)
+        # Every sample right after the TYPE line of its own metric
+        commits = lines.index('# TYPE simpledb_commits_total counter')
+        self.assertEqual(lines[commits + 1:commits + 4], [
+            'simpledb_commits_total{prefix="user:"} 0',
+            '# TYPE simpledb_conflicts_total counter',
+            'simpledb_conflicts_total{prefix="user:"} 1'])
+        self.assertTrue('simpledb_hot_key_samples{key="say \\"hi\\"\\n"} 1' in lines)
+        self.assertEqual(escape_label('a\\b'), 'a\\\\b')
+
+
+if __name__ == '__main__':
+    unittest.main()
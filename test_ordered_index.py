@@ -0,0 +1,86 @@
+import random
+import unittest
+import ordered_index
+from ordered_index import OrderedKeyIndex, decode_cursor, encode_cursor, prefix_end
+
+
+class TestOrderedKeyIndex(unittest.TestCase):
+    def setUp(self):
+        # Small chunks so splits and merges happen with few keys
+        self.chunk_size = ordered_index.CHUNK_SIZE
+        ordered_index.CHUNK_SIZE = 4
+        self.test_index = OrderedKeyIndex()
+
+    def tearDown(self):
+        ordered_index.CHUNK_SIZE = self.chunk_size
+
+    def test_add_remove(self):
+        keys = ['test_key_%03d' % i for i in range(200)]
+        shuffled = keys[:]
+        random.shuffle(shuffled)
+        for key in shuffled:
+            self.test_index.add(key)
+        self.test_index.add('test_key_000')
+        self.assertEqual(len(self.test_index), 200)
+        self.assertEqual(list(self.test_index), keys)
+        self.assertTrue('test_key_042' in self.test_index)
+        self.assertFalse('test_bad_key' in self.test_index)
+        self.assertTrue(max(map(len, self.test_index.chunks)) <= 8)
+
+        random.shuffle(shuffled)
+        for key in shuffled[:150]:
+            self.test_index.remove(key)
+        self.test_index.remove('test_bad_key')
+        self.assertEqual(list(self.test_index), sorted(shuffled[150:]))
+        self.assertEqual(self.test_index.maxes,
+                         [chunk[-1] for chunk in self.test_index.chunks])
+        for key in shuffled[150:]:
+            self.test_index.remove(key)
+        self.assertEqual(len(self.test_index), 0)
+        self.assertEqual(list(self.test_index), [])
+
+    def test_irange(self):
+        self.test_index.load(['%02d' % i for i in range(0, 50, 2)])
+        self.assertEqual(list(self.test_index.irange('10', '20')),
+                         ['10', '12', '14', '16', '18'])
+        self.assertEqual(list(self.test_index.irange('11', '21')),
+                         ['12', '14', '16', '18', '20'])
+        self.assertEqual(list(self.test_index.irange('10', '20', reverse=True)),
+                         ['18', '16', '14', '12', '10'])
+        self.assertEqual(list(self.test_index.irange(end='05')), ['00', '02', '04'])
+        self.assertEqual(list(self.test_index.irange('44', reverse=True)),
+                         ['48', '46', '44'])
+        self.assertEqual(list(self.test_index.irange(reverse=True)),
+                         ['%02d' % i for i in range(48, -1, -2)])
+        self.assertEqual(list(self.test_index.irange('20', '10')), [])
+        self.assertEqual(list(self.test_index.irange('99')), [])
+        self.assertEqual(list(self.test_index.irange('10', '20', inclusive=False)),
+                         ['12', '14', '16', '18'])
+
+    def test_irange_write(self):
+        self.test_index.load(['%02d' % i for i in range(20)])
+        seen = []
+        for key in self.test_index.irange():
+            seen.append(key)
+            if key == '05':
+                self.test_index.remove('06')
+                self.test_index.remove('10')
+                self.test_index.add('15a')
+        self.assertFalse('10' in seen)
+        self.assertTrue('15a' in seen)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_prefix_end(self):
+        self.assertEqual(prefix_end('user:'), 'user;')
+        self.assertEqual(prefix_end('a' + chr(0x10FFFF)), 'b')
+        self.assertEqual(prefix_end(''), None)
+
+    def test_cursor(self):
+        self.assertEqual(decode_cursor(encode_cursor('välue', None)), ('välue', None))
+        self.assertEqual(decode_cursor(encode_cursor('a', 'b')), ('a', 'b'))
+        with self.assertRaises(ValueError):
+            decode_cursor('bad cursor')
+
+
+if __name__ == '__main__':
+    unittest.main()
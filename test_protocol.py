@@ -0,0 +1,77 @@
+import unittest
+from protocol import ProtocolError, ReplyError, check_args, encode_command, encode_error, \
+    encode_integer, encode_value, parse_command, parse_reply, reply_exception, OK
+
+
+class TestProtocol(unittest.TestCase):
+    def test_command(self):
+        data = encode_command('PUT', 'test_key', 'välue\r\n')
+        self.assertEqual(parse_command(data), (['PUT', 'test_key', 'välue\r\n'], len(data)))
+        # Incomplete until the last byte
+        for end in range(len(data)):
+            self.assertEqual(parse_command(data[:end]), None)
+
+        pipelined = data + encode_command('GET', 'test_key')
+        args, offset = parse_command(pipelined)
+        self.assertEqual(parse_command(pipelined, offset)[0], ['GET', 'test_key'])
+
+    def test_bad_command(self):
+        with self.assertRaises(ProtocolError):
+            parse_command(b'GET test_key\r\n')
+        with self.assertRaises(ProtocolError):
+            parse_command(b'*1\r\n+OK\r\n')
+        with self.assertRaises(ProtocolError):
+            parse_command(b'*0\r\n')
+        with self.assertRaises(ProtocolError):
+            parse_command(b'*1\r\n$abc\r\n')
+        with self.assertRaises(ProtocolError):
+            parse_command(b'*1' + b'1' * 100)
+
+    def test_typed_reply(self):
+        self.assertEqual(encode_value(5), encode_integer(5))
+        self.assertEqual(encode_value(b'\x00\xff'), b'&2\r\n\x00\xff\r\n')
+        self.assertEqual(encode_value(memoryview(b'ab')), b'&2\r\nab\r\n')
+        for value in ('välue', b'\xff\xfe\x00', b'', -2 ** 70, 0.5, float('inf')):
+            reply = parse_reply(encode_value(value))[0]
+            self.assertEqual((reply, type(reply)), (value, type(value)))
+        self.assertEqual(parse_reply(encode_value(None) + OK), (None, 5))
+
+    def test_typed_command(self):
+        data = encode_command('PUT', 'test_key', b'\xff\x00') + \
+            encode_command('PUT', 'test_key', 7) + encode_command('PUT', 'test_key', 1.5)
+        args, offset = parse_command(data)
+        self.assertEqual(args, ['PUT', 'test_key', b'\xff\x00'])
+        args, offset = parse_command(data, offset)
+        self.assertEqual(args, ['PUT', 'test_key', 7])
+        args, offset = parse_command(data, offset)
+        self.assertEqual((args[2], type(args[2]), offset), (1.5, float, len(data)))
+        self.assertTrue(check_args(('GET', 'a', b'b', 1, 1.0)))
+        self.assertFalse(check_args(('GET', None)))
+        # Absent expected value of CAS
+        self.assertTrue(check_args(('cas', 'a', None, 'b')))
+        self.assertFalse(check_args(('CAS', 'a', 'b', None)))
+        data = encode_command('CAS', 'a', None, 'b')
+        self.assertEqual(parse_command(data), (['CAS', 'a', None, 'b'], len(data)))
+        with self.assertRaises(ProtocolError):
+            parse_command(b'*1\r\n:abc\r\n')
+
+    def test_reply(self):
+        data = OK + encode_value('foo') + encode_integer(42) + \
+            encode_error(KeyError('test_key')) + encode_error(Exception("Error, bad"))
+        replies = []
+        offset = 0
+        while offset < len(data):
+            reply, offset = parse_reply(data, offset)
+            replies.append(reply)
+        self.assertEqual(replies[:3], [None, 'foo', 42])
+        self.assertTrue(isinstance(replies[3], ReplyError))
+        error = reply_exception(replies[3])
+        self.assertTrue(isinstance(error, KeyError))
+        self.assertEqual(error.args, ('test_key',))
+        self.assertEqual(str(reply_exception(replies[4])), "Error, bad")
+        self.assertTrue(isinstance(reply_exception(ReplyError('TYPEERROR ')), TypeError))
+        self.assertEqual(parse_reply(encode_value('foo')[:-1]), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import multiprocessing
+import socket
+import threading
+import time
+import unittest
+from db import SimpleDB
+from replication import ReplicationServer, Replica
+
+
+def run_primary(connection):
+    db = SimpleDB({'a': 'foo'}, thread_safe=True, changefeed=1024)
+    server = ReplicationServer(db, port=0)
+    server.start()
+    connection.send(server.port)
+    for i in range(100):
+        db.put('key_%d' % i, str(i))
+    db.delete('a')
+    connection.send(db.commit_seq)
+    connection.recv()
+    server.close()
+    db.close()
+
+
+class TestReplication(unittest.TestCase):
+    def setUp(self):
+        self.primary = SimpleDB({'a': 'foo'}, thread_safe=True, changefeed=8, ordered_index=True)
+        self.server = ReplicationServer(self.primary, port=0)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.close()
+        self.primary.close()
+
+    def test_replicate(self):
+        with Replica(port=self.server.port, ordered_index=True) as replica:
+            # Bootstrap from a snapshot
+            self.assertTrue(replica.wait_for(self.primary.commit_seq, 5))
+            self.assertEqual(replica.get('a'), 'foo')
+            self.primary.put('b', 'bar', ttl=100)
+            self.primary.createTransaction('abc')
+            self.primary.put('c', 'baz', 'abc')
+            self.primary.delete('a', 'abc')
+            self.primary.commitTransaction('abc')
+            self.assertTrue(replica.wait_for(self.primary.commit_seq, 5))
+            self.assertEqual(replica.getDB(), {'b': 'bar', 'c': 'baz'})
+            self.assertEqual(replica.db.commit_seq, self.primary.commit_seq)
+            self.assertTrue(replica.get_ttl('b') > 99)
+            self.assertEqual(list(replica.scan()), [('b', 'bar'), ('c', 'baz')])
+            with self.assertRaises(Exception):
+                replica.get('a')
+            self.assertEqual(self.server.snapshots_sent, 1)
+            # Caught up once a heartbeat tells it so
+            deadline = time.monotonic() + 5
+            while replica.lag()['commits'] and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(replica.lag(), {'commits': 0, 'seconds': 0.0, 'connected': True})
+
+    def test_reconnect(self):
+        with Replica(port=self.server.port) as replica:
+            self.assertTrue(replica.wait_for(self.primary.commit_seq, 5))
+            # Drop the connection, commits made meanwhile are resumed from the feed
+            for connection in list(self.server.connections):
+                connection.close()
+            self.primary.put('b', 'bar')
+            self.assertTrue(replica.wait_for(self.primary.commit_seq, 5))
+            self.assertEqual(replica.get('b'), 'bar')
+            # Further behind than the changefeed holds while the primary is
+            # down, loaded from a snapshot again
+            self.server.close()
+            for i in range(20):
+                self.primary.put('key_%d' % i, str(i))
+            self.server = ReplicationServer(self.primary, port=0)
+            self.server.start()
+            replica.port = self.server.port
+            self.assertTrue(replica.wait_for(self.primary.commit_seq, 5))
+            self.assertEqual(replica.getDB(), self.primary.getDB())
+            self.assertEqual(self.server.snapshots_sent, 1)
+
+    def test_expiry(self):
+        self.primary.put('b', 'bar', ttl=10)
+        with Replica(port=self.server.port, ordered_index=True) as replica:
+            self.assertTrue(replica.wait_for(self.primary.commit_seq, 5))
+            # Due on the replica, hidden but left for the primary to expire
+            replica.db.clock = lambda: time.time() + 20
+            with self.assertRaises(KeyError):
+                replica.get('b')
+            self.assertEqual(replica.get_many(['a', 'b']), ['foo', None])
+            self.assertEqual(list(replica.scan()), [('a', 'foo')])
+            self.assertEqual(replica.scan_page()[1], [('a', 'foo')])
+            with self.assertRaises(Exception):
+                replica.get_ttl('b')
+            self.assertEqual(replica.db.expire_cycle(), 0)
+            self.assertTrue('b' in replica.getDB())
+            self.assertEqual(replica.db.commit_seq, self.primary.commit_seq)
+            self.primary.clock = lambda: time.time() + 20
+            self.assertEqual(self.primary.expire_cycle(), 1)
+            self.primary.put('c', 'baz')
+            self.assertTrue(replica.wait_for(self.primary.commit_seq, 5))
+            self.assertEqual(replica.getDB(), {'a': 'foo', 'c': 'baz'})
+
+    def test_primary_closed(self):
+        connection, other = socket.socketpair()
+        stream = threading.Thread(target=self.server.stream,
+                                  args=(connection, self.primary.commit_seq), daemon=True)
+        stream.start()
+        # Ends instead of sending heartbeats forever
+        self.primary.close()
+        stream.join(5)
+        self.assertFalse(stream.is_alive())
+        connection.close()
+        other.close()
+
+    def test_options(self):
+        with self.assertRaises(ValueError):
+            ReplicationServer(SimpleDB(changefeed=8))
+        with self.assertRaises(ValueError):
+            Replica(port=self.server.port, wal_path='replica.wal')
+        with self.assertRaises(ValueError):
+            Replica(port=self.server.port, maxmemory=1000)
+
+    def test_process(self):
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=run_primary, args=(child,))
+        process.start()
+        try:
+            with Replica(port=parent.recv()) as replica:
+                commit_seq = parent.recv()
+                self.assertTrue(replica.wait_for(commit_seq, 5))
+                self.assertEqual(len(replica.getDB()), 100)
+                self.assertEqual(replica.get('key_99'), '99')
+        finally:
+            parent.send(None)
+            process.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
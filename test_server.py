@@ -0,0 +1,134 @@
+import asyncio
+import unittest
+from client import AsyncClient
+from db import SimpleDB
+from protocol import encode_command, parse_reply
+from server import Server
+
+
+class TestServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.test_db = SimpleDB({'a': 'foo'})
+        self.server = Server(self.test_db, port=0)
+        await self.server.start()
+        self.client = AsyncClient(port=self.server.port, pool_size=2)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+
+    async def test_commands(self):
+        self.assertEqual(await self.client.get('a'), 'foo')
+        await self.client.put('b', 'bar')
+        await self.client.delete('a')
+        self.assertEqual(self.test_db.getDB(), {'b': 'bar'})
+        with self.assertRaises(KeyError):
+            await self.client.get('a')
+        with self.assertRaises(Exception):
+            await self.client.delete('a')
+        with self.assertRaises(Exception):
+            await self.client.execute('BAD')
+        with self.assertRaises(Exception):
+            await self.client.execute('GET')
+        with self.assertRaises(TypeError):
+            await self.client.get(None)
+        await self.client.ping()
+
+    async def test_atomic(self):
+        self.assertEqual(await self.client.incr('n'), 1)
+        self.assertEqual(await self.client.incr('n', 5), 6)
+        self.assertEqual(await self.client.decr('n', 2), 4)
+        self.assertEqual(await self.client.append('a', 'bar'), 6)
+        self.assertEqual(await self.client.getset('a', 'baz'), 'foobar')
+        self.assertEqual(await self.client.getset('b', 'new'), None)
+        self.assertTrue(await self.client.cas('a', 'baz', 'qux'))
+        self.assertFalse(await self.client.cas('a', 'baz', 'quux'))
+        # Only if absent
+        self.assertTrue(await self.client.cas('d', None, 'new'))
+        self.assertFalse(await self.client.cas('d', None, 'other'))
+        await self.client.delete('d')
+        self.assertTrue(await self.client.setnx('c', 'x'))
+        self.assertFalse(await self.client.setnx('c', 'y'))
+        self.assertEqual(self.test_db.getDB(), {'a': 'qux', 'b': 'new', 'c': 'x', 'n': '4'})
+        with self.assertRaises(Exception):
+            await self.client.execute('INCR', 'n', 'abc')
+        await self.client.createTransaction('abc')
+        self.assertEqual(await self.client.incr('n', 1, 'abc'), None)
+        self.assertTrue(await self.client.cas('a', 'qux', 'abc', 'abc'))
+        await self.client.commitTransaction('abc')
+        self.assertEqual(self.test_db.get_many(['a', 'n']), ['abc', '5'])
+
+    async def test_typed(self):
+        await self.client.put('bin', b'\xff\xfe\x00')
+        await self.client.put('int', 2 ** 70)
+        await self.client.put('float', 0.5)
+        self.assertEqual(self.test_db.get_many(['bin', 'int', 'float']),
+                         [b'\xff\xfe\x00', 2 ** 70, 0.5])
+        # A value that is not utf-8 does not break the replies after it
+        replies = await self.client.pipeline([('GET', 'a'), ('GET', 'bin'), ('GET', 'int'),
+                                              ('GET', 'float'), ('GET', 'a')])
+        self.assertEqual(replies, ['foo', b'\xff\xfe\x00', 2 ** 70, 0.5, 'foo'])
+        self.assertEqual([type(reply) for reply in replies[1:4]], [bytes, int, float])
+        self.assertEqual(await self.client.append('bin', b'\x01'), 4)
+        self.assertEqual(await self.client.get('bin'), b'\xff\xfe\x00\x01')
+        self.assertTrue(await self.client.cas('int', 2 ** 70, 1.5))
+        self.assertEqual(await self.client.get('int'), 1.5)
+        with self.assertRaises(TypeError):
+            await self.client.put('a', None)
+
+    async def test_transaction(self):
+        await self.client.createTransaction('abc')
+        await self.client.put('a', 'bar', 'abc')
+        self.assertEqual(await self.client.get('a', 'abc'), 'bar')
+        self.assertEqual(await self.client.get('a'), 'foo')
+        await self.client.commitTransaction('abc')
+        self.assertEqual(await self.client.get('a'), 'bar')
+
+        await self.client.createTransaction('def')
+        await self.client.delete('a', 'def')
+        await self.client.rollbackTransaction('def')
+        self.assertEqual(await self.client.get('a'), 'bar')
+        with self.assertRaises(Exception):
+            await self.client.commitTransaction('def')
+
+    async def test_pipeline(self):
+        commands = [('PUT', 'key_%d' % i, 'value_%d' % i) for i in range(1000)]
+        commands.append(('GET', 'key_999'))
+        commands.append(('GET', 'bad_key'))
+        replies = await self.client.pipeline(commands)
+        self.assertEqual(replies[:1000], [None] * 1000)
+        self.assertEqual(replies[1000], 'value_999')
+        self.assertTrue(isinstance(replies[1001], KeyError))
+
+        # Concurrent requests share the pool
+        values = await asyncio.gather(*[self.client.get('key_%d' % i) for i in range(200)])
+        self.assertEqual(values, ['value_%d' % i for i in range(200)])
+        self.assertTrue(1 <= len(self.client.connections) <= 2)
+
+    async def test_disconnect(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.server.port)
+        writer.write(encode_command('BEGIN', 'abc') + encode_command('PUT', 'a', 'bar', 'abc'))
+        await writer.drain()
+        data = await reader.readexactly(10)
+        self.assertEqual(parse_reply(data)[0], None)
+        self.assertTrue('abc' in self.test_db.transaction)
+        # Transactions left open by a closed connection are rolled back
+        writer.close()
+        await writer.wait_closed()
+        for _ in range(100):
+            if 'abc' not in self.test_db.transaction:
+                break
+            await asyncio.sleep(0.01)
+        self.assertFalse('abc' in self.test_db.transaction)
+
+    async def test_protocol_error(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.server.port)
+        writer.write(b'GET a\r\n')
+        await writer.drain()
+        reply = await reader.read()
+        self.assertTrue(reply.startswith(b'-ERR'))
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import os
+import tempfile
+import unittest
+from sharded import PartialCommitError, ShardedDB
+
+
+class TestShardedDB(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_db = ShardedDB(shards=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.test_db.close()
+
+    def setUp(self):
+        self.test_db.delete_many(self.test_db.getDB())
+        self.keys = ['key_%d' % i for i in range(30)]
+        self.test_db.put_many({key: 'foo' for key in self.keys})
+
+    def test_routing(self):
+        self.assertEqual(len({self.test_db.shard_of(key) for key in self.keys}), 3)
+        self.test_db.put('key_0', 'bar')
+        self.assertEqual(self.test_db.get('key_0'), 'bar')
+        self.test_db.delete('key_1')
+        with self.assertRaises(KeyError):
+            self.test_db.get('key_1')
+        with self.assertRaises(Exception):
+            self.test_db.delete('key_1')
+        with self.assertRaises(TypeError):
+            self.test_db.put('key_1', None)
+        self.assertEqual(self.test_db.get_many(['key_2', 'bad_key', 'key_0']),
+                         ['foo', None, 'bar'])
+        self.assertEqual(len(self.test_db.getDB()), 29)
+
+    def test_typed(self):
+        self.test_db.put('key_0', memoryview(b'\x00\xff'))
+        self.test_db.put_many({'key_1': 7, 'key_2': memoryview(b'abc'), 'key_3': 0.5})
+        self.assertEqual(self.test_db.get_many(['key_0', 'key_1', 'key_2', 'key_3']),
+                         [b'\x00\xff', 7, b'abc', 0.5])
+
+    def test_atomic(self):
+        self.assertEqual(self.test_db.incr('counter', 3), 3)
+        self.assertEqual(self.test_db.decr('counter'), 2)
+        self.assertEqual(self.test_db.append('key_0', 'bar'), 6)
+        self.assertTrue(self.test_db.cas('key_0', 'foobar', 'baz'))
+        self.assertFalse(self.test_db.cas('key_0', 'foobar', 'qux'))
+        self.assertEqual(self.test_db.getset('key_1', memoryview(b'x')), 'foo')
+        self.assertFalse(self.test_db.setnx('key_2', 'bar'))
+        self.assertTrue(self.test_db.setnx('new_key', 'bar', ttl=100))
+        self.assertEqual(self.test_db.get_many(['key_0', 'key_1', 'new_key', 'counter']),
+                         ['baz', b'x', 'bar', '2'])
+        self.test_db.createTransaction('abc')
+        self.assertEqual(self.test_db.getset('key_3', 'bar', 'abc'), 'foo')
+        self.assertTrue(self.test_db.cas('key_4', 'foo', 'bar', 'abc'))
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.get_many(['key_3', 'key_4']), ['bar', 'bar'])
+        self.test_db.delete_many(['counter', 'new_key'])
+
+    def test_many_atomic(self):
+        # Missing key on one shard fail the delete on every shard
+        with self.assertRaises(Exception):
+            self.test_db.delete_many(self.keys + ['bad_key'])
+        self.assertEqual(len(self.test_db.getDB()), 30)
+        self.test_db.delete_many(self.keys[:10])
+        self.assertEqual(len(self.test_db.getDB()), 20)
+
+    def test_single_shard_transaction(self):
+        shard = self.test_db.shard_of('key_0')
+        same_shard = [key for key in self.keys if self.test_db.shard_of(key) == shard]
+        self.test_db.createTransaction('abc')
+        for key in same_shard:
+            self.test_db.put(key, 'bar', 'abc')
+        self.assertEqual(self.test_db.get('key_0', 'abc'), 'bar')
+        self.assertEqual(self.test_db.get('key_0'), 'foo')
+        self.test_db.commitTransaction('abc')
+        self.assertEqual(self.test_db.get_many(same_shard), ['bar'] * len(same_shard))
+
+    def test_cross_shard_transaction(self):
+        self.test_db.createTransaction('abc')
+        self.test_db.put_many({key: 'bar' for key in self.keys}, 'abc')
+        self.test_db.delete('key_5', 'abc')
+        self.test_db.commitTransaction('abc')
+        data = self.test_db.getDB()
+        self.assertEqual(len(data), 29)
+        self.assertEqual(set(data.values()), {'bar'})
+
+        self.test_db.createTransaction('def')
+        self.test_db.put_many({key: 'baz' for key in self.keys}, 'def')
+        self.test_db.rollbackTransaction('def')
+        self.assertEqual(set(self.test_db.getDB().values()), {'bar'})
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('def')
+
+    def test_cross_shard_conflict(self):
+        self.test_db.createTransaction('abc')
+        for key in self.keys:
+            self.test_db.get(key, 'abc')
+            self.test_db.put(key, 'bar', 'abc')
+        # A conflict on a single shard abort the commit on every shard
+        self.test_db.put('key_7', 'baz')
+        with self.assertRaises(Exception):
+            self.test_db.commitTransaction('abc')
+        data = self.test_db.getDB()
+        self.assertEqual(data['key_7'], 'baz')
+        self.assertFalse('bar' in data.values())
+
+    def test_cross_shard_merge_conflict(self):
+        other = next(key for key in self.keys
+                     if self.test_db.shard_of(key) != self.test_db.shard_of('key_0'))
+        self.test_db.put('key_0', '5')
+        self.test_db.createTransaction('abc')
+        self.test_db.incr('key_0', 1, 'abc')
+        self.test_db.put(other, 'bar', 'abc')
+        # The merge can no longer apply, found at prepare before any shard commits
+        self.test_db.put('key_0', 'not a number')
+        with self.assertRaises(Exception) as context:
+            self.test_db.commitTransaction('abc')
+        self.assertEqual(str(context.exception), 'Transaction Commit Fail')
+        self.assertEqual(self.test_db.get_many(['key_0', other]), ['not a number', 'foo'])
+
+        self.test_db.put('key_0', '5')
+        self.test_db.createTransaction('def')
+        self.test_db.incr('key_0', 1, 'def')
+        self.test_db.put(other, 'bar', 'def')
+        self.test_db.commitTransaction('def')
+        self.assertEqual(self.test_db.get_many(['key_0', other]), ['6', 'bar'])
+
+    def test_partial_commit(self):
+        failing = self.test_db.shard_of('key_0')
+        other = next(key for key in self.keys if self.test_db.shard_of(key) != failing)
+        self.test_db.createTransaction('abc')
+        self.test_db.put('key_0', 'bar', 'abc')
+        self.test_db.put(other, 'bar', 'abc')
+        run = self.test_db.run
+
+        # One shard fails to apply after every shard prepared
+        def failing_run(batches):
+            if batches.get(failing, [(None,)])[0][0] == 'commitTransaction':
+                batches = {**batches, failing: [('bad_method', ())]}
+            return run(batches)
+
+        self.test_db.run = failing_run
+        try:
+            with self.assertRaises(PartialCommitError) as context:
+                self.test_db.commitTransaction('abc')
+        finally:
+            del self.test_db.run
+        self.assertEqual(list(context.exception.failed), [failing])
+        self.assertEqual(context.exception.committed, [self.test_db.shard_of(other)])
+        self.assertEqual(self.test_db.get_many(['key_0', other]), ['foo', 'bar'])
+        # The failed shard no longer holds its key
+        self.test_db.put('key_0', 'baz')
+
+    def test_shard_files(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            wal_path = os.path.join(data_dir, 'db.wal')
+            with ShardedDB(shards=2, wal_path=wal_path) as test_db:
+                test_db.put_many({key: 'foo' for key in self.keys})
+            self.assertTrue(os.path.exists(wal_path + '.0'))
+            self.assertTrue(os.path.exists(wal_path + '.1'))
+            with ShardedDB(shards=2, wal_path=wal_path) as test_db:
+                self.assertEqual(len(test_db.getDB()), 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
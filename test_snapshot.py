@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+from db import SimpleDB
+from snapshot import write_snapshot, load_snapshot
+from wal import replay
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.test_path = os.path.join(self.test_dir.name, 'test.snap')
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def test_write_load(self):
+        test_data = {'test_key_%d' % i: 'test_val_%d' % i for i in range(100)}
+        test_data['ключ'] = 'значение'
+        write_snapshot(self.test_path, test_data, 42)
+        self.assertEqual(load_snapshot(self.test_path), (42, test_data, {}))
+
+        # Keys or values holding the separator
+        test_data['test\0key'] = 'test\0val'
+        write_snapshot(self.test_path, test_data, 43)
+        self.assertEqual(load_snapshot(self.test_path), (43, test_data, {}))
+
+        test_expires = {'test_key_1': 1000.5, 'ключ': 2000.25}
+        write_snapshot(self.test_path, test_data, 44, test_expires)
+        self.assertEqual(load_snapshot(self.test_path),
+                         (44, test_data, test_expires))
+
+        # Values other than str, with keys still joined
+        test_data = {'bytes': b'\x00\xff', 'int': 2 ** 64, 'float': -0.25, 'str': 'välue'}
+        write_snapshot(self.test_path, test_data, 45, {'int': 10.0})
+        self.assertEqual(load_snapshot(self.test_path), (45, test_data, {'int': 10.0}))
+        test_data['test\0key'] = memoryview(b'view')
+        write_snapshot(self.test_path, test_data, 45)
+        test_data['test\0key'] = b'view'
+        self.assertEqual(load_snapshot(self.test_path), (45, test_data, {}))
+
+        write_snapshot(self.test_path, {}, 45)
+        self.assertEqual(load_snapshot(self.test_path), (45, {}, {}))
+        write_snapshot(self.test_path, {'': ''}, 46)
+        self.assertEqual(load_snapshot(self.test_path), (46, {'': ''}, {}))
+
+    def test_bad_file(self):
+        with open(self.test_path, 'wb') as bad_file:
+            bad_file.write(b'not a snapshot file at all, really not')
+        with self.assertRaises(Exception):
+            load_snapshot(self.test_path)
+
+        write_snapshot(self.test_path, {'test_key': 'test_val'}, 1)
+        with open(self.test_path, 'r+b') as bad_file:
+            bad_file.truncate(os.path.getsize(self.test_path) - 1)
+        with self.assertRaises(Exception):
+            load_snapshot(self.test_path)
+
+
+class TestSimpleDB_Snapshot(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.test_path = os.path.join(self.test_dir.name, 'test.snap')
+        self.test_wal_path = os.path.join(self.test_dir.name, 'test.wal')
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def test_save_load(self):
+        test_db = SimpleDB({'a': 'foo', 'b': 'bar'})
+        test_db.put('c', 'baz')
+        snapshot_seq = test_db.save_snapshot(self.test_path)
+        self.assertEqual(snapshot_seq, test_db.commit_seq)
+
+        loaded_db = SimpleDB(snapshot_path=self.test_path)
+        self.assertEqual(loaded_db.getDB(), test_db.getDB())
+        self.assertEqual(loaded_db.commit_seq, snapshot_seq)
+        self.assertEqual(loaded_db.get('c'), 'baz')
+        loaded_db.put('d', 'foo')
+        self.assertEqual(loaded_db.db_transaction_id['d'], snapshot_seq + 1)
+
+        with self.assertRaises(Exception):
+            SimpleDB({'a': 'foo'}, snapshot_path=self.test_path)
+        with self.assertRaises(Exception):
+            SimpleDB().save_snapshot()
+
+    def test_bgsave(self):
+        test_db = SimpleDB(thread_safe=True, snapshot_path=self.test_path)
+        test_db.put_many({'key_%d' % i: 'val' for i in range(1000)})
+        pid = test_db.bgsave()
+        # Commit made after the fork are not in the snapshot
+        test_db.put('after_fork', 'val')
+        test_db.wait_snapshot(pid)
+        snapshot_seq, data, _ = load_snapshot(self.test_path)
+        self.assertEqual(len(data), 1000)
+        self.assertEqual(snapshot_seq, test_db.commit_seq - 1)
+
+    def test_checkpoint_recovery(self):
+        test_db = SimpleDB(wal_path=self.test_wal_path, snapshot_path=self.test_path)
+        test_db.put_many({'a': 'foo', 'b': 'foo'})
+        test_db.put('ttl_key', 'foo', ttl=100)
+        test_db.delete('b')
+        snapshot_seq = test_db.checkpoint()
+        # Log only hold commits after the checkpoint
+        self.assertEqual(list(replay(self.test_wal_path)), [])
+        test_db.put('c', 'bar')
+        test_db.put('a', 'bar')
+        test_db.close()
+        self.assertEqual(len(list(replay(self.test_wal_path))), 2)
+
+        recovered_db = SimpleDB(wal_path=self.test_wal_path,
+                                snapshot_path=self.test_path)
+        self.assertEqual(recovered_db.getDB(),
+                         {'a': 'bar', 'c': 'bar', 'ttl_key': 'foo'})
+        self.assertEqual(recovered_db.expiry.deadlines, test_db.expiry.deadlines)
+        self.assertEqual(recovered_db.commit_seq, test_db.commit_seq)
+        # Keys from the snapshot carry the snapshot commit_seq
+        self.assertEqual(recovered_db.db_transaction_id['ttl_key'], snapshot_seq)
+        self.assertEqual(recovered_db.db_transaction_id['a'],
+                         test_db.db_transaction_id['a'])
+        recovered_db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+from storage import ArenaStore, make_storage, version_map
+
+
+class TestArenaStore(unittest.TestCase):
+    def setUp(self):
+        self.test_store = ArenaStore(intern_max=8, compress_min=64)
+
+    def test_mapping(self):
+        self.test_store['a'] = 'foo'
+        self.test_store['b'] = 'välue'
+        self.test_store.update({'c': '', 'd': 'x' * 100})
+        self.assertEqual(len(self.test_store), 4)
+        self.assertEqual(self.test_store['b'], 'välue')
+        self.assertEqual(self.test_store['c'], '')
+        self.assertEqual(self.test_store.get('bad_key'), None)
+        self.assertTrue('a' in self.test_store)
+        self.assertEqual(self.test_store, {'a': 'foo', 'b': 'välue', 'c': '', 'd': 'x' * 100})
+        self.assertEqual(self.test_store.pop('a'), 'foo')
+        self.assertEqual(self.test_store.pop('a', None), None)
+        with self.assertRaises(KeyError):
+            self.test_store.pop('a')
+        del self.test_store['b']
+        with self.assertRaises(KeyError):
+            self.test_store['b']
+        self.assertEqual(sorted(self.test_store), ['c', 'd'])
+
+    def test_typed(self):
+        test_data = {'a': b'\x00' * 100, 'b': memoryview(b'abc'), 'c': -2 ** 70, 'd': 1.5,
+                     'e': 'abc', 'f': b'abc'}
+        self.test_store.update(test_data)
+        test_data['b'] = b'abc'
+        self.assertEqual(dict(self.test_store.items()), test_data)
+        # 'abc' and b'abc' share one interned copy, read back each with its own type
+        self.assertEqual(self.test_store.stats()['interned_values'], 2)
+        self.test_store['a'] = 7
+        self.assertEqual(self.test_store.pop('a'), 7)
+
+    def test_reuse(self):
+        self.test_store['a'] = 'long value 1'
+        size = len(self.test_store.arena)
+        # Same size class, overwritten in place
+        self.test_store['a'] = 'long value 22'
+        self.assertEqual(len(self.test_store.arena), size)
+        # Freed slot is reused by the next value of its class
+        del self.test_store['a']
+        self.test_store['b'] = 'other value'
+        self.assertEqual(len(self.test_store.arena), size)
+        self.assertEqual(self.test_store['b'], 'other value')
+        self.test_store['b'] = 'x' * 40
+        self.assertEqual(self.test_store.stats()['free_bytes'], 32)
+
+    def test_intern(self):
+        for i in range(10):
+            self.test_store['key_%d' % i] = 'red'
+        self.assertEqual(self.test_store.stats()['interned_values'], 1)
+        self.assertEqual(list(self.test_store.references.values()), [10])
+        for i in range(9):
+            del self.test_store['key_%d' % i]
+        self.assertEqual(self.test_store['key_9'], 'red')
+        self.test_store['key_9'] = 'blue'
+        self.assertEqual(list(self.test_store.interned), [b'blue'])
+        self.assertEqual(self.test_store['key_9'], 'blue')
+
+    def test_resize(self):
+        for i in range(1000):
+            self.test_store['key_%d' % i] = 'value_%d' % i
+        for i in range(0, 1000, 2):
+            del self.test_store['key_%d' % i]
+        for i in range(1000, 1500):
+            self.test_store['key_%d' % i] = 'value_%d' % i
+        self.assertEqual(len(self.test_store), 1000)
+        self.assertTrue(self.test_store.filled * 3 <= len(self.test_store.offsets) * 2)
+        self.assertEqual(self.test_store['key_999'], 'value_999')
+        self.assertFalse('key_998' in self.test_store)
+        self.assertEqual(sorted(self.test_store.items())[0], ('key_1', 'value_1'))
+
+    def test_versions(self):
+        self.test_store.update({'a': 'foo', 'b': 'bar'})
+        versions = version_map(self.test_store, 7)
+        self.assertEqual(dict(versions), {'a': 7, 'b': 7})
+        versions.update({'a': 8})
+        self.test_store['a'] = 'new value'
+        self.assertEqual(versions['a'], 8)
+        with self.assertRaises(KeyError):
+            versions['c'] = 1
+        self.test_store.pop('b')
+        self.assertEqual(versions.pop('b', None), None)
+        self.assertEqual(versions.get('b'), None)
+
+    def test_compress(self):
+        value = 'abc' * 1000
+        self.test_store['a'] = value
+        self.assertTrue(len(self.test_store.arena) < 1000)
+        self.assertEqual(self.test_store['a'], value)
+        # Random looking data is stored as is
+        noise = ''.join(chr(33 + (i * 7919) % 90) for i in range(100))
+        self.test_store['b'] = noise
+        self.assertEqual(self.test_store['b'], noise)
+
+    def test_make_storage(self):
+        self.assertEqual(type(make_storage('dict')), dict)
+        self.assertEqual(make_storage('arena', {'a': 'foo'})['a'], 'foo')
+        self.assertTrue(make_storage(self.test_store) is self.test_store)
+        with self.assertRaises(ValueError):
+            make_storage('bad_storage')
+
+
+if __name__ == '__main__':
+    unittest.main()
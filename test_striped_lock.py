@@ -0,0 +1,49 @@
+import threading
+import unittest
+from striped_lock import StripedLock
+
+
+class TestStripedLock(unittest.TestCase):
+    def setUp(self):
+        self.test_lock = StripedLock(8)
+
+    def test_for_key(self):
+        self.assertIs(self.test_lock.for_key('test_key'),
+                      self.test_lock.for_key('test_key'))
+
+        with self.assertRaises(Exception):
+            StripedLock(0)
+
+    def test_hold(self):
+        keys = ['test_key_%d' % i for i in range(20)]
+        with self.test_lock.hold(keys):
+            for key in keys:
+                self.assertTrue(self.test_lock.for_key(key).locked())
+        for lock in self.test_lock.locks:
+            self.assertFalse(lock.locked())
+
+        with self.test_lock.hold_all():
+            for lock in self.test_lock.locks:
+                self.assertTrue(lock.locked())
+        for lock in self.test_lock.locks:
+            self.assertFalse(lock.locked())
+
+    def test_hold_no_deadlock(self):
+        keys = ['test_key_%d' % i for i in range(20)]
+
+        def worker(worker_keys):
+            for _ in range(200):
+                with self.test_lock.hold(worker_keys):
+                    pass
+
+        threads = [threading.Thread(target=worker, args=(keys,)),
+                   threading.Thread(target=worker, args=(keys[::-1],))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from storage import make_storage, version_map
+from tiered import TieredStore
+
+
+class TestTieredStore(unittest.TestCase):
+    def setUp(self):
+        self.test_store = TieredStore(hot_keys=2, batch_size=2)
+
+    def tearDown(self):
+        self.test_store.close()
+
+    def test_mapping(self):
+        self.test_store.update({'a': 'foo', 'b': b'bar', 'c': 3, 'd': 1.5, 'e': 'välue'})
+        self.assertEqual(len(self.test_store), 5)
+        self.assertEqual(self.test_store.stats()['resident_keys'], 2)
+        # Read through from disk
+        self.assertEqual(self.test_store['a'], 'foo')
+        self.assertEqual(self.test_store['b'], b'bar')
+        self.assertEqual(self.test_store.get('bad_key'), None)
+        self.assertTrue('c' in self.test_store)
+        self.assertEqual(self.test_store, {'a': 'foo', 'b': b'bar', 'c': 3, 'd': 1.5, 'e': 'välue'})
+        self.assertEqual(self.test_store.pop('c'), 3)
+        self.assertEqual(self.test_store.pop('c', None), None)
+        with self.assertRaises(KeyError):
+            self.test_store.pop('c')
+        del self.test_store['a']
+        with self.assertRaises(KeyError):
+            self.test_store['a']
+        self.assertEqual(sorted(self.test_store), ['b', 'd', 'e'])
+        self.assertEqual(len(self.test_store), 3)
+        # Put back after its delete was buffered
+        self.test_store['a'] = 'new'
+        self.test_store.update({'x': '1', 'y': '2', 'z': '3'})
+        self.assertEqual(self.test_store['a'], 'new')
+        self.assertEqual(len(self.test_store), 7)
+
+    def test_write_behind(self):
+        self.test_store.update({'a': '1', 'b': '2'})
+        # Resident and dirty, nothing written yet
+        self.assertEqual(self.test_store.stats()['rows_written'], 0)
+        self.test_store['c'] = '3'
+        self.assertEqual(self.test_store.stats()['pending_writes'], 1)
+        self.test_store['d'] = '4'
+        # Batch of two written at once
+        stats = self.test_store.stats()
+        self.assertEqual((stats['pending_writes'], stats['flushes'], stats['rows_written']), (0, 1, 2))
+        # Read back clean, pushing out the dirty c and d
+        self.test_store['a']
+        self.test_store['b']
+        self.assertEqual(self.test_store.stats()['rows_written'], 4)
+        # Clean ones are pushed out without a write
+        self.test_store['c']
+        self.test_store['d']
+        self.assertEqual(self.test_store.stats()['pending_writes'], 0)
+        self.test_store.flush()
+        self.assertEqual(self.test_store.stats()['rows_written'], 4)
+
+    def test_versions(self):
+        versions = version_map(self.test_store)
+        self.test_store.update({'a': '1', 'b': '2', 'c': '3', 'd': '4', 'e': '5'})
+        for version, key in enumerate('abcde'):
+            versions[key] = version
+        self.assertEqual(self.test_store.stats()['resident_keys'], 2)
+        self.assertEqual([versions[key] for key in 'abcde'], [0, 1, 2, 3, 4])
+        # Overwriting a key that is not resident keep its version
+        self.test_store['a'] = '10'
+        self.assertEqual(versions['a'], 0)
+        self.assertEqual(versions.get('bad_key'), None)
+        with self.assertRaises(KeyError):
+            versions['bad_key'] = 1
+        self.test_store.pop('b')
+        with self.assertRaises(KeyError):
+            versions['b']
+        version_map(self.test_store, 9)
+        self.assertEqual(set(versions.values()), {9})
+
+    def test_path(self):
+        path = os.path.join(tempfile.mkdtemp(), 'tiered.db')
+        test_store = make_storage(TieredStore(path, hot_keys=1, batch_size=1), {'a': '1', 'b': '2'})
+        self.assertTrue(os.path.exists(path))
+        test_store.close()
+        # Scratch space, emptied when opened again
+        test_store = TieredStore(path)
+        self.assertEqual(len(test_store), 0)
+        self.assertEqual(test_store.get('a'), None)
+        test_store.close()
@@ -0,0 +1,47 @@
+import unittest
+from value_index import ValueIndex
+
+
+class TestValueIndex(unittest.TestCase):
+    def test_exact(self):
+        test_index = ValueIndex()
+        db = {'a': 'foo', 'b': 'bar'}
+        test_index.load(db)
+        self.assertEqual(test_index.keys_equal('foo'), ['a'])
+
+        changes = test_index.changes(db, {'b': 'foo', 'c': 'baz'}, ['a'])
+        # Nothing change until apply
+        self.assertEqual(test_index.keys_equal('foo'), ['a'])
+        test_index.apply(changes)
+        self.assertEqual(test_index.keys_equal('foo'), ['b'])
+        self.assertEqual(test_index.keys_equal('bar'), [])
+        self.assertEqual(sorted(test_index.buckets), ['baz', 'foo'])
+        self.assertEqual(len(test_index), 2)
+        with self.assertRaises(Exception):
+            test_index.keys_prefix('f')
+
+    def test_prefix(self):
+        test_index = ValueIndex('prefix', lambda value: value.split('@')[-1]
+                                if '@' in value else None)
+        test_index.load({'a': 'foo@mail.com', 'b': 'bar@mail.org', 'c': 'baz',
+                         'd': 'qux@mail.com'})
+        self.assertEqual(len(test_index), 3)
+        self.assertEqual(list(test_index.keys_equal('mail.com')), ['a', 'd'])
+        self.assertEqual(list(test_index.keys_prefix('mail.')), ['a', 'd', 'b'])
+        self.assertEqual(list(test_index.keys_prefix('bad')), [])
+        self.assertTrue(test_index.matches('x@mail.org', prefix='mail.'))
+        self.assertFalse(test_index.matches('baz', equals='baz'))
+
+    def test_bad_index(self):
+        with self.assertRaises(Exception):
+            ValueIndex('bad_kind')
+        with self.assertRaises(TypeError):
+            ValueIndex('exact', 'not callable')
+        with self.assertRaises(TypeError):
+            ValueIndex('prefix', len).changes({}, {'a': 'foo'})
+        with self.assertRaises(TypeError):
+            ValueIndex('exact', list).changes({}, {'a': 'foo'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+import os
+import tempfile
+import threading
+import unittest
+from db import SimpleDB
+from wal import WriteAheadLog, encode_record, decode_payload, replay, valid_length, HEADER
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.test_path = os.path.join(self.test_dir.name, 'test.wal')
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def test_encode_record(self):
+        record = encode_record(7, {'test_key': 'test_val', 'ключ': 'значение'},
+                               ['test_del_key'], {'ключ': 1234.5})
+        payload = record[HEADER.size:]
+        self.assertEqual(HEADER.unpack(record[:HEADER.size])[0], len(payload))
+        self.assertEqual(decode_payload(payload), (
+            {'test_key': 'test_val', 'ключ': 'значение'}, ['test_del_key'],
+            {'ключ': 1234.5}))
+        # Values other than str are written with their type
+        typed = {'bytes': b'\x00\xff', 'view': memoryview(b'abc'), 'int': -2 ** 70, 'float': 0.5}
+        record = encode_record(8, typed, (), {'int': 99.0})
+        self.assertEqual(decode_payload(record[HEADER.size:]), (
+            {'bytes': b'\x00\xff', 'view': b'abc', 'int': -2 ** 70, 'float': 0.5}, [],
+            {'int': 99.0}))
+
+    def test_append_replay(self):
+        for durability in ('always', 'periodic', 'os'):
+            if os.path.exists(self.test_path):
+                os.remove(self.test_path)
+            wal = WriteAheadLog(self.test_path, durability, interval_ms=1)
+            wal.append(1, {'test_key_1': 'test_val_1'})
+            wal.append(2, {'test_key_2': 'test_val_2'}, ['test_key_1'])
+            wal.close()
+            self.assertEqual(list(replay(self.test_path)), [
+                (1, {'test_key_1': 'test_val_1'}, [], {}),
+                (2, {'test_key_2': 'test_val_2'}, ['test_key_1'], {}),
+            ])
+
+        with self.assertRaises(Exception):
+            wal.append(3, {'test_key': 'test_val'})
+        with self.assertRaises(Exception):
+            WriteAheadLog(self.test_path, 'bad_durability')
+
+    def test_torn_record(self):
+        wal = WriteAheadLog(self.test_path)
+        wal.append(1, {'test_key_1': 'test_val_1'})
+        wal.append(2, {'test_key_2': 'test_val_2'})
+        wal.close()
+        # Crash in the middle of the last write
+        with open(self.test_path, 'r+b') as log_file:
+            log_file.truncate(os.path.getsize(self.test_path) - 3)
+        self.assertEqual(list(replay(self.test_path)),
+                         [(1, {'test_key_1': 'test_val_1'}, [], {})])
+
+        # Torn record is cut off before new records are appended
+        wal = WriteAheadLog(self.test_path)
+        wal.append(3, {'test_key_3': 'test_val_3'})
+        wal.close()
+        self.assertEqual([record[0] for record in replay(self.test_path)], [1, 3])
+
+    def test_abort(self):
+        wal = WriteAheadLog(self.test_path)
+        wal.append(1, {'test_key_1': 'test_val_1'})
+        wal.append(2, {'test_key_2': 'test_val_2'})
+        wal.append(3, {'test_key_3': 'test_val_3'})
+        wal.abort(2)
+        wal.close()
+        # Replayed empty, the commit sequence number is kept
+        self.assertEqual(list(replay(self.test_path)), [
+            (1, {'test_key_1': 'test_val_1'}, [], {}),
+            (2, {}, [], {}),
+            (3, {'test_key_3': 'test_val_3'}, [], {}),
+        ])
+        self.assertEqual(valid_length(self.test_path), os.path.getsize(self.test_path))
+
+    def test_group_commit(self):
+        wal = WriteAheadLog(self.test_path)
+
+        def worker(i):
+            for j in range(50):
+                wal.append(i * 50 + j, {'key_%d_%d' % (i, j): 'val'})
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wal.close()
+
+        self.assertEqual(len(list(replay(self.test_path))), 400)
+        self.assertTrue(wal.sync_count <= 400)
+
+
+class TestSimpleDB_Durable(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.test_path = os.path.join(self.test_dir.name, 'test.wal')
+
+    def tearDown(self):
+        self.test_dir.cleanup()
+
+    def test_recovery(self):
+        test_db = SimpleDB(wal_path=self.test_path)
+        test_db.put('a', 'foo')
+        test_db.put_many({'b': 'foo', 'c': 'foo'})
+        test_db.createTransaction('abc')
+        test_db.put('a', 'bar', 'abc')
+        test_db.delete('b', 'abc')
+        test_db.commitTransaction('abc')
+        test_db.delete('c')
+        test_db.put('e', 'foo', ttl=100)
+        test_db.put('f', 'foo', ttl=100)
+        test_db.put('f', 'bar')
+        # Never committed, not in the log
+        test_db.createTransaction('def')
+        test_db.put('d', 'foo', 'def')
+        test_db.close()
+
+        recovered_db = SimpleDB(wal_path=self.test_path, durability='os')
+        self.assertEqual(recovered_db.getDB(), {'a': 'bar', 'e': 'foo', 'f': 'bar'})
+        self.assertEqual(list(recovered_db.expiry.deadlines), ['e'])
+        self.assertEqual(recovered_db.commit_seq, test_db.commit_seq)
+        self.assertEqual(recovered_db.db_transaction_id, test_db.db_transaction_id)
+
+        recovered_db.put('d', 'foo')
+        recovered_db.close()
+        recovered_db = SimpleDB(wal_path=self.test_path)
+        self.assertEqual(recovered_db.getDB(),
+                         {'a': 'bar', 'd': 'foo', 'e': 'foo', 'f': 'bar'})
+        recovered_db.close()
+
+    def test_failed_commit(self):
+        test_db = SimpleDB(wal_path=self.test_path)
+        test_db.put('a', 'foo')
+
+        def fail(puts, deletes, expires):
+            raise MemoryError
+
+        # Logged, then failed while being applied
+        test_db.update_expiry = fail
+        with self.assertRaises(MemoryError):
+            test_db.put('b', 'bar')
+        del test_db.update_expiry
+        test_db.put('c', 'baz')
+        test_db.close()
+
+        recovered_db = SimpleDB(wal_path=self.test_path)
+        self.assertEqual(recovered_db.getDB(), {'a': 'foo', 'c': 'baz'})
+        self.assertEqual(recovered_db.commit_seq, test_db.commit_seq)
+        recovered_db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
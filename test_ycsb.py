@@ -0,0 +1,93 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+from ycsb import (DEFAULTS, WORKLOADS, SizeGenerator, Workload, ZipfianGenerator, compare,
+                  main, make_generator)
+
+
+class TestYCSB(unittest.TestCase):
+    def config(self, **overrides):
+        config = dict(DEFAULTS, records=200, operations=1000)
+        config.update(overrides)
+        return config
+
+    def test_zipfian(self):
+        generator = ZipfianGenerator(1000, random.Random(1))
+        counts = [0] * 1000
+        for _ in range(100000):
+            counts[generator.next()] += 1
+        # Most frequent first, item 0 about 1 / zeta(1000) of the draws
+        self.assertTrue(counts[0] > counts[1] > counts[10] > counts[100])
+        self.assertTrue(0.12 < counts[0] / 100000 < 0.14)
+        self.assertTrue(sum(counts[:10]) > sum(counts[500:]))
+
+    def test_generators(self):
+        rng = random.Random(1)
+        for distribution in ('uniform', 'zipfian', 'constant'):
+            generator = make_generator(distribution, 50, rng)
+            self.assertTrue(all(0 <= generator.next() < 50 for _ in range(10000)))
+        with self.assertRaises(ValueError):
+            make_generator('normal', 50, rng)
+        sizes = SizeGenerator((8, 64), 'zipfian', rng)
+        drawn = [sizes.next() for _ in range(10000)]
+        self.assertTrue(min(drawn) == 8 and max(drawn) <= 64)
+        self.assertTrue(sum(size < 16 for size in drawn) > 5000)
+        with self.assertRaises(ValueError):
+            SizeGenerator((10, 5), 'uniform', rng)
+
+    def test_workloads(self):
+        for name in WORKLOADS:
+            result = Workload(name, self.config(key_size=(8, 24), key_distribution='uniform',
+                                                value_size=(1, 50), value_distribution='zipfian'
+                                                )).run()
+            self.assertEqual(set(WORKLOADS[name]) - set(result['operations']), set())
+            self.assertTrue(result['throughput'] > 0)
+            for stats in result['operations'].values():
+                self.assertEqual(stats['errors'], 0)
+                self.assertTrue(stats['p50_us'] <= stats['p99_us'] <= stats['max_us'])
+
+    def test_transaction_conflicts(self):
+        config = self.config(records=20, distribution='zipfian')
+        first = Workload('transaction', config).run()['transactions']
+        self.assertTrue(first['aborted'] > 0 and first['committed'] > 0)
+        # Seeded, the same conflicts every run
+        self.assertEqual(Workload('transaction', config).run()['transactions'], first)
+        pessimistic = Workload('transaction', config, {'concurrency': 'pessimistic'}).run()
+        self.assertTrue(pessimistic['transactions']['committed'] > 0)
+
+    def test_compare(self):
+        baseline = {'workloads': {'read_heavy': {
+            'throughput': 1000.0, 'operations': {'read': {'p99_us': 2.0}}},
+            'transaction': {'throughput': 100.0, 'operations': {},
+                            'transactions': {'abort_rate': 0.1}}}}
+        results = json.loads(json.dumps(baseline))
+        self.assertFalse(any(row['regression'] for row in compare(baseline, results)))
+        results['workloads']['read_heavy']['throughput'] = 850.0
+        results['workloads']['read_heavy']['operations']['read']['p99_us'] = 3.0
+        results['workloads']['transaction']['transactions']['abort_rate'] = 0.2
+        regressions = [(row['workload'], row['metric'])
+                       for row in compare(baseline, results) if row['regression']]
+        self.assertEqual(regressions, [('read_heavy', 'throughput'),
+                                       ('read_heavy', 'read p99_us'),
+                                       ('transaction', 'abort_rate')])
+        self.assertEqual(compare(baseline, results, threshold=0.2, latency_threshold=1,
+                                 abort_threshold=0.5)[0]['regression'], False)
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.json')
+            self.assertEqual(main(['run', '--workloads', 'read_heavy,counter', '--records', '100',
+                                   '--operations', '500', '--value-size', '10:20',
+                                   '--db-option', 'thread_safe=true', '--output', path]), 0)
+            with open(path) as results_file:
+                results = json.load(results_file)
+            self.assertEqual(sorted(results['workloads']), ['counter', 'read_heavy'])
+            self.assertEqual(results['options'], {'thread_safe': True})
+            self.assertEqual(results['config']['value_size'], [10, 20])
+            self.assertEqual(main(['compare', path, path]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,341 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from codec import decode_value, encode_value
+
+'''
+Tiered storage: hot keys in memory, cold keys on disk
+
+TieredStore is a drop-in replacement for the dict holding db (storage.py) for
+data larger than memory. At most hot_keys keys are resident, in least recently
+used order. The others are rows of a sqlite3 table holding the key, its value
+(type tag and bytes, see codec.py) and its version, so db_transaction_id
+(TieredVersionView) knows the version of every key and commit validation works
+the same whether a key is resident or not.
+
+Reads look in memory first and read through to disk on a miss, the entry read
+becoming resident. Writes only change memory and mark the entry dirty
+(write-behind). A dirty entry pushed out of memory waits in the write buffer
+with the keys deleted since, they are written to disk together in one sqlite
+transaction once batch_size are waiting. A clean entry pushed out is dropped,
+it is on disk already.
+
+The sqlite file is scratch space emptied when the store is opened, durability
+stays with the write-ahead log and snapshots. Without a path sqlite uses a
+private temporary file deleted when the store is closed.
+'''
+
+HOT_KEYS = 100000
+BATCH_SIZE = 1000
+
+# Write buffer marker of a deleted key
+DELETED = None
+
+SCHEMA = '''CREATE TABLE entries (key TEXT PRIMARY KEY, type INTEGER NOT NULL,
+                                   value BLOB NOT NULL, version INTEGER NOT NULL)
+            WITHOUT ROWID'''
+
+
+class TieredStore(MutableMapping):
+    def __init__(self, path: str = None, hot_keys: int = HOT_KEYS, batch_size: int = BATCH_SIZE,
+                 data=None):
+        if hot_keys < 1 or batch_size < 1:
+            raise ValueError("Error, hot_keys and batch_size must be at least 1")
+        self.path = path
+        self.hot_keys = hot_keys
+        self.batch_size = batch_size
+        # Resident entries as {key: [value, version, dirty]}, least recently used first
+        self.hot = OrderedDict()
+        # Write buffer as {key: (value, version) or DELETED}
+        self.pending = {}
+        self.count = 0
+        # Nothing was ever written to disk, a missing key need not be looked up
+        self.disk_empty = True
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path or '', check_same_thread=False,
+                                          isolation_level=None)
+        # Scratch space, nothing to recover after a crash
+        self.connection.execute('PRAGMA journal_mode=OFF')
+        self.connection.execute('PRAGMA synchronous=OFF')
+        self.connection.execute('DROP TABLE IF EXISTS entries')
+        self.connection.execute(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.rows_written = 0
+        if data:
+            self.update(data)
+
+    def __len__(self):
+        return self.count
+
+    # Row (type, value, version) of key on disk, None when there is none.
+    # Called with the lock held.
+    def read_row(self, key: str):
+        if self.disk_empty:
+            return None
+        return self.connection.execute(
+            'SELECT type, value, version FROM entries WHERE key = ?', (key,)).fetchone()
+
+    # Resident entry of key, read through from the write buffer or disk, None
+    # when key does not exist. Called with the lock held.
+    def find(self, key: str):
+        entry = self.hot.get(key)
+        if entry != None:
+            self.hot.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        if key in self.pending:
+            buffered = self.pending[key]
+            if buffered is DELETED:
+                return None
+            del self.pending[key]
+            # Back in memory before it reached disk, still dirty
+            entry = [buffered[0], buffered[1], True]
+        else:
+            row = self.read_row(key)
+            if row == None:
+                return None
+            entry = [decode_value(row[0], row[1]), row[2], False]
+        self.hot[key] = entry
+        self.evict()
+        return entry
+
+    def __contains__(self, key):
+        if type(key) != str:
+            return False
+        with self.lock:
+            if key in self.hot:
+                return True
+            if key in self.pending:
+                return self.pending[key] is not DELETED
+            return self.read_row(key) != None
+
+    def __getitem__(self, key):
+        with self.lock:
+            entry = self.find(key)
+            if entry == None:
+                raise KeyError(key)
+            return entry[0]
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.find(key)
+            return default if entry == None else entry[0]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            entry = self.hot.get(key)
+            if entry != None:
+                entry[0] = value
+                entry[2] = True
+                self.hot.move_to_end(key)
+                return
+            # Keep the version of a key that is not resident, like an overwrite
+            version = None
+            if key in self.pending:
+                # A deleted key keeps its delete buffered, its old row is still on disk
+                buffered = self.pending[key]
+                if buffered is not DELETED:
+                    version = buffered[1]
+                    del self.pending[key]
+            else:
+                row = self.read_row(key)
+                if row != None:
+                    version = row[2]
+            if version == None:
+                version = 0
+                self.count += 1
+            self.hot[key] = [value, version, True]
+            self.evict()
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key, *default):
+        with self.lock:
+            entry = self.find(key)
+            if entry == None:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            del self.hot[key]
+            self.count -= 1
+            if not self.disk_empty:
+                self.buffer(key, DELETED)
+            return entry[0]
+
+    # Push least recently used entries out of memory, dirty ones to the write
+    # buffer. Called with the lock held.
+    def evict(self):
+        while len(self.hot) > self.hot_keys:
+            key, entry = self.hot.popitem(last=False)
+            if entry[2]:
+                self.buffer(key, (entry[0], entry[1]))
+
+    def buffer(self, key: str, buffered):
+        self.pending[key] = buffered
+        if len(self.pending) >= self.batch_size:
+            self.flush_pending()
+
+    # Write the write buffer to disk in one transaction. Called with the lock held.
+    def flush_pending(self):
+        if not self.pending:
+            return
+        rows = []
+        deletes = []
+        for key, buffered in self.pending.items():
+            if buffered is DELETED:
+                deletes.append((key,))
+            else:
+                tag, data = encode_value(buffered[0])
+                rows.append((key, tag, data, buffered[1]))
+        self.pending = {}
+        connection = self.connection
+        connection.execute('BEGIN')
+        try:
+            if deletes:
+                connection.executemany('DELETE FROM entries WHERE key = ?', deletes)
+            if rows:
+                connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', rows)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        if rows:
+            self.disk_empty = False
+        self.flushes += 1
+        self.rows_written += len(rows) + len(deletes)
+
+    # Write every dirty entry to disk, resident ones stay resident and clean
+    def flush(self):
+        with self.lock:
+            for key, entry in self.hot.items():
+                if entry[2]:
+                    self.pending[key] = (entry[0], entry[1])
+                    entry[2] = False
+            self.flush_pending()
+
+    def __iter__(self):
+        return iter(self.keys_list())
+
+    def keys_list(self):
+        with self.lock:
+            self.flush_pending()
+            keys = list(self.hot)
+            if not self.disk_empty:
+                hot = self.hot
+                keys.extend(key for key, in self.connection.execute('SELECT key FROM entries')
+                            if key not in hot)
+            return keys
+
+    def items(self):
+        with self.lock:
+            self.flush_pending()
+            items = [(key, entry[0]) for key, entry in self.hot.items()]
+            if not self.disk_empty:
+                hot = self.hot
+                items.extend((key, decode_value(tag, data)) for key, tag, data in
+                             self.connection.execute('SELECT key, type, value FROM entries')
+                             if key not in hot)
+            return items
+
+    # Version of key without making it resident, None when it does not exist
+    def get_version(self, key: str):
+        with self.lock:
+            entry = self.hot.get(key)
+            if entry != None:
+                return entry[1]
+            if key in self.pending:
+                buffered = self.pending[key]
+                return None if buffered is DELETED else buffered[1]
+            row = None if self.disk_empty else self.connection.execute(
+                'SELECT version FROM entries WHERE key = ?', (key,)).fetchone()
+            return None if row == None else row[0]
+
+    def set_version(self, key: str, version: int):
+        with self.lock:
+            entry = self.hot.get(key)
+            if entry != None:
+                entry[1] = version
+                entry[2] = True
+                return
+            buffered = self.pending.get(key)
+            if buffered is not None:
+                self.pending[key] = (buffered[0], version)
+                return
+            if key in self.pending or self.disk_empty or self.connection.execute(
+                    'UPDATE entries SET version = ? WHERE key = ?', (version, key)).rowcount == 0:
+                raise KeyError(key)
+
+    def set_all_versions(self, version: int):
+        with self.lock:
+            for entry in self.hot.values():
+                entry[1] = version
+            for key, buffered in self.pending.items():
+                if buffered is not DELETED:
+                    self.pending[key] = (buffered[0], version)
+            if not self.disk_empty:
+                self.connection.execute('UPDATE entries SET version = ?', (version,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def stats(self):
+        return {
+            'keys': self.count,
+            'resident_keys': len(self.hot),
+            'pending_writes': len(self.pending),
+            'hits': self.hits,
+            'misses': self.misses,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+        }
+
+
+class TieredVersionView(MutableMapping):
+    '''
+    db_transaction_id of a TieredStore: versions live with their entry, in
+    memory or on disk. As with VersionView (storage.py) a version exists exactly
+    while its key does.
+    '''
+
+    def __init__(self, store: TieredStore):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __getitem__(self, key):
+        version = self.store.get_version(key)
+        if version == None:
+            raise KeyError(key)
+        return version
+
+    def get(self, key, default=None):
+        version = self.store.get_version(key)
+        return default if version == None else version
+
+    def __setitem__(self, key, version: int):
+        self.store.set_version(key, version)
+
+    def __delitem__(self, key):
+        if key not in self.store:
+            raise KeyError(key)
+
+    def pop(self, key, *default):
+        version = self.get(key)
+        if version == None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return version
@@ -0,0 +1,116 @@
+import threading
+from ordered_index import OrderedKeyIndex, prefix_end
+
+'''
+Secondary indexes on values
+
+An index map what extractor(value) return for every key to the key. The default
+extractor is the value itself, a key whose extractor return None is not indexed.
+
+Kinds (kind):
+    'exact'  - hash buckets {extracted: set of keys}, equality lookups only
+    'prefix' - (extracted, key) pairs kept sorted in an OrderedKeyIndex, equality
+               and prefix lookups, extracted values must be strings
+
+A commit first ask every index for its changes, which is where an extractor may
+raise, then applies them once the commit can no longer fail.
+'''
+
+INDEX_KINDS = ('exact', 'prefix')
+
+
+class ValueIndex(object):
+    def __init__(self, kind: str = 'exact', extractor=None):
+        if kind not in INDEX_KINDS:
+            raise ValueError("Error, index kind must be one of %s" % ', '.join(INDEX_KINDS))
+        if extractor != None and not callable(extractor):
+            raise TypeError
+        self.kind = kind
+        self.extractor = extractor
+        self.buckets = {}
+        self.entries = OrderedKeyIndex()
+        # Writers on different key stripes share the index
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        if self.kind == 'exact':
+            return sum(map(len, self.buckets.values()))
+        return len(self.entries)
+
+    def extract(self, value):
+        extracted = value if self.extractor == None else self.extractor(value)
+        if extracted == None:
+            return None
+        if self.kind == 'prefix' and type(extracted) != str:
+            raise TypeError
+        # Unhashable values must fail here, before the commit is applied
+        hash(extracted)
+        return extracted
+
+    # Index every key of db {key: value}
+    def load(self, db):
+        self.apply(self.changes(db, db))
+
+    '''
+    Entries to remove and add as [(extracted, key)] when puts {key: value} and
+    deletes [key] are applied to db. Nothing is changed yet.
+    '''
+
+    def changes(self, db, puts, deletes=()):
+        removed = []
+        added = []
+        for key in deletes:
+            if key in db:
+                removed.append((self.extract(db[key]), key))
+        for key, value in puts.items():
+            if key in db:
+                removed.append((self.extract(db[key]), key))
+            added.append((self.extract(value), key))
+        return removed, added
+
+    def apply(self, changes):
+        removed, added = changes
+        if self.kind == 'prefix':
+            for entry in removed:
+                if entry[0] != None:
+                    self.entries.remove(entry)
+            for entry in added:
+                if entry[0] != None:
+                    self.entries.add(entry)
+            return
+        with self.lock:
+            for extracted, key in removed:
+                bucket = self.buckets.get(extracted)
+                if bucket != None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self.buckets[extracted]
+            for extracted, key in added:
+                if extracted != None:
+                    self.buckets.setdefault(extracted, set()).add(key)
+
+    # Keys indexed under extracted, lazily for a prefix index
+    def keys_equal(self, extracted):
+        if self.kind == 'exact':
+            with self.lock:
+                return list(self.buckets.get(extracted, ()))
+        # ('a', key) sort after ('a',) and before ('a\0',) for any key
+        return (key for _, key in self.entries.irange((extracted,), (extracted + '\0',)))
+
+    # Keys whose extracted value start with prefix, in order of extracted value
+    def keys_prefix(self, prefix: str):
+        if self.kind != 'prefix':
+            raise Exception("Error, prefix lookups need a prefix index")
+        end = prefix_end(prefix)
+        return (key for _, key in self.entries.irange(
+            (prefix,), None if end == None else (end,)))
+
+    # Whether value still match the lookup, keys come from the index lazily and
+    # may have been written since
+    def matches(self, value, equals=None, prefix: str = None):
+        extracted = self.extract(value)
+        if extracted == None:
+            return False
+        if prefix != None:
+            return extracted.startswith(prefix)
+        return extracted == equals
@@ -0,0 +1,299 @@
+import os
+import struct
+import threading
+import zlib
+from codec import decode_value, encode_value
+
+'''
+Append-only write-ahead log
+
+Each commit is written as one record:
+    header: payload length (uint32), crc32 of payload (uint32), commit_seq (uint64)
+    payload: entries of
+        op (uint8), key length (uint32), key utf-8
+        value length (uint32), value utf-8    (OP_PUT and OP_PUT_EXPIRE)
+        value type (uint8), value length (uint32), value bytes
+                                              (OP_PUT_TYPED and OP_PUT_TYPED_EXPIRE,
+                                               values other than str, see codec.py)
+        deadline (float64, unix time)         (OP_PUT_EXPIRE and OP_PUT_TYPED_EXPIRE)
+
+A commit that failed after its record was written is cancelled by an abort
+record of the same commit_seq, whose payload is the single byte OP_ABORT. It is
+replayed as an empty commit, like the filler the changefeed publish for it.
+
+Durability levels:
+    'always'   - commit return only after its record is fsync'ed. Commits arriving
+                 while a fsync is running are written and fsync'ed together by
+                 the next one (group commit).
+    'periodic' - records are written on commit and fsync'ed every interval_ms
+                 by a background thread, a crash may lose the last interval.
+    'os'       - records are handed to the OS on commit but never fsync'ed,
+                 survive a process crash but not a machine crash.
+'''
+
+DURABILITY_LEVELS = ('always', 'periodic', 'os')
+
+OP_PUT = 1
+OP_DELETE = 2
+OP_PUT_EXPIRE = 3
+OP_PUT_TYPED = 4
+OP_PUT_TYPED_EXPIRE = 5
+OP_ABORT = 6
+
+ABORT_PAYLOAD = bytes((OP_ABORT,))
+
+HEADER = struct.Struct('<IIQ')
+LENGTH = struct.Struct('<I')
+DEADLINE = struct.Struct('<d')
+
+
+# Encode a commit of puts {key: value}, deletes [key] and the deadlines
+# {key: deadline} of puts with a TTL into one record
+def encode_record(commit_seq: int, puts, deletes=(), expires=None):
+    parts = []
+    for key, value in puts.items():
+        key_bytes = key.encode('utf-8')
+        deadline = expires.get(key) if expires else None
+        if type(value) == str:
+            value_bytes = value.encode('utf-8')
+            parts.append(bytes((OP_PUT if deadline == None else OP_PUT_EXPIRE,)))
+            parts.append(LENGTH.pack(len(key_bytes)))
+            parts.append(key_bytes)
+        else:
+            tag, value_bytes = encode_value(value)
+            parts.append(bytes((OP_PUT_TYPED if deadline == None else OP_PUT_TYPED_EXPIRE,)))
+            parts.append(LENGTH.pack(len(key_bytes)))
+            parts.append(key_bytes)
+            parts.append(bytes((tag,)))
+        parts.append(LENGTH.pack(len(value_bytes)))
+        parts.append(value_bytes)
+        if deadline != None:
+            parts.append(DEADLINE.pack(deadline))
+    for key in deletes:
+        key_bytes = key.encode('utf-8')
+        parts.append(bytes((OP_DELETE,)))
+        parts.append(LENGTH.pack(len(key_bytes)))
+        parts.append(key_bytes)
+    payload = b''.join(parts)
+    return HEADER.pack(len(payload), zlib.crc32(payload), commit_seq) + payload
+
+
+# Record cancelling the commit commit_seq
+def encode_abort(commit_seq: int):
+    return HEADER.pack(len(ABORT_PAYLOAD), zlib.crc32(ABORT_PAYLOAD), commit_seq) + ABORT_PAYLOAD
+
+
+# Decode a record payload back into (puts, deletes, expires)
+def decode_payload(payload):
+    puts = {}
+    deletes = []
+    expires = {}
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(payload):
+        op = payload[offset]
+        offset += 1
+        key_length, = LENGTH.unpack_from(payload, offset)
+        offset += LENGTH.size
+        key = str(view[offset:offset + key_length], 'utf-8')
+        offset += key_length
+        if op == OP_PUT or op == OP_PUT_EXPIRE:
+            value_length, = LENGTH.unpack_from(payload, offset)
+            offset += LENGTH.size
+            puts[key] = str(view[offset:offset + value_length], 'utf-8')
+            offset += value_length
+            if op == OP_PUT_EXPIRE:
+                expires[key], = DEADLINE.unpack_from(payload, offset)
+                offset += DEADLINE.size
+        elif op == OP_PUT_TYPED or op == OP_PUT_TYPED_EXPIRE:
+            tag = payload[offset]
+            value_length, = LENGTH.unpack_from(payload, offset + 1)
+            offset += 1 + LENGTH.size
+            puts[key] = decode_value(tag, view[offset:offset + value_length])
+            offset += value_length
+            if op == OP_PUT_TYPED_EXPIRE:
+                expires[key], = DEADLINE.unpack_from(payload, offset)
+                offset += DEADLINE.size
+        elif op == OP_DELETE:
+            deletes.append(key)
+        else:
+            raise ValueError("Error, unknown log op %d" % op)
+    return puts, deletes, expires
+
+
+'''
+Read every complete record of the log at path, yield
+(commit_seq, puts, deletes, expires). Aborted commits are yielded empty.
+Stop at the first torn or corrupted record, which is what a crash in the middle
+of a write leave behind. valid_length() give where that happened.
+'''
+
+
+def replay(path: str):
+    # Abort records follow the record they cancel, find them first
+    aborted = {commit_seq for commit_seq, puts, _, _, _ in _read_records(path) if puts == None}
+    for commit_seq, puts, deletes, expires, _ in _read_records(path):
+        if puts == None:
+            continue
+        if commit_seq in aborted:
+            yield commit_seq, {}, [], {}
+        else:
+            yield commit_seq, puts, deletes, expires
+
+
+# Length of the log at path up to the end of the last complete record
+def valid_length(path: str):
+    end = 0
+    for _, _, _, _, end in _read_records(path):
+        pass
+    return end
+
+
+def _read_records(path: str):
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as log_file:
+        offset = 0
+        while True:
+            header = log_file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, crc, commit_seq = HEADER.unpack(header)
+            payload = log_file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            if payload == ABORT_PAYLOAD:
+                offset += HEADER.size + length
+                yield commit_seq, None, None, None, offset
+                continue
+            try:
+                puts, deletes, expires = decode_payload(payload)
+            except (ValueError, UnicodeDecodeError, struct.error):
+                return
+            offset += HEADER.size + length
+            yield commit_seq, puts, deletes, expires, offset
+
+
+class WriteAheadLog(object):
+    def __init__(self, path: str, durability: str = 'always', interval_ms: int = 10):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError("Error, durability must be one of %s" %
+                             ', '.join(DURABILITY_LEVELS))
+        self.path = path
+        self.durability = durability
+        self.interval = interval_ms / 1000.0
+        # Cut off a torn record left by a crash so new records follow valid data
+        end = valid_length(path)
+        self.file = open(path, 'ab')
+        if self.file.tell() != end:
+            self.file.truncate(end)
+        self.condition = threading.Condition()
+        # Records waiting to be written by the next group commit
+        self.pending = []
+        # Records are numbered in append order, synced_lsn is the last one on disk
+        self.appended_lsn = 0
+        self.synced_lsn = 0
+        self.syncing = False
+        self.closed = False
+        # Error of a failed fsync, commits waiting on it fail as well
+        self.error = None
+        # Number of fsync done, each cover one or more commits
+        self.sync_count = 0
+        self.flusher = None
+        if durability == 'periodic':
+            self.flusher = threading.Thread(target=self.flush_periodically, daemon=True)
+            self.flusher.start()
+
+    # Append a commit to the log, return once it is as durable as the level ask
+    def append(self, commit_seq: int, puts, deletes=(), expires=None):
+        self.write_record(encode_record(commit_seq, puts, deletes, expires))
+
+    # Cancel the commit commit_seq already appended, it failed to be applied
+    def abort(self, commit_seq: int):
+        self.write_record(encode_abort(commit_seq))
+
+    def write_record(self, record: bytes):
+        with self.condition:
+            if self.closed:
+                raise Exception("Error, write-ahead log is closed")
+            if self.durability != 'always':
+                self.file.write(record)
+                if self.durability == 'os':
+                    self.file.flush()
+                return
+            self.pending.append(record)
+            self.appended_lsn += 1
+            lsn = self.appended_lsn
+            while self.synced_lsn < lsn:
+                if self.error != None:
+                    raise self.error
+                if self.syncing:
+                    # Another commit is fsync'ing, ours go with the next batch
+                    self.condition.wait()
+                    continue
+                # Become the leader, write and fsync every pending record at once
+                batch, self.pending = self.pending, []
+                target = self.appended_lsn
+                self.syncing = True
+                self.condition.release()
+                try:
+                    self.file.write(b''.join(batch))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                except Exception as error:
+                    self.error = error
+                    raise error
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    self.condition.notify_all()
+                self.synced_lsn = target
+                self.sync_count += 1
+
+    def flush_periodically(self):
+        while True:
+            with self.condition:
+                self.condition.wait(self.interval)
+                if self.closed:
+                    return
+                self.file.flush()
+                # Own descriptor so the log can be swapped while fsync run
+                fileno = os.dup(self.file.fileno())
+            try:
+                os.fsync(fileno)
+            finally:
+                os.close(fileno)
+            self.sync_count += 1
+
+    # Drop records up to commit_seq once a snapshot cover them. Later records are
+    # kept, the log is rewritten to a new file then swapped in.
+    def truncate_until(self, commit_seq: int):
+        with self.condition:
+            # Wait for a group commit writing outside the lock
+            while self.syncing:
+                self.condition.wait()
+            self.file.flush()
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as temp_file:
+                for record_seq, puts, deletes, expires in replay(self.path):
+                    if record_seq > commit_seq:
+                        temp_file.write(
+                            encode_record(record_seq, puts, deletes, expires))
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            self.file.close()
+            os.replace(temp_path, self.path)
+            self.file = open(self.path, 'ab')
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        if self.flusher != None:
+            self.flusher.join()
+        with self.condition:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
@@ -0,0 +1,526 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from db import SimpleDB
+from metrics import Histogram
+
+'''
+YCSB-style workloads for SimpleDB
+
+Usage:
+    python ycsb.py run [--workloads read_heavy,scan] [--records n] [--operations n]
+                       [--distribution zipfian] [--key-size 16:32] [--value-size 100]
+                       [--db-option thread_safe=true] [--output results.json]
+    python ycsb.py compare baseline.json results.json [--threshold 0.1]
+
+A workload first loads records keys, then runs operations operations drawn
+from its mix, on keys picked by the request distribution. Runs are seeded, the
+same arguments run the same operations on the same keys and values.
+
+Key and value sizes are drawn from their own distribution between a minimum and
+a maximum ("min:max", or one size). A zipfian size distribution makes most
+sizes close to the minimum and a few close to the maximum.
+
+The transaction workload interleaves concurrency transactions on one thread,
+each reading and writing transaction_keys keys before committing, so those
+sharing a key conflict as they would on concurrent threads but the same way on
+every run.
+
+Latencies are recorded in nanoseconds (metrics.Histogram) and reported in
+microseconds. compare flags a workload whose throughput dropped, p99 latency
+rose or abort rate rose by more than the thresholds, and exits with status 1.
+'''
+
+DISTRIBUTIONS = ('uniform', 'zipfian', 'constant')
+ZIPFIAN_THETA = 0.99
+
+# Operation mix of every workload as {operation: proportion}, the letters are
+# the closest core YCSB workload
+WORKLOADS = {
+    'update_heavy': {'read': 0.5, 'update': 0.5},  # A
+    'read_heavy': {'read': 0.95, 'update': 0.05},  # B
+    'read_only': {'read': 1.0},  # C
+    'scan': {'scan': 0.95, 'insert': 0.05},  # E
+    'read_modify_write': {'read': 0.5, 'read_modify_write': 0.5},  # F
+    'write_heavy': {'read': 0.1, 'update': 0.5, 'insert': 0.25, 'delete': 0.15},
+    'batch': {'read_many': 0.5, 'update_many': 0.3, 'insert_many': 0.1, 'delete_many': 0.1},
+    'counter': {'read': 0.2, 'incr': 0.6, 'append': 0.2},
+    'transaction': {'transaction': 1.0},
+}
+
+# SimpleDB options a workload needs
+WORKLOAD_OPTIONS = {
+    'scan': {'ordered_index': True},
+}
+
+DEFAULTS = {
+    'records': 10000,
+    'operations': 100000,
+    'distribution': 'zipfian',
+    'key_size': (16, 16),
+    'key_distribution': 'constant',
+    'value_size': (100, 100),
+    'value_distribution': 'constant',
+    'scan_length': 100,
+    'batch_size': 10,
+    'transaction_keys': 4,
+    'concurrency': 8,
+    'seed': 1,
+    'repeat': 1,
+}
+
+
+def zeta(n: int, theta: float):
+    return sum(1 / (i ** theta) for i in range(1, n + 1))
+
+
+class UniformGenerator(object):
+    def __init__(self, items: int, rng: random.Random):
+        self.items = items
+        self.rng = rng
+
+    def next(self):
+        return int(self.rng.random() * self.items)
+
+
+class ConstantGenerator(object):
+    def __init__(self, items: int, rng: random.Random):
+        self.items = items
+
+    # The largest item: with sizes, the maximum
+    def next(self):
+        return self.items - 1
+
+
+class ZipfianGenerator(object):
+    '''
+    Items 0 to items - 1, item 0 the most frequent, as in YCSB (Gray et al.,
+    "Quickly generating billion-record synthetic databases").
+    '''
+
+    def __init__(self, items: int, rng: random.Random, theta: float = ZIPFIAN_THETA):
+        self.items = items
+        self.rng = rng
+        self.theta = theta
+        self.zetan = zeta(items, theta)
+        self.alpha = 1 / (1 - theta)
+        self.eta = (1 - (2 / items) ** (1 - theta)) / (1 - zeta(2, theta) / self.zetan)
+        self.half_pow_theta = 1 + 0.5 ** theta
+
+    def next(self):
+        u = self.rng.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < self.half_pow_theta:
+            return min(1, self.items - 1)
+        return min(int(self.items * (self.eta * u - self.eta + 1) ** self.alpha), self.items - 1)
+
+
+def fnv_hash(value: int):
+    hash = 0xCBF29CE484222325
+    for _ in range(8):
+        hash = ((hash ^ (value & 0xFF)) * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+        value >>= 8
+    return hash
+
+
+class ScrambledZipfianGenerator(ZipfianGenerator):
+    # Zipfian with the hot items spread over the key space instead of being the
+    # first keys
+    def next(self):
+        return fnv_hash(ZipfianGenerator.next(self)) % self.items
+
+
+def make_generator(distribution: str, items: int, rng: random.Random, scrambled: bool = True):
+    if distribution == 'uniform':
+        return UniformGenerator(items, rng)
+    if distribution == 'zipfian':
+        return (ScrambledZipfianGenerator if scrambled else ZipfianGenerator)(items, rng)
+    if distribution == 'constant':
+        return ConstantGenerator(items, rng)
+    raise ValueError("Error, distribution must be one of %s" % ', '.join(DISTRIBUTIONS))
+
+
+class SizeGenerator(object):
+    # Sizes from minimum to maximum, zipfian ones mostly close to the minimum
+    def __init__(self, sizes, distribution: str, rng: random.Random):
+        self.minimum, maximum = sizes
+        if self.minimum < 1 or maximum < self.minimum:
+            raise ValueError("Error, sizes must be 1 <= min <= max")
+        self.generator = make_generator(distribution, maximum - self.minimum + 1, rng,
+                                        scrambled=False)
+
+    def next(self):
+        return self.minimum + self.generator.next()
+
+
+class Workload(object):
+    '''
+    One run of a workload on a fresh SimpleDB built from options.
+    '''
+
+    def __init__(self, name: str, config, options=None):
+        if name not in WORKLOADS:
+            raise ValueError("Error, workload must be one of %s" % ', '.join(WORKLOADS))
+        self.name = name
+        self.mix = WORKLOADS[name]
+        self.config = config
+        self.options = dict(WORKLOAD_OPTIONS.get(name, {}), **(options or {}))
+        self.rng = random.Random(config['seed'])
+        self.requests = make_generator(config['distribution'], config['records'], self.rng)
+        self.key_sizes = SizeGenerator(config['key_size'], config['key_distribution'], self.rng)
+        self.value_sizes = SizeGenerator(config['value_size'], config['value_distribution'],
+                                         self.rng)
+        # Values are slices of one random text at random offsets
+        self.text = ''.join(self.rng.choice('abcdefghijklmnopqrstuvwxyz')
+                            for _ in range(2 * config['value_size'][1]))
+        self.keys = []
+        # Keys inserted by the run, deleted last inserted first
+        self.inserted = []
+        self.histograms = {}
+        self.errors = {}
+        # Open transactions of the transaction workload as [transactionId, keys
+        # left, seconds spent]
+        self.slots = [None] * config['concurrency']
+        self.transaction_count = 0
+        self.committed = 0
+        self.aborted = 0
+        self.db = None
+
+    def make_key(self, number: int):
+        key = 'user%d' % number
+        return key + '0' * (self.key_sizes.next() - len(key))
+
+    def make_value(self):
+        size = self.value_sizes.next()
+        offset = int(self.rng.random() * (len(self.text) - size + 1))
+        return self.text[offset:offset + size]
+
+    def next_key(self):
+        return self.keys[self.requests.next()]
+
+    def record(self, operation: str, elapsed: float):
+        histogram = self.histograms.get(operation)
+        if histogram == None:
+            histogram = self.histograms[operation] = Histogram()
+        histogram.record(int(elapsed * 1e9))
+
+    def load(self):
+        self.db = SimpleDB(**self.options)
+        self.keys = [self.make_key(number) for number in range(self.config['records'])]
+        values = [self.make_value() for _ in self.keys]
+        start = time.perf_counter()
+        for key, value in zip(self.keys, values):
+            self.db.put(key, value)
+        return len(self.keys) / (time.perf_counter() - start)
+
+    def run(self):
+        load_throughput = self.load()
+        operations = list(self.mix)
+        weights = [self.mix[operation] for operation in operations]
+        choices = self.rng.choices(operations, weights, k=self.config['operations'])
+        methods = {operation: getattr(self, 'do_' + operation) for operation in operations}
+        start = time.perf_counter()
+        for number, operation in enumerate(choices):
+            try:
+                methods[operation](number)
+            except Exception:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+        elapsed = time.perf_counter() - start
+        self.db.close()
+        return self.result(load_throughput, elapsed)
+
+    def result(self, load_throughput: float, elapsed: float):
+        operations = {}
+        for operation, histogram in sorted(self.histograms.items()):
+            operations[operation] = {
+                'count': histogram.count,
+                'errors': self.errors.get(operation, 0),
+                'mean_us': histogram.total / histogram.count / 1000 if histogram.count else 0,
+                'p50_us': histogram.percentile(0.5) / 1000,
+                'p95_us': histogram.percentile(0.95) / 1000,
+                'p99_us': histogram.percentile(0.99) / 1000,
+                'max_us': histogram.max / 1000,
+            }
+        result = {
+            'mix': self.mix,
+            'options': self.options,
+            'load_throughput': load_throughput,
+            'throughput': self.config['operations'] / elapsed if elapsed > 0 else 0,
+            'operations': operations,
+        }
+        if 'transaction' in self.mix:
+            finished = self.committed + self.aborted
+            result['transactions'] = {
+                'committed': self.committed,
+                'aborted': self.aborted,
+                'abort_rate': self.aborted / finished if finished else 0.0,
+            }
+        return result
+
+    # Every do_<operation> runs one operation of the mix, timing only the
+    # SimpleDB calls
+
+    def do_read(self, number: int):
+        key = self.next_key()
+        start = time.perf_counter()
+        self.db.get(key)
+        self.record('read', time.perf_counter() - start)
+
+    def do_update(self, number: int):
+        key, value = self.next_key(), self.make_value()
+        start = time.perf_counter()
+        self.db.put(key, value)
+        self.record('update', time.perf_counter() - start)
+
+    def do_insert(self, number: int):
+        key, value = self.make_key(self.config['records'] + number), self.make_value()
+        start = time.perf_counter()
+        self.db.put(key, value)
+        self.record('insert', time.perf_counter() - start)
+        self.inserted.append(key)
+
+    # Delete a key inserted by the run, so the loaded keys read stay
+    def do_delete(self, number: int):
+        if not self.inserted:
+            return self.do_insert(number)
+        key = self.inserted.pop()
+        start = time.perf_counter()
+        self.db.delete(key)
+        self.record('delete', time.perf_counter() - start)
+
+    def do_scan(self, number: int):
+        key, length = self.next_key(), 1 + int(self.rng.random() * self.config['scan_length'])
+        start = time.perf_counter()
+        for _ in self.db.scan(key, limit=length):
+            pass
+        self.record('scan', time.perf_counter() - start)
+
+    def do_read_modify_write(self, number: int):
+        key, value = self.next_key(), self.make_value()
+        start = time.perf_counter()
+        self.db.get(key)
+        self.db.put(key, value)
+        self.record('read_modify_write', time.perf_counter() - start)
+
+    def do_read_many(self, number: int):
+        keys = [self.next_key() for _ in range(self.config['batch_size'])]
+        start = time.perf_counter()
+        self.db.get_many(keys)
+        self.record('read_many', time.perf_counter() - start)
+
+    def do_update_many(self, number: int):
+        items = {self.next_key(): self.make_value() for _ in range(self.config['batch_size'])}
+        start = time.perf_counter()
+        self.db.put_many(items)
+        self.record('update_many', time.perf_counter() - start)
+
+    def do_insert_many(self, number: int):
+        first = self.config['records'] + number * self.config['batch_size']
+        items = {self.make_key(first + i): self.make_value()
+                 for i in range(self.config['batch_size'])}
+        start = time.perf_counter()
+        self.db.put_many(items)
+        self.record('insert_many', time.perf_counter() - start)
+        self.inserted.extend(items)
+
+    def do_delete_many(self, number: int):
+        if len(self.inserted) < self.config['batch_size']:
+            return self.do_insert_many(number)
+        keys = self.inserted[-self.config['batch_size']:]
+        del self.inserted[-self.config['batch_size']:]
+        start = time.perf_counter()
+        self.db.delete_many(keys)
+        self.record('delete_many', time.perf_counter() - start)
+
+    # Counters live on their own keys, the loaded values are not integers
+    def do_incr(self, number: int):
+        key = 'counter:' + self.next_key()
+        start = time.perf_counter()
+        self.db.incr(key)
+        self.record('incr', time.perf_counter() - start)
+
+    def do_append(self, number: int):
+        key = 'log:' + self.next_key()
+        start = time.perf_counter()
+        self.db.append(key, 'x')
+        self.record('append', time.perf_counter() - start)
+
+    # One step of the next slot's transaction: begin it if needed, read and
+    # write one key, commit after transaction_keys keys. The time of every
+    # step of a transaction is recorded once it ends.
+    def do_transaction(self, number: int):
+        index = number % len(self.slots)
+        slot = self.slots[index]
+        key, value = self.next_key(), self.make_value()
+        start = time.perf_counter()
+        try:
+            if slot == None:
+                self.transaction_count += 1
+                slot = self.slots[index] = ['ycsb_%d' % self.transaction_count,
+                                            self.config['transaction_keys'], 0.0]
+                self.db.createTransaction(slot[0])
+            self.db.get(key, slot[0])
+            self.db.put(key, value, slot[0])
+            slot[1] -= 1
+            if slot[1] == 0:
+                self.slots[index] = None
+                self.db.commitTransaction(slot[0])
+                self.committed += 1
+                self.record('transaction', slot[2] + time.perf_counter() - start)
+            else:
+                slot[2] += time.perf_counter() - start
+        except Exception:
+            # Conflict on commit, or a key locked by another pessimistic transaction
+            self.slots[index] = None
+            self.aborted += 1
+            self.record('aborted_transaction', slot[2] + time.perf_counter() - start)
+            if slot[0] in self.db.transaction:
+                self.db.rollbackTransaction(slot[0])
+
+
+def run(workloads, config, options=None):
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+        },
+        'config': dict(config),
+        'options': options or {},
+        'workloads': {},
+    }
+    for name in workloads:
+        # Best of repeat runs, the least disturbed by the machine
+        runs = [Workload(name, config, options).run() for _ in range(config['repeat'])]
+        results['workloads'][name] = max(runs, key=lambda result: result['throughput'])
+    return results
+
+
+'''
+-List[Dict] compare(Dict baseline, Dict results, float threshold, float latency_threshold,
+                    float abort_threshold)
+    *One row per metric of the workloads in both: workload, metric, baseline, result,
+    change (relative, absolute for abort_rate) and regression, True when throughput
+    dropped by more than threshold, a p99 latency rose by more than latency_threshold
+    or the abort rate rose by more than abort_threshold
+'''
+
+
+def compare(baseline, results, threshold: float = 0.1, latency_threshold: float = 0.25,
+            abort_threshold: float = 0.01):
+    rows = []
+
+    def add(workload, metric, old, new, change, regression):
+        rows.append({'workload': workload, 'metric': metric, 'baseline': old, 'result': new,
+                     'change': change, 'regression': regression})
+
+    for name, result in results['workloads'].items():
+        old = baseline['workloads'].get(name)
+        if old == None:
+            continue
+        change = result['throughput'] / old['throughput'] - 1 if old['throughput'] else 0.0
+        add(name, 'throughput', old['throughput'], result['throughput'], change,
+            change < -threshold)
+        for operation, stats in result['operations'].items():
+            old_stats = old['operations'].get(operation)
+            if old_stats == None or not old_stats['p99_us']:
+                continue
+            change = stats['p99_us'] / old_stats['p99_us'] - 1
+            add(name, operation + ' p99_us', old_stats['p99_us'], stats['p99_us'], change,
+                change > latency_threshold)
+        if 'transactions' in result and 'transactions' in old:
+            old_rate = old['transactions']['abort_rate']
+            new_rate = result['transactions']['abort_rate']
+            add(name, 'abort_rate', old_rate, new_rate, new_rate - old_rate,
+                new_rate - old_rate > abort_threshold)
+    return rows
+
+
+def print_results(results):
+    for name, result in results['workloads'].items():
+        print('{:<40} {:>14,.0f} ops/sec'.format(name, result['throughput']))
+        for operation, stats in result['operations'].items():
+            print('{:<40} {:>10,.1f} us p50 {:>10,.1f} us p99'.format(
+                '  ' + operation, stats['p50_us'], stats['p99_us']))
+        if 'transactions' in result:
+            print('{:<40} {:>13.1%}'.format('  abort rate', result['transactions']['abort_rate']))
+
+
+def print_comparison(rows):
+    for row in rows:
+        print('{:<20} {:<28} {:>14,.1f} {:>14,.1f} {:>+8.1%}{}'.format(
+            row['workload'], row['metric'], row['baseline'], row['result'], row['change'],
+            '  REGRESSION' if row['regression'] else ''))
+
+
+def parse_sizes(text: str):
+    sizes = [int(size) for size in text.split(':')]
+    if len(sizes) == 1:
+        sizes.append(sizes[0])
+    if len(sizes) != 2:
+        raise argparse.ArgumentTypeError("sizes must be min:max or one size")
+    return tuple(sizes)
+
+
+# name=value, value parsed as JSON when it is (true, 3, "arena") else kept as text
+def parse_option(text: str):
+    if '=' not in text:
+        raise argparse.ArgumentTypeError("options must be name=value")
+    name, value = text.split('=', 1)
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return name, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='YCSB-style workloads for SimpleDB')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--workloads', default=','.join(WORKLOADS))
+    run_parser.add_argument('--records', type=int, default=DEFAULTS['records'])
+    run_parser.add_argument('--operations', type=int, default=DEFAULTS['operations'])
+    run_parser.add_argument('--distribution', choices=DISTRIBUTIONS[:2],
+                            default=DEFAULTS['distribution'])
+    for name in ('key', 'value'):
+        run_parser.add_argument('--%s-size' % name, type=parse_sizes,
+                                default=DEFAULTS['%s_size' % name])
+        run_parser.add_argument('--%s-distribution' % name, choices=DISTRIBUTIONS,
+                                default=DEFAULTS['%s_distribution' % name])
+    for name in ('scan_length', 'batch_size', 'transaction_keys', 'concurrency', 'seed',
+                 'repeat'):
+        run_parser.add_argument('--' + name.replace('_', '-'), type=int, default=DEFAULTS[name])
+    run_parser.add_argument('--db-option', type=parse_option, action='append', default=[])
+    run_parser.add_argument('--output')
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    compare_parser.add_argument('--latency-threshold', type=float, default=0.25)
+    compare_parser.add_argument('--abort-threshold', type=float, default=0.01)
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.baseline) as baseline_file, open(args.results) as results_file:
+            rows = compare(json.load(baseline_file), json.load(results_file), args.threshold,
+                           args.latency_threshold, args.abort_threshold)
+        print_comparison(rows)
+        return 1 if any(row['regression'] for row in rows) else 0
+
+    config = {name: getattr(args, name) for name in DEFAULTS}
+    results = run(args.workloads.split(','), config, dict(args.db_option))
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())